@@ -1,4 +1,7 @@
 import asyncio
+import csv
+import io
+import json
 import nonebot
 import datetime
 import inspect
@@ -6,7 +9,7 @@ import os
 import sys
 
 from typing import ForwardRef, _eval_type  # type: ignore
-from typing import Any, List, Dict, Type, Union, Optional, TYPE_CHECKING
+from typing import Any, List, Dict, Type, Union, Optional, Tuple, TYPE_CHECKING
 
 from playhouse.shortcuts import model_to_dict
 from pydantic import BaseModel, conset
@@ -20,12 +23,16 @@ from nonebot.typing import T_State
 
 from fastapi import FastAPI, Request, Path, Response, Cookie, WebSocket, WebSocketDisconnect
 from fastapi.staticfiles import StaticFiles
-from starlette.responses import FileResponse
+from starlette.responses import FileResponse, StreamingResponse
 
 from .utils import BossStatus, ClanBattle, ClanBattleData, CommitBattlrOnTreeResult, CommitInProgressResult, CommitRecordResult, CommitSLResult, CommitSubscribeResult, WebAuth
 from .utils import Tools, MessageFormatter, ClanRankQueryHelperTw
+from .db import db_executor
+from .message_sender import message_sender
+from .web_push import clan_state_publisher
+from .command_router import CommandRouter
 
-from .exception import WebsocketResloveException, WebsocketAuthException
+from .exception import ClanBattleException, WebsocketResloveException, WebsocketAuthException
 
 from .config import load_config, get_config
 
@@ -65,6 +72,47 @@ if not "pytest" in sys.modules:
         if os.path.isdir(static_file_path):
             app.mount("/", StaticFiles(directory=static_file_path, html=True),
                       name="static")
+
+    session_sweeper_task = None
+
+    @driver.on_startup
+    async def start_session_sweeper():  # 定期清理过期的网页会话和已处理的群消息
+        global session_sweeper_task
+
+        async def sweep_sessions():
+            while True:
+                try:
+                    await db_executor.run(WebAuth.sweep_expired_sessions)
+                    await db_executor.run_write(message_sender.outbox_write_key, message_sender.sweep)
+                except Exception as e:
+                    print(f"YukiClanbattle: Sweep expired sessions failed: {e}")
+                await asyncio.sleep(3600)
+        session_sweeper_task = asyncio.create_task(sweep_sessions())
+
+    bot_index_refresher_task = None
+
+    @driver.on_startup
+    async def start_bot_index_refresher():  # 定期刷新每个Bot所在的群
+        global bot_index_refresher_task
+
+        async def refresh_bot_index():
+            while True:
+                await asyncio.sleep(600)
+                await message_sender.bot_index.refresh_all(nonebot.get_bots())
+        bot_index_refresher_task = asyncio.create_task(refresh_bot_index())
+
+    @driver.on_bot_connect
+    async def resume_message_outbox(bot: Bot):  # Bot连接后继续发送发件箱中的群消息
+        try:
+            await message_sender.bot_index.refresh_bot(bot)
+        except Exception as e:
+            print(
+                f"YukiClanbattle: Get group list of bot {bot.self_id} failed: {e}")
+        await message_sender.resume()
+
+    @driver.on_bot_disconnect
+    async def remove_bot_index(bot: Bot):
+        message_sender.bot_index.remove_bot(bot.self_id)
 else:
     load_config()
     Tools.update_boss_info()
@@ -121,6 +169,11 @@ class WebQueryReport(WebPostBase):
     member: Optional[str]
     boss: Optional[str]
     cycle: Optional[str]
+    start_date: Optional[str] = None
+    end_date: Optional[str] = None
+    record_type: Optional[str] = None  # normal为完整刀，extra为补偿刀，kill为尾刀
+    cursor: Optional[str] = None
+    limit: Optional[int] = None
 
 
 class WebSetClanbattleData(WebPostBase):
@@ -145,27 +198,67 @@ class WebChangeBossStatus(WebPostBase):
     remain_hp: str
 
 
+class WebImportRecord(WebPostBase):
+    format: str  # csv、json或ndjson
+    content: str
+
+
+# 网页传入的日期对应的会战日时间范围（UTC），与原来按日期查询的换算方式一致
+def get_day_time_range(clan_type: str, date: str) -> Tuple[datetime.datetime, datetime.datetime]:
+    day_data = date.split('T')[0]
+    detla = datetime.timedelta(
+        hours=9) if clan_type == "jp" else datetime.timedelta(hours=8)
+    now_time_today = datetime.datetime.strptime(
+        day_data, "%Y-%m-%d") + datetime.timedelta(days=1)
+    start_time = now_time_today + datetime.timedelta(hours=5) - detla
+    end_time = now_time_today + datetime.timedelta(hours=29) - detla
+    return (start_time, end_time)
+
+
+# 分批读取出刀记录并逐块输出，内存占用与记录数量无关
+async def export_record_stream(clan, data_num: int, file_format: str):
+    fields = ClanBattleData.export_record_fields
+    if file_format == "csv":
+        # 带 BOM 以便 Excel 正确识别中文
+        yield "\ufeff" + ",".join(fields) + "\r\n"
+    cursor = None
+    while True:
+        rows = await clan.get_export_record_chunk(data_num, cursor)
+        if not rows:
+            break
+        buffer = io.StringIO()
+        if file_format == "csv":
+            writer = csv.writer(buffer)
+            writer.writerows(rows)
+        else:
+            for row in rows:
+                buffer.write(json.dumps(dict(zip(fields, row)),
+                             ensure_ascii=False, default=str) + "\n")
+        yield buffer.getvalue()
+        cursor = (rows[-1][3], rows[-1][0])
+
+
 class WebGetRoute:
     @staticmethod
     async def get_joined_clan(uid: str):
-        clan_list = clanbattle.get_joined_clan(uid)
+        clan_list = await clanbattle.get_joined_clan(uid)
         return {"err_code": 0, "clan_list": clan_list}
 
     @staticmethod
     async def boss_status(uid: str, clan_gid: str):
-        clan = clanbattle.get_clan_data(clan_gid)
-        boss_status = clan.get_current_boss_state()
+        clan = await clanbattle.get_clan_data(clan_gid)
+        boss_status = await clan.get_current_boss_state()
         return {"err_code": 0, "boss_status": boss_status}
     @staticmethod
     async def member_list(uid: str, clan_gid: str):
-        clan = clanbattle.get_clan_data(clan_gid)
-        member_list = clan.get_clan_members_with_info()
+        clan = await clanbattle.get_clan_data(clan_gid)
+        member_list = await clan.get_clan_members_with_info()
         return {"err_code": 0, "member_list": member_list}
 
     @staticmethod
     async def report_unqueue(uid: str, clan_gid: str):
-        clan = clanbattle.get_clan_data(clan_gid)
-        result = clan.delete_battle_in_progress(uid)
+        clan = await clanbattle.get_clan_data(clan_gid)
+        result = await clan.delete_battle_in_progress(uid)
         if result:
             return {"err_code": 0}
         else:
@@ -173,11 +266,11 @@ class WebGetRoute:
 
     @staticmethod
     async def get_in_queue(uid: str, clan_gid: str):
-        clan = clanbattle.get_clan_data(clan_gid)
+        clan = await clanbattle.get_clan_data(clan_gid)
         in_process_list_dict = {}
         for i in range(1, 6):
             in_process_list = []
-            in_processes = clan.get_battle_in_progress(boss=i)
+            in_processes = await clan.get_battle_in_progress(boss=i)
             for process in in_processes:
                 in_process_list.append(model_to_dict(process))
             in_process_list_dict[str(i)] = in_process_list
@@ -185,11 +278,11 @@ class WebGetRoute:
 
     @staticmethod
     async def on_tree_list(uid: str, clan_gid: str):
-        clan = clanbattle.get_clan_data(clan_gid)
+        clan = await clanbattle.get_clan_data(clan_gid)
         on_tree_list_dict = {}
         for i in range(1, 6):
             on_tree_list = []
-            on_trees = clan.get_battle_on_tree(boss=i)
+            on_trees = await clan.get_battle_on_tree(boss=i)
             for on_tree in on_trees:
                 on_tree_list.append(model_to_dict(on_tree))
             on_tree_list_dict[str(i)] = on_tree_list
@@ -197,11 +290,11 @@ class WebGetRoute:
 
     @staticmethod
     async def subscribe_list(uid: str, clan_gid: str):
-        clan = clanbattle.get_clan_data(clan_gid)
+        clan = await clanbattle.get_clan_data(clan_gid)
         subscribe_list_dict = {}
         for i in range(1, 6):
             subscribe_list = []
-            subscribes = clan.get_battle_subscribe(boss=i)
+            subscribes = await clan.get_battle_subscribe(boss=i)
             for subscribe in subscribes:
                 subscribe_list.append(model_to_dict(subscribe))
             subscribe_list_dict[str(i)] = subscribe_list
@@ -209,25 +302,33 @@ class WebGetRoute:
 
     @staticmethod
     async def current_clanbattle_data_num(uid: str, clan_gid: str):
-        clan = clanbattle.get_clan_data(clan_gid)
-        data_num = clan.get_current_clanbattle_data()
+        clan = await clanbattle.get_clan_data(clan_gid)
+        data_num = await clan.get_current_clanbattle_data()
         return {"err_code": 0, "data_num": data_num}
 
     @staticmethod
     async def clan_area(uid: str, clan_gid: str):
-        clan = clanbattle.get_clan_data(clan_gid)
+        clan = await clanbattle.get_clan_data(clan_gid)
         return {"err_code": 0, "area": clan.clan_info.clan_type}
 
     @staticmethod
     async def clan_name(uid: str, clan_gid: str):
-        clan = clanbattle.get_clan_data(clan_gid)
+        clan = await clanbattle.get_clan_data(clan_gid)
         return {"err_code": 0, "clan_name": clan.clan_info.clan_name}
 
+    # 面板首页需要的所有数据
+    @staticmethod
+    async def dashboard(uid: str, clan_gid: str):
+        clan = await clanbattle.get_clan_data(clan_gid)
+        version = clan.state_version
+        dashboard = await clan.run(ClanBattleData.get_dashboard)
+        return {"err_code": 0, "version": version, **dashboard}
+
 
 class WebPostRoute:
     @staticmethod
     async def login(item: WebLoginPost, request: Request, response: Response):
-        login_item = WebAuth.login(item.qq_uid, item.password)
+        login_item = await db_executor.run(WebAuth.login, item.qq_uid, item.password)
         if login_item[0] == 404:
             return {"err_code": 404, "msg": "找不到该用户"}
         elif login_item[0] == 403:
@@ -238,37 +339,39 @@ class WebPostRoute:
 
     @staticmethod
     async def report_record(item: WebReportRecord, session: str = Cookie(None)):
-        uid = WebAuth.check_session_valid(session)
+        uid = await clanbattle.get_session_uid(session)
         if item.is_proxy_report:
-            joined_clan = clanbattle.get_joined_clan(item.proxy_report_member)
+            joined_clan = await clanbattle.get_joined_clan(item.proxy_report_member)
             if not item.clan_gid in joined_clan:
                 return {"err_code": 403, "msg": "您还没有加入该公会"}
-        clan = clanbattle.get_clan_data(item.clan_gid)
+        clan = await clanbattle.get_clan_data(item.clan_gid)
         challenge_boss = int(item.target_boss)
         proxy_report_uid = item.proxy_report_member if item.is_proxy_report else None
         comment = item.comment if item.comment else None
         force_use_full_chance = item.froce_use_full_chance
+        expected_cycle = None
         if not item.is_kill_boss:
             challenge_damage = item.damage
         else:
-            boss_status = clan.get_current_boss_state()[challenge_boss-1]
-            challenge_damage = str(boss_status.boss_hp)
+            # 尾刀的伤害在提交时按boss剩余血量计算，同时检查boss没有被其他人先击败
+            boss_status = (await clan.get_current_boss_state())[challenge_boss-1]
+            challenge_damage = None
+            expected_cycle = boss_status.target_cycle
         if item.is_proxy_report:
-            result = await clan.commit_record(proxy_report_uid, challenge_boss, challenge_damage, comment, uid, force_use_full_chance)
+            result = await clan.commit_record(proxy_report_uid, challenge_boss, challenge_damage, comment, uid, force_use_full_chance, item.is_kill_boss, expected_cycle)
             uid = proxy_report_uid
         else:
-            result = await clan.commit_record(uid, challenge_boss, challenge_damage, comment, None, force_use_full_chance)
-        bot: Bot = list(nonebot.get_bots().values())[0]
+            result = await clan.commit_record(uid, challenge_boss, challenge_damage, comment, None, force_use_full_chance, item.is_kill_boss, expected_cycle)
         if result == CommitRecordResult.success:
-            record = clan.get_recent_record(uid)[0]
-            today_status = clan.get_today_record_status(uid)
-            boss_status = clan.get_current_boss_state()[challenge_boss-1]
+            record = (await clan.get_recent_record(uid))[0]
+            today_status = await clan.get_today_record_status(uid)
+            boss_status = (await clan.get_current_boss_state())[challenge_boss-1]
             if today_status.last_is_addition:
                 record_type = "补偿刀"
             else:
                 record_type = "完整刀"
-            await bot.send_group_msg(group_id=item.clan_gid, message="网页上报数据：\n" + MessageSegment.at(uid) + f"对{challenge_boss}王造成了{Tools.get_num_str_with_dot(record.damage)}点伤害\n今日第{today_status.today_challenged}刀，{record_type}\n当前{challenge_boss}王第{boss_status.target_cycle}周目，生命值{Tools.get_num_str_with_dot(boss_status.boss_hp)}")
-            return {"err_code": 0}
+            message_id = await message_sender.send(item.clan_gid, "网页上报数据：\n" + MessageSegment.at(uid) + f"对{challenge_boss}王造成了{Tools.get_num_str_with_dot(record.damage)}点伤害\n今日第{today_status.today_challenged}刀，{record_type}\n当前{challenge_boss}王第{boss_status.target_cycle}周目，生命值{Tools.get_num_str_with_dot(boss_status.boss_hp)}")
+            return {"err_code": 0, "message_id": message_id}
         elif result == CommitRecordResult.illegal_damage_inpiut:
             return {"err_code": 403, "msg": "上报的伤害格式不合法"}
         elif result == CommitRecordResult.damage_out_of_hp:
@@ -277,18 +380,19 @@ class WebPostRoute:
             return {"err_code": 403, "msg": "上报数据合法性检查错误，请检查是否正确上报"}
         elif result == CommitRecordResult.member_not_in_clan:
             return {"err_code": 403, "msg": "您还未加入公会，请发送“加入公会”加入"}
+        elif result == CommitRecordResult.boss_status_changed:
+            return {"err_code": 403, "msg": "boss已经被其他人击败，请刷新后重新上报"}
 
     @staticmethod
     async def report_queue(item: WebReportQueue, session: str = Cookie(None)):
-        uid = WebAuth.check_session_valid(session)
-        clan = clanbattle.get_clan_data(item.clan_gid)
+        uid = await clanbattle.get_session_uid(session)
+        clan = await clanbattle.get_clan_data(item.clan_gid)
         challenge_boss = int(item.target_boss)
         comment = item.comment if item.comment else None
-        result = clan.commit_battle_in_progress(uid, challenge_boss, comment)
-        bot: Bot = list(nonebot.get_bots().values())[0]
+        result = await clan.commit_battle_in_progress(uid, challenge_boss, comment)
         if result == CommitInProgressResult.success:
-            await bot.send_group_msg(group_id=item.clan_gid, message=MessageSegment.at(uid) + f"开始挑战{challenge_boss}王")
-            return {"err_code": 0}
+            message_id = await message_sender.send(item.clan_gid, MessageSegment.at(uid) + f"开始挑战{challenge_boss}王")
+            return {"err_code": 0, "message_id": message_id}
         elif result == CommitInProgressResult.already_in_battle:
             return {"err_code": 403, "msg": "您已经有正在挑战的boss"}
         elif result == CommitInProgressResult.illegal_target_boss:
@@ -298,17 +402,16 @@ class WebPostRoute:
 
     @staticmethod
     async def report_subscribe(item: WebReportSubscribe, session: str = Cookie(None)):
-        uid = WebAuth.check_session_valid(session)
-        clan = clanbattle.get_clan_data(item.clan_gid)
+        uid = await clanbattle.get_session_uid(session)
+        clan = await clanbattle.get_clan_data(item.clan_gid)
         challenge_boss = int(item.target_boss)
         cycle = int(item.target_cycle)
         comment = item.comment if item.comment else None
-        result = clan.commit_batle_subscribe(
+        result = await clan.commit_batle_subscribe(
             uid, challenge_boss, cycle, comment)
-        bot: Bot = list(nonebot.get_bots().values())[0]
         if result == CommitSubscribeResult.success:
-            await bot.send_group_msg(group_id=item.clan_gid, message=MessageSegment.at(uid) + f"预约了{cycle}周目{challenge_boss}王")
-            return {"err_code": 0}
+            message_id = await message_sender.send(item.clan_gid, MessageSegment.at(uid) + f"预约了{cycle}周目{challenge_boss}王")
+            return {"err_code": 0, "message_id": message_id}
         elif result == CommitSubscribeResult.already_in_progress:
             return {"err_code": 403, "msg": "您已经正在挑战这个boss了"}
         elif result == CommitSubscribeResult.already_subscribed:
@@ -320,11 +423,11 @@ class WebPostRoute:
 
     @staticmethod
     async def report_unsubscribe(item: WebReportSubscribe, session: str = Cookie(None)):
-        uid = WebAuth.check_session_valid(session)
-        clan = clanbattle.get_clan_data(item.clan_gid)
+        uid = await clanbattle.get_session_uid(session)
+        clan = await clanbattle.get_clan_data(item.clan_gid)
         challenge_boss = int(item.target_boss)
         cycle = int(item.target_cycle)
-        result = clan.delete_battle_subscribe(uid, challenge_boss, cycle)
+        result = await clan.delete_battle_subscribe(uid, challenge_boss, cycle)
         if result:
             return {"err_code": 0}
         else:
@@ -332,11 +435,11 @@ class WebPostRoute:
 
     @staticmethod
     async def report_ontree(item: WebReportOnTree, session: str = Cookie(None)):
-        uid = WebAuth.check_session_valid(session)
-        clan = clanbattle.get_clan_data(item.clan_gid)
+        uid = await clanbattle.get_session_uid(session)
+        clan = await clanbattle.get_clan_data(item.clan_gid)
         boss = int(item.boss)
         comment = item.comment if item.comment else None
-        result = clan.commit_battle_on_tree(uid, boss, comment)
+        result = await clan.commit_battle_on_tree(uid, boss, comment)
         if result == CommitBattlrOnTreeResult.success:
             return {"err_code": 0}
         elif result == CommitBattlrOnTreeResult.already_in_other_boss_progress:
@@ -348,16 +451,16 @@ class WebPostRoute:
 
     @staticmethod
     async def report_sl(item: WebReportSL, session: str = Cookie(None)):
-        uid = WebAuth.check_session_valid(session)
-        clan = clanbattle.get_clan_data(item.clan_gid)
+        uid = await clanbattle.get_session_uid(session)
+        clan = await clanbattle.get_clan_data(item.clan_gid)
         boss = int(item.boss)
         proxy_report_uid = item.proxy_report_uid if item.is_proxy_report else None
         comment = item.comment if item.comment else None
         if item.is_proxy_report:
-            result = clan.commit_battle_sl(
+            result = await clan.commit_battle_sl(
                 proxy_report_uid, boss, comment, uid)
         else:
-            result = clan.commit_battle_sl(
+            result = await clan.commit_battle_sl(
                 uid, boss, comment, proxy_report_uid)
         if result == CommitSLResult.success:
             return {"err_code": 0}
@@ -370,113 +473,126 @@ class WebPostRoute:
 
     @staticmethod
     async def query_record(item: WebQueryReport, session: str = Cookie(None)):
-        clan = clanbattle.get_clan_data(item.clan_gid)
+        clan = await clanbattle.get_clan_data(item.clan_gid)
         uid = item.member if item.member != '' else None
         boss = int(item.boss) if item.boss != '' else None
         cycle = int(item.cycle) if item.cycle != '' else None
         if item.date and item.date != '':
-            day_data = item.date.split('T')[0]
-            detla = datetime.timedelta(
-                hours=9) if clan.clan_info.clan_type == "jp" else datetime.timedelta(hours=8)
-            now_time_today = datetime.datetime.strptime(
-                day_data, "%Y-%m-%d") + datetime.timedelta(days=1)
-            start_time = now_time_today + datetime.timedelta(hours=5) - detla
-            end_time = now_time_today + datetime.timedelta(hours=29) - detla
+            start_time, end_time = get_day_time_range(
+                clan.clan_info.clan_type, item.date)
         else:
             start_time = None
             end_time = None
-        record_list = []
-        records = clan.get_record(uid=uid, boss=boss, cycle=cycle,
-                                  start_time=start_time, end_time=end_time, time_desc=True)
-        if not records:
-            return {"err_code": 0, "record": []}
-        for record in records:
-            record_list.append(model_to_dict(record))
-        return {"err_code": 0, "record": record_list}
+        # 日期范围，开始和结束日期都包含在内
+        if item.start_date:
+            start_time = get_day_time_range(
+                clan.clan_info.clan_type, item.start_date)[0]
+        if item.end_date:
+            end_time = get_day_time_range(
+                clan.clan_info.clan_type, item.end_date)[1]
+        cursor = None
+        if item.cursor:
+            try:
+                cursor_time, cursor_id = item.cursor.rsplit("_", 1)
+                cursor = (datetime.datetime.fromisoformat(
+                    cursor_time), int(cursor_id))
+            except ValueError:
+                return {"err_code": 403, "msg": "分页参数错误"}
+        limit = min(max(item.limit, 1), 500) if item.limit else 100
+        records, total, next_cursor = await clan.query_record_page(uid=uid, boss=boss, cycle=cycle, start_time=start_time, end_time=end_time,
+                                                                   record_type=item.record_type, cursor=cursor, limit=limit)
+        record_list = [model_to_dict(record) for record in records]
+        return {"err_code": 0, "record": record_list, "total": total,
+                "next_cursor": f"{next_cursor[0].isoformat()}_{next_cursor[1]}" if next_cursor else None}
 
     @staticmethod
     async def change_current_clanbattle_data_num(item: WebSetClanbattleData, session: str = Cookie(None)):
-        uid = WebAuth.check_session_valid(session)
-        clan = clanbattle.get_clan_data(item.clan_gid)
-        if not clan.check_admin_permission(str(uid)):
+        uid = await clanbattle.get_session_uid(session)
+        clan = await clanbattle.get_clan_data(item.clan_gid)
+        if not await clan.check_admin_permission(str(uid)):
             return {"err_code": -2, "msg": "您不是会战管理员，无权切换会战档案"}
-        clan.set_current_clanbattle_data(item.data_num)
-        bot: Bot = list(nonebot.get_bots().values())[0]
+        await clan.set_current_clanbattle_data(item.data_num)
         gid = clan.clan_info.clan_gid
-        await bot.send_group_msg(group_id=gid, message=f"会战管理员已经将会战档案切换为{item.data_num}，请注意")
-        return {"err_code": 0, "msg": "设置成功"}
+        message_id = await message_sender.send(gid, f"会战管理员已经将会战档案切换为{item.data_num}，请注意")
+        return {"err_code": 0, "msg": "设置成功", "message_id": message_id}
 
     @staticmethod
     async def battle_status(item: WebQueryChallengeStatusForm, session: str = Cookie(None)):
-        clan = clanbattle.get_clan_data(item.clan_gid)
-        status_list = []
-        members = clan.get_clan_members()
-        for member in members:
-            if not item.date:
-                status = clan.get_today_record_status(member)
-            else:
-                day_data = item.date.split('T')[0]
-                detla = datetime.timedelta(
-                    hours=9) if clan.clan_info.clan_type == "jp" else datetime.timedelta(hours=8)
-                now_time_today = datetime.datetime.strptime(
-                    day_data, "%Y-%m-%d") + datetime.timedelta(days=1)
-                start_time = now_time_today + \
-                    datetime.timedelta(hours=5) - detla
-                end_time = now_time_today + \
-                    datetime.timedelta(hours=29) - detla
-                status = clan.get_record_status(member, start_time, end_time)
-            status_list.append(status)
+        clan = await clanbattle.get_clan_data(item.clan_gid)
+        if not item.date:
+            status_list = await clan.get_today_member_status()
+        else:
+            day_data = item.date.split('T')[0]
+            detla = datetime.timedelta(
+                hours=9) if clan.clan_info.clan_type == "jp" else datetime.timedelta(hours=8)
+            now_time_today = datetime.datetime.strptime(
+                day_data, "%Y-%m-%d") + datetime.timedelta(days=1)
+            start_time = now_time_today + \
+                datetime.timedelta(hours=5) - detla
+            end_time = now_time_today + \
+                datetime.timedelta(hours=29) - detla
+            status_list = await clan.get_member_record_status(start_time, end_time)
         return {"err_code": 0, "status": status_list}
 
     @staticmethod
     async def notice_member(item: WebNoticeChallengeForm, session: str = Cookie(None)):
-        uid = WebAuth.check_session_valid(session)
-        clan = clanbattle.get_clan_data(item.clan_gid)
-        if not clan.check_admin_permission(str(uid)):
+        uid = await clanbattle.get_session_uid(session)
+        clan = await clanbattle.get_clan_data(item.clan_gid)
+        if not await clan.check_admin_permission(str(uid)):
             return {"err_code": -2, "msg": "您不是会战管理员，无权提醒其他成员出刀"}
         notice_list = []
         for key in item.notice_member:
             if item.notice_member[key] == True:
-                if clan.check_joined_clan(key):
+                if await clan.check_joined_clan(key):
                     notice_list.append(key)
-        bot: Bot = list(nonebot.get_bots().values())[0]
-        notice_message = Message("管理员催你快去出刀啦")
-        for member in notice_list:
-            notice_message += MessageSegment.at(member)
-            if len(notice_message) == 20:
-                await bot.send_group_msg(group_id=item.clan_gid, message=notice_message)
-                notice_message = Message("管理员催你快去出刀啦")
-        if len(notice_message) > 1:
-            await bot.send_group_msg(group_id=item.clan_gid, message=notice_message)
-        return {"err_code": 0}
+        message_id = None
+        if notice_list:
+            message_id = await message_sender.send(item.clan_gid, Message(
+                "管理员催你快去出刀啦") + Message(map(MessageSegment.at, notice_list)))
+        return {"err_code": 0, "message_id": message_id}
 
     @staticmethod
     async def remove_clan_member(item: WebRemoveClanMember, session: str = Cookie(None)):
-        uid = WebAuth.check_session_valid(session)
-        clan = clanbattle.get_clan_data(item.clan_gid)
-        if not clan.check_admin_permission(str(uid)):
+        uid = await clanbattle.get_session_uid(session)
+        clan = await clanbattle.get_clan_data(item.clan_gid)
+        if not await clan.check_admin_permission(str(uid)):
             return {"err_code": -2, "msg": "您不是会战管理员，无权将其他成员移出公会"}
         remove_uid = item.remove_member
-        bot: Bot = list(nonebot.get_bots().values())[0]
-        if clan.delete_clan_member(remove_uid):
-            await bot.send_group_msg(group_id=item.clan_gid, message=f"会战管理员通过网页将成员{remove_uid}移出公会")
-            return {"err_code": 0}
+        if await clan.delete_clan_member(remove_uid):
+            message_id = await message_sender.send(item.clan_gid, f"会战管理员通过网页将成员{remove_uid}移出公会")
+            return {"err_code": 0, "message_id": message_id}
         else:
             return {"err_code": 403, "msg": "移出公会失败，Ta可能还未加入公会？请尝试刷新页面！"}
 
     @staticmethod
     async def change_boss_status(item: WebChangeBossStatus, session: str = Cookie(None)):
-        uid = WebAuth.check_session_valid(session)
-        clan = clanbattle.get_clan_data(item.clan_gid)
-        if not clan.check_admin_permission(str(uid)):
+        uid = await clanbattle.get_session_uid(session)
+        clan = await clanbattle.get_clan_data(item.clan_gid)
+        if not await clan.check_admin_permission(str(uid)):
             return {"err_code": -2, "msg": "您不是会战管理员，无权调整boss状态"}
-        if clan.commit_force_change_boss_status(int(item.boss), int(item.cycle), item.remain_hp):
-            bot: Bot = list(nonebot.get_bots().values())[0]
-            await bot.send_group_msg(group_id=item.clan_gid, message=f"会战管理员通过网页将{item.boss}王调整至{item.cycle}周目，剩余生命值{item.remain_hp}")
-            return {"err_code": 0}
+        if await clan.commit_force_change_boss_status(int(item.boss), int(item.cycle), item.remain_hp):
+            message_id = await message_sender.send(item.clan_gid, f"会战管理员通过网页将{item.boss}王调整至{item.cycle}周目，剩余生命值{item.remain_hp}")
+            return {"err_code": 0, "message_id": message_id}
         else:
             return {"err_code": 403, "msg": "调整状态出现错误"}
 
+    @staticmethod
+    async def import_record(item: WebImportRecord, session: str = Cookie(None)):
+        uid = await clanbattle.get_session_uid(session)
+        clan = await clanbattle.get_clan_data(item.clan_gid)
+        if not await clan.check_admin_permission(str(uid)):
+            return {"err_code": -2, "msg": "您不是会战管理员，无权导入出刀记录"}
+        try:
+            rows = ClanBattleData.parse_import_content(
+                item.content, item.format)
+        except (ClanBattleException, ValueError) as e:
+            return {"err_code": 403, "msg": f"文件解析失败：{e}"}
+        count, errors = await clan.import_records(rows)
+        if errors:
+            return {"err_code": 403, "msg": "导入失败，请检查记录内容", "errors": errors}
+        message_id = await message_sender.send(item.clan_gid, f"会战管理员通过网页导入了{count}条出刀记录")
+        return {"err_code": 0, "count": count, "message_id": message_id}
+
 
 if not "pytest" in sys.modules:
 
@@ -489,21 +605,95 @@ if not "pytest" in sys.modules:
     async def _():
         return FileResponse(os.path.join(os.path.dirname(__file__), "dist/index.html"))
 
+    # 网页面板推送，连接后发送 {"action": "subscribe", "clan_gid": "公会群号"} 订阅公会
+    # 订阅后先推送完整数据 snapshot，之后数据变化时推送 diff，只包含变化的部分和新的版本号
+    @app.websocket("/api/clanbattle/ws")
+    async def _(websocket: WebSocket, session: str = Cookie(None)):
+        await websocket.accept()
+        try:
+            if not (uid := await clanbattle.get_session_uid(session)):
+                raise WebsocketAuthException()
+            while True:
+                try:
+                    request = await websocket.receive_json()
+                    action = request["action"]
+                    clan_gid = str(request["clan_gid"])
+                except (ValueError, KeyError, TypeError):
+                    await websocket.send_json({"err_code": 400, "msg": str(WebsocketResloveException())})
+                    continue
+                if action != "subscribe":
+                    await websocket.send_json({"err_code": 404, "msg": "找不到该操作"})
+                    continue
+                if not clan_gid in (await clanbattle.check_session(session))[1]:
+                    await websocket.send_json({"err_code": 403, "msg": "您还没有加入该公会"})
+                    continue
+                if not await clan_state_publisher.subscribe(websocket, await clanbattle.get_clan_data(clan_gid)):
+                    await websocket.send_json({"err_code": 404, "msg": "公会不存在"})
+        except WebsocketAuthException as e:
+            await websocket.send_json({"err_code": -1, "msg": str(e)})
+            await websocket.close(code=4001)
+        except WebSocketDisconnect:
+            pass
+        finally:
+            clan_state_publisher.unsubscribe(websocket)
+
+    # 导出会战档案的出刀记录，format 为 csv 或 ndjson，不指定 data_num 时导出当前档案
+    @app.get("/api/clanbattle/export/{clan_gid}")
+    async def _(clan_gid: str, response: Response, format: str = "csv", data_num: int = None, session: str = Cookie(None)):
+        uid, joined_clan = await clanbattle.check_session(session)
+        if not uid:
+            return {"err_code": -1, "msg": "会话错误，请重新登录"}
+        if not clan_gid in joined_clan:
+            return {"err_code": 403, "msg": "您还没有加入该公会"}
+        if not format in ["csv", "ndjson"]:
+            response.status_code = 404
+            return {"err_code": 404, "msg": "不支持该导出格式"}
+        clan = await clanbattle.get_clan_data(clan_gid)
+        if not data_num:
+            data_num = clan.clan_info.current_using_data_num
+        media_type = "text/csv; charset=utf-8" if format == "csv" else "application/x-ndjson"
+        return StreamingResponse(export_record_stream(clan, data_num, format), media_type=media_type,
+                                 headers={"Content-Disposition": f'attachment; filename="clanbattle_{clan_gid}_{data_num}.{format}"'})
+
+    # 查询网页操作发送到群里的消息的发送状态
+    @app.get("/api/clanbattle/message/{message_id}")
+    async def _(message_id: int, response: Response, session: str = Cookie(None)):
+        uid, joined_clan = await clanbattle.check_session(session)
+        if not uid:
+            return {"err_code": -1, "msg": "会话错误，请重新登录"}
+        message = await db_executor.run(message_sender.get_message, message_id)
+        if not message or not message.group_id in joined_clan:
+            response.status_code = 404
+            return {"err_code": 404, "msg": "找不到该消息"}
+        return {"err_code": 0, "message_id": message.id, "status": message.status, "attempts": message.attempts,
+                "created": message.created, "sent_time": message.sent_time, "last_error": message.last_error}
+
     @app.get("/api/clanbattle/{api_name}")
-    async def _(api_name: str, response: Response, clan_gid: str = None, session: str = Cookie(None)):
-        if not (uid := WebAuth.check_session_valid(session)):
+    async def _(api_name: str, request: Request, response: Response, clan_gid: str = None, session: str = Cookie(None)):
+        uid, joined_clan = await clanbattle.check_session(session)
+        if not uid:
             return {"err_code": -1, "msg": "会话错误，请重新登录"}
         if not hasattr(WebGetRoute, api_name):
             response.status_code = 404
             return {"err_code": 404, "msg": "找不到该路由"}
+        # 根据路由和公会数据版本生成 ETag，数据未变化时返回304，不需要查询数据库
+        etag = None
+        if api_name in ["get_joined_clan"]:
+            etag = f'W/"{api_name}-{uid}-{",".join(joined_clan)}"'
+        elif clan_gid in joined_clan and not api_name in ["report_unqueue"]:
+            if clan := await clanbattle.get_clan_data(clan_gid):
+                etag = clan.get_state_etag(api_name)
+        if etag and Tools.etag_matches(request.headers.get("if-none-match"), etag):
+            return Response(status_code=304, headers={"ETag": etag})
         if api_name in ["get_joined_clan"]:
             ret = await getattr(WebGetRoute, api_name)(uid=uid)
         else:
-            joined_clan = clanbattle.get_joined_clan(uid)
             if not clan_gid in joined_clan:
                 return {"err_code": 403, "msg": "您还没有加入该公会"}
             #clan = clanbattle.get_clan_data(clan_gid)
             ret = await getattr(WebGetRoute, api_name)(uid=uid, clan_gid=clan_gid)
+        if etag:
+            response.headers["ETag"] = etag
         return ret
 
     @app.post("/api/clanbattle/{api_name}")
@@ -521,9 +711,9 @@ if not "pytest" in sys.modules:
                 post_item_class: WebPostBase = sig.parameters["item"].annotation
                 item_inst = post_item_class.parse_obj(json_content)
                 # 部分鉴权
-                if not (uid := WebAuth.check_session_valid(session)):
+                uid, joined_clan = await clanbattle.check_session(session)
+                if not uid:
                     return {"err_code": -1, "msg": "会话错误，请重新登录"}
-                joined_clan = clanbattle.get_joined_clan(uid)
                 if not item_inst.clan_gid in joined_clan:
                     return {"err_code": 403, "msg": "您还没有加入该公会"}
                 return await post_func(item=item_inst, session=session)
@@ -532,65 +722,89 @@ if not "pytest" in sys.modules:
             return "Forbidden"
 
 
+# 报刀、尾刀等指令前可以带boss编号
+def with_boss_prefix(keyword: str) -> List[str]:
+    return [keyword] + [f"{boss}{keyword}" for boss in range(1, 6)]
+
+
+clanbattle_router = CommandRouter()
+
+
 class clanbattle_qq:
-    worker = MatcherGroup(
-        type="message", block=True
-    )
-    create_clan = worker.on_regex(r"^创建([台日国])服[公工]会$")
-    commit_record = worker.on_regex(
-        r"^([1-5]{1})?报刀 ?(整)? ?([1-5]{1})??( )?(\d+[EeKkWwBb]{0,2})?([:：](.*?))? ?(\[CQ:at,qq=([1-9][0-9]{4,})\] ?)?$"
-    )
-    commit_kill_record = worker.on_regex(
-        r"^([1-5]{1})?尾刀 ?(整)? ?([1-5]{1})?? ?([:：](.*?))? ?(\[CQ:at,qq=([1-9][0-9]{4,})\] ?)?$")
-    progress = worker.on_regex(r"^(状态|查) ?([1-5]{0,5})?$")
-    query_recent_record = worker.on_regex(
-        r"^查刀 ?(\[CQ:at,qq=([1-9][0-9]{4,})\] ?)?$")
-    queue = worker.on_regex(r"^((申请(出刀)?)|进) ?([1-5]{1})?([:：](.*?))?$")
-    unqueue = worker.on_regex(r"^取消申请|解锁$")
-    showqueue = worker.on_regex(r"^出刀表 ?([1-5]{1,5})?$")
+    # 所有指令由 clanbattle_router 的同一个响应器处理，以下名称用于发送回复
+    router = clanbattle_router
+    create_clan = router.on_regex(
+        "create_clan", r"^创建([台日国])服[公工]会$", ["创建"])
+    commit_record = router.on_regex(
+        "commit_record", r"^([1-5]{1})?报刀 ?(整)? ?([1-5]{1})??( )?(\d+[EeKkWwBb]{0,2})?([:：](.*?))? ?(\[CQ:at,qq=([1-9][0-9]{4,})\] ?)?$",
+        with_boss_prefix("报刀"))
+    commit_kill_record = router.on_regex(
+        "commit_kill_record", r"^([1-5]{1})?尾刀 ?(整)? ?([1-5]{1})?? ?([:：](.*?))? ?(\[CQ:at,qq=([1-9][0-9]{4,})\] ?)?$",
+        with_boss_prefix("尾刀"))
+    progress = router.on_regex(
+        "progress", r"^(状态|查) ?([1-5]{0,5})?$", ["状态", "查"])
+    query_recent_record = router.on_regex(
+        "query_recent_record", r"^查刀 ?(\[CQ:at,qq=([1-9][0-9]{4,})\] ?)?$", ["查刀"])
+    queue = router.on_regex(
+        "queue", r"^((申请(出刀)?)|进) ?([1-5]{1})?([:：](.*?))?$", ["申请", "进"])
+    unqueue = router.on_regex(
+        "unqueue", r"^取消申请|解锁$", ["取消申请"], ["解锁"])
+    showqueue = router.on_regex(
+        "showqueue", r"^出刀表 ?([1-5]{1,5})?$", ["出刀表"])
     #clearqueue = worker.on_regex(r"^[清删][空除]出刀表([1-5]{1,5})?$")
-    on_tree = worker.on_regex(
-        r"^挂树 ?([1-5]{1})?([:：](.*?))? ?(\[CQ:at,qq=([1-9][0-9]{4,})\] ?)?$"
-    )
-    un_on_tree = worker.on_regex(r"^取消挂树|下树$")
-    query_on_tree = worker.on_regex(r"^查树$")
-    subscribe = worker.on_regex(
-        r"^预约 ?([1-5]{1})( )?([0-9]{1,3})?([:：](.*?))?$")
-    showsubscribe = worker.on_regex(r"^预约表$")
-    unsubscribe = worker.on_regex(r"^取消预约 ?([1-5]{1})( )?([0-9]{1,3})?$")
-    undo_record_commit = worker.on_regex(
-        r"^撤[回销]? ?([1-5]{1})?$"
-    )
-    sl = worker.on_regex(
-        r"^[sS][lL](\?|？)? ?([1-5]{1})?([:：](.*?))?(\[CQ:at,qq=([1-9][0-9]{4,})\] ?)?$")
-    sl_query = on_regex(r"^查[sS][lL] ?(\[CQ:at,qq=([1-9][0-9]{4,})\] ?)?$")
-    today_record = on_regex(r"^今日出刀 ?(\[CQ:at,qq=([1-9][0-9]{4,})\] ?)?$")
-    webview = worker.on_regex(r"^面板$")
-    help = worker.on_regex(r"^帮助$")
-    join_clan = worker.on_regex(
-        r"^加入[公工]会 ?(\[CQ:at,qq=([1-9][0-9]{4,})\] ?)?$")
-    leave_clan = worker.on_regex(r"^退出[公工]会$")
-    refresh_clan_admin = worker.on_regex(r"^刷新会战管理员列表$")
-    rename_clan_uname = worker.on_regex(
-        r"^修改昵称 ?(.{1,20})(\[CQ:at,qq=([1-9][0-9]{4,})\] ?)?$")
-    rename_clan = worker.on_regex(r"^修改[公工]会名称 ?(.{1,20})$")
-    remove_clan_member = worker.on_regex(r"^移出[公工]会 ?(.{1,20})$")
-    reset_password = worker.on_regex(r"^设置密码 ?(.{1,20})$")
-    add_clanbattle_admin = on_regex(
-        r"^添加会战管理员 ?(\[CQ:at,qq=([1-9][0-9]{4,})\] ?)$")
-    join_all_member = worker.on_regex(r"^加入全部成员$")
-    switch_current_clanbattle_data = worker.on_regex(r"^切换会战档案 ?(.{1,2})$")
-    clear_current_clanbattle_data = worker.on_regex(r"^清空当前会战档案$")
-    force_change_boss_status = worker.on_regex(
-        r"^修改进度 ?([1-5]{1}) ([0-9]{1,3}) (\d+[EeKkWwBb]{0,2})$")
-    delete_clan = worker.on_regex(r"^清除公会数据$")
-    query_certain_num = worker.on_regex(r"^查(([0-3]{1})|(补偿))刀$")
-    notice_not_report = worker.on_regex(r"^催刀([0-2]{1})?$")
-    clan_rank = worker.on_regex(r"^公会排名$")
+    on_tree = router.on_regex(
+        "on_tree", r"^挂树 ?([1-5]{1})?([:：](.*?))? ?(\[CQ:at,qq=([1-9][0-9]{4,})\] ?)?$", ["挂树"])
+    un_on_tree = router.on_regex(
+        "un_on_tree", r"^取消挂树|下树$", ["取消挂树"], ["下树"])
+    query_on_tree = router.on_regex("query_on_tree", r"^查树$", ["查树"])
+    subscribe = router.on_regex(
+        "subscribe", r"^预约 ?([1-5]{1})( )?([0-9]{1,3})?([:：](.*?))?$", ["预约"])
+    showsubscribe = router.on_regex("showsubscribe", r"^预约表$", ["预约表"])
+    unsubscribe = router.on_regex(
+        "unsubscribe", r"^取消预约 ?([1-5]{1})( )?([0-9]{1,3})?$", ["取消预约"])
+    undo_record_commit = router.on_regex(
+        "undo_record_commit", r"^撤[回销]? ?([1-5]{1})?$", ["撤"])
+    sl = router.on_regex(
+        "sl", r"^[sS][lL](\?|？)? ?([1-5]{1})?([:：](.*?))?(\[CQ:at,qq=([1-9][0-9]{4,})\] ?)?$", ["sl"])
+    sl_query = router.on_regex(
+        "sl_query", r"^查[sS][lL] ?(\[CQ:at,qq=([1-9][0-9]{4,})\] ?)?$", ["查sl"], block=False)
+    today_record = router.on_regex(
+        "today_record", r"^今日出刀 ?(\[CQ:at,qq=([1-9][0-9]{4,})\] ?)?$", ["今日出刀"], block=False)
+    webview = router.on_regex("webview", r"^面板$", ["面板"])
+    help = router.on_regex("help", r"^帮助$", ["帮助"])
+    join_clan = router.on_regex(
+        "join_clan", r"^加入[公工]会 ?(\[CQ:at,qq=([1-9][0-9]{4,})\] ?)?$", ["加入"])
+    leave_clan = router.on_regex("leave_clan", r"^退出[公工]会$", ["退出"])
+    refresh_clan_admin = router.on_regex(
+        "refresh_clan_admin", r"^刷新会战管理员列表$", ["刷新会战管理员列表"])
+    rename_clan_uname = router.on_regex(
+        "rename_clan_uname", r"^修改昵称 ?(.{1,20})(\[CQ:at,qq=([1-9][0-9]{4,})\] ?)?$", ["修改昵称"])
+    rename_clan = router.on_regex(
+        "rename_clan", r"^修改[公工]会名称 ?(.{1,20})$", ["修改公会名称", "修改工会名称"])
+    remove_clan_member = router.on_regex(
+        "remove_clan_member", r"^移出[公工]会 ?(.{1,20})$", ["移出"])
+    reset_password = router.on_regex(
+        "reset_password", r"^设置密码 ?(.{1,20})$", ["设置密码"])
+    add_clanbattle_admin = router.on_regex(
+        "add_clanbattle_admin", r"^添加会战管理员 ?(\[CQ:at,qq=([1-9][0-9]{4,})\] ?)$", ["添加会战管理员"], block=False)
+    join_all_member = router.on_regex(
+        "join_all_member", r"^加入全部成员$", ["加入全部成员"])
+    switch_current_clanbattle_data = router.on_regex(
+        "switch_current_clanbattle_data", r"^切换会战档案 ?(.{1,2})$", ["切换会战档案"])
+    clear_current_clanbattle_data = router.on_regex(
+        "clear_current_clanbattle_data", r"^清空当前会战档案$", ["清空当前会战档案"])
+    force_change_boss_status = router.on_regex(
+        "force_change_boss_status", r"^修改进度 ?([1-5]{1}) ([0-9]{1,3}) (\d+[EeKkWwBb]{0,2})$", ["修改进度"])
+    delete_clan = router.on_regex("delete_clan", r"^清除公会数据$", ["清除公会数据"])
+    query_certain_num = router.on_regex(
+        "query_certain_num", r"^查(([0-3]{1})|(补偿))刀$", ["查"])
+    notice_not_report = router.on_regex(
+        "notice_not_report", r"^催刀([0-2]{1})?$", ["催刀"])
+    clan_rank = router.on_regex("clan_rank", r"^公会排名$", ["公会排名"])
     #killcalc = worker.on_regex(r"^合刀( )?(\d+) (\d+) (\d+)( \d+)?$")
 
 
-@clanbattle_qq.create_clan.handle()
+@clanbattle_router.handle("create_clan")
 async def create_clan_qq(bot: Bot, event: GroupMessageEvent, state: T_State):
     gid = str(event.group_id)
     clan_area = state['_matched_groups'][0]
@@ -600,7 +814,7 @@ async def create_clan_qq(bot: Bot, event: GroupMessageEvent, state: T_State):
         clan_type = "tw"
     elif clan_area == "国":
         clan_type = "cn"
-    clan = clanbattle.get_clan_data(gid)
+    clan = await clanbattle.get_clan_data(gid)
     if clan:
         await clanbattle_qq.create_clan.send("公会已经存在！")
     else:
@@ -615,33 +829,29 @@ async def create_clan_qq(bot: Bot, event: GroupMessageEvent, state: T_State):
         for member in group_member_list:
             if member["role"] in ["owner", "admin"] and member["user_id"] != int(bot.self_id):
                 admin_list.append(str(member["user_id"]))
-        clanbattle.create_clan(gid, group_name, clan_type, admin_list)
+        await clanbattle.create_clan(gid, group_name, clan_type, admin_list)
         await clanbattle_qq.create_clan.send("公会创建成功，请发送“帮助”查看使用说明")
-        clan = clanbattle.get_clan_data(gid)
+        clan = await clanbattle.get_clan_data(gid)
         if len(group_member_list) > 36:
             await clanbattle_qq.create_clan.send("当前群内人数过多，仅自动加入管理员，请手动加入需要加入公会的群员，如需加入全部成员请发送“加入全部成员”")
-            for member in group_member_list:
-                if member["role"] in ["owner", "admin"] and member["user_id"] != int(bot.self_id):
-                    clan.add_clan_member(str(
-                        member["user_id"]), member["card"] if member["card"] != "" else member["nickname"])
+            await clan.add_clan_members([(str(member["user_id"]), member["card"] if member["card"] != "" else member["nickname"])
+                                         for member in group_member_list if member["role"] in ["owner", "admin"] and member["user_id"] != int(bot.self_id)])
         else:
-            for member in group_member_list:
-                if member["user_id"] != int(bot.self_id):
-                    clan.add_clan_member(str(
-                        member["user_id"]), member["card"] if member["card"] != "" else member["nickname"])
+            await clan.add_clan_members([(str(member["user_id"]), member["card"] if member["card"] != "" else member["nickname"])
+                                         for member in group_member_list if member["user_id"] != int(bot.self_id)])
             await clanbattle_qq.create_clan.send("已经将全部群成员加入公会")
 
 
-@clanbattle_qq.progress.handle()
+@clanbattle_router.handle("progress")
 async def get_clanbatle_status_qq(bot: Bot, event: GroupMessageEvent, state: T_State):
     print(get_config)
     gid = str(event.group_id)
-    clan = clanbattle.get_clan_data(gid)
+    clan = await clanbattle.get_clan_data(gid)
     if not clan:
         await clanbattle_qq.progress.finish("本群还未创建公会，发送“创建[国台日]服公会”来创建公会")
-    if not clan.check_joined_clan(str(event.user_id)):
+    if not await clan.check_joined_clan(str(event.user_id)):
         await clanbattle_qq.progress.finish("您还没有加入公会，请发送“加入公会”来加入公会哦")
-    boss_status = clan.get_current_boss_state()
+    boss_status = await clan.get_current_boss_state()
     if state['_matched_groups'][0] == "状态" and not state['_matched_groups'][1]:
         msg = "当前状态：\n" if not get_config().enable_anti_msg_fail else "Status:\n"
         # for boss in boss_status:
@@ -650,8 +860,8 @@ async def get_clanbatle_status_qq(bot: Bot, event: GroupMessageEvent, state: T_S
         #     if not clan.check_boss_challengeable(boss.target_cycle, boss.target_boss):
         #         msg += "（不可挑战）"
         #     msg += "\n"
-        msg += MessageFormatter.get_all_boss_status_msg(clan=clan)
-        status = clan.get_today_record_status_total()
+        msg += await clan.run(MessageFormatter.get_all_boss_status_msg)
+        status = await clan.get_today_record_status_total()
         msg += f"今日已出{status[0]}刀，剩余{status[1]}刀补偿刀"
         # in_processes = clan.get_battle_in_progress()
         # in_processes_num = 0
@@ -665,7 +875,7 @@ async def get_clanbatle_status_qq(bot: Bot, event: GroupMessageEvent, state: T_S
         await clanbattle_qq.progress.finish(msg.strip() if not get_config().enable_anti_msg_fail else msg.strip() + "喵")
     elif state['_matched_groups'][1]:
         boss_count = int(state['_matched_groups'][1])
-        msg = MessageFormatter.get_boss_status_msg(clan=clan,boss_count=boss_count)
+        msg = await clan.run(MessageFormatter.get_boss_status_msg, boss_count)
         # boss = boss_status[boss_count-1]
         # msg = f"当前{boss_count}王位于{boss.target_cycle}周目，剩余血量{Tools.get_num_str_with_dot(boss.boss_hp)}"
         # if not clan.check_boss_challengeable(boss.target_cycle, boss_count):
@@ -704,7 +914,7 @@ async def get_clanbatle_status_qq(bot: Bot, event: GroupMessageEvent, state: T_S
         await clanbattle_qq.progress.finish(msg.strip() if isinstance(msg, str) else msg)
 
 
-@clanbattle_qq.commit_record.handle()
+@clanbattle_router.handle("commit_record")
 async def commit_record_qq(bot: Bot, event: GroupMessageEvent, state: T_State):
     proxy_report_uid: str = None
     if not state['_matched_groups'][8]:
@@ -720,28 +930,28 @@ async def commit_record_qq(bot: Bot, event: GroupMessageEvent, state: T_State):
                              ) if state['_matched_groups'][2] else None
     challenge_damage = state['_matched_groups'][4]
     comment = state['_matched_groups'][6]
-    clan = clanbattle.get_clan_data(str(event.group_id))
+    clan = await clanbattle.get_clan_data(str(event.group_id))
     if not challenge_boss:
-        if progress := clan.get_battle_in_progress(uid=uid):
+        if progress := await clan.get_battle_in_progress(uid=uid):
             challenge_boss = progress[0].target_boss
-        elif on_tree := clan.get_battle_on_tree(uid=uid):
+        elif on_tree := await clan.get_battle_on_tree(uid=uid):
             challenge_boss = on_tree[0].target_boss
         elif proxy_report_uid:
-            if progress := clan.get_battle_in_progress(uid=proxy_report_uid):
+            if progress := await clan.get_battle_in_progress(uid=proxy_report_uid):
                 challenge_boss = progress[0].target_boss
-            elif on_tree := clan.get_battle_on_tree(uid=proxy_report_uid):
+            elif on_tree := await clan.get_battle_on_tree(uid=proxy_report_uid):
                 challenge_boss = on_tree[0].target_boss
         if not challenge_boss:
             await clanbattle_qq.commit_record.finish("您还没有正在挑战的boss，请发送“报刀x 伤害”来进行报刀")
     if not clan:
         await clanbattle_qq.commit_record.finish("本群还未创建公会，发送“创建[国台日]服公会”来创建公会")
-    if not clan.check_joined_clan(str(event.user_id)):
+    if not await clan.check_joined_clan(str(event.user_id)):
         await clanbattle_qq.commit_record.finish("您还没有加入公会，请发送“加入公会”来加入公会哦")
     result = await clan.commit_record(uid, challenge_boss, challenge_damage, comment, proxy_report_uid, force_use_full_chance)
     if result == CommitRecordResult.success:
-        record = clan.get_recent_record(uid)[0]
-        today_status = clan.get_today_record_status(uid)
-        boss_status = clan.get_current_boss_state()[challenge_boss-1]
+        record = (await clan.get_recent_record(uid))[0]
+        today_status = await clan.get_today_record_status(uid)
+        boss_status = (await clan.get_current_boss_state())[challenge_boss-1]
         if today_status.last_is_addition:
             record_type = "补偿刀"
         else:
@@ -764,7 +974,7 @@ async def commit_record_qq(bot: Bot, event: GroupMessageEvent, state: T_State):
         await clanbattle_qq.commit_record.finish("你还挂在其他树上，先下树再说吧")
 
 
-@clanbattle_qq.commit_kill_record.handle()
+@clanbattle_router.handle("commit_kill_record")
 async def commit_kill_record(bot: Bot, event: GroupMessageEvent, state: T_State):
     proxy_report_uid: str = None
     if not state['_matched_groups'][6]:
@@ -779,30 +989,30 @@ async def commit_kill_record(bot: Bot, event: GroupMessageEvent, state: T_State)
         challenge_boss = int(state['_matched_groups'][2]
                              ) if state['_matched_groups'][2] else None
     comment = state['_matched_groups'][4]
-    clan = clanbattle.get_clan_data(str(event.group_id))
+    clan = await clanbattle.get_clan_data(str(event.group_id))
     if not clan:
         await clanbattle_qq.commit_kill_record.finish("本群还未创建公会，发送“创建[国台日]服公会”来创建公会")
-    if not clan.check_joined_clan(str(event.user_id)):
+    if not await clan.check_joined_clan(str(event.user_id)):
         await clanbattle_qq.commit_kill_record.finish("您还没有加入公会，请发送“加入公会”来加入公会哦")
     if not challenge_boss:
-        if progress := clan.get_battle_in_progress(uid=uid):
+        if progress := await clan.get_battle_in_progress(uid=uid):
             challenge_boss = progress[0].target_boss
-        elif on_tree := clan.get_battle_on_tree(uid=uid):
+        elif on_tree := await clan.get_battle_on_tree(uid=uid):
             challenge_boss = on_tree[0].target_boss
         elif proxy_report_uid:
-            if progress := clan.get_battle_in_progress(uid=proxy_report_uid):
+            if progress := await clan.get_battle_in_progress(uid=proxy_report_uid):
                 challenge_boss = progress[0].target_boss
-            elif on_tree := clan.get_battle_on_tree(uid=proxy_report_uid):
+            elif on_tree := await clan.get_battle_on_tree(uid=proxy_report_uid):
                 challenge_boss = on_tree[0].target_boss
         if not challenge_boss:
             await clanbattle_qq.commit_kill_record.finish("您还没有正在挑战的boss，请发送“尾刀x”来进行报刀")
-    boss_status = clan.get_current_boss_state()[challenge_boss-1]
-    challenge_damage = str(boss_status.boss_hp)
-    result = await clan.commit_record(uid, challenge_boss, challenge_damage, comment, proxy_report_uid, force_use_full_chance)
+    boss_status = (await clan.get_current_boss_state())[challenge_boss-1]
+    result = await clan.commit_record(uid, challenge_boss, None, comment, proxy_report_uid,
+                                      force_use_full_chance, is_kill_boss=True, expected_cycle=boss_status.target_cycle)
     if result == CommitRecordResult.success:
-        record = clan.get_recent_record(uid)[0]
-        today_status = clan.get_today_record_status(uid)
-        boss_status = clan.get_current_boss_state()[challenge_boss-1]
+        record = (await clan.get_recent_record(uid))[0]
+        today_status = await clan.get_today_record_status(uid)
+        boss_status = (await clan.get_current_boss_state())[challenge_boss-1]
         if today_status.last_is_addition:
             record_type = "补偿刀"
         else:
@@ -823,36 +1033,39 @@ async def commit_kill_record(bot: Bot, event: GroupMessageEvent, state: T_State)
         await clanbattle_qq.commit_kill_record.finish("现在无法挑战这个boss，别在这发癫了！")
     elif result == CommitRecordResult.on_another_tree:
         await clanbattle_qq.commit_kill_record.finish("你还挂在其他树上，先下树再说吧")
+    elif result == CommitRecordResult.boss_status_changed:
+        await clanbattle_qq.commit_kill_record.finish(f"{challenge_boss}王已经被其他人击败了，请确认后重新上报")
 
 
-@clanbattle_qq.queue.handle()
+@clanbattle_router.handle("queue")
 async def commit_in_progress(bot: Bot, event: GroupMessageEvent, state: T_State):
     print(state['_matched_groups'])
     uid = str(event.user_id)
     challenge_boss = int(state['_matched_groups'][3]
                          ) if state['_matched_groups'][3] else None
     comment = state['_matched_groups'][5]
-    clan = clanbattle.get_clan_data(str(event.group_id))
+    clan = await clanbattle.get_clan_data(str(event.group_id))
     if not clan:
         await clanbattle_qq.queue.finish("本群还未创建公会，发送“创建[国台日]服公会”来创建公会")
-    if not clan.check_joined_clan(str(event.user_id)):
+    if not await clan.check_joined_clan(str(event.user_id)):
         await clanbattle_qq.queue.finish("您还没有加入公会，请发送“加入公会”来加入公会哦")
     if not challenge_boss:
-        if progress := clan.get_battle_in_progress(uid=uid):
-            clan.update_battle_in_progress_record(uid, comment)
+        if progress := await clan.get_battle_in_progress(uid=uid):
+            await clan.update_battle_in_progress_record(uid, comment)
             await clanbattle_qq.queue.finish("修改出刀备注成功！")
     msg = ""
-    if processes := clan.get_battle_in_progress(boss=challenge_boss):
+    if processes := await clan.get_battle_in_progress(boss=challenge_boss):
         in_process_list = []
+        names = await clan.get_user_names([proc.member_uid for proc in processes])
         for proc in processes:
             if proc.comment and proc.comment != "":
                 in_process_list.append(
-                    f"{clan.get_user_info(proc.member_uid).uname}：{proc.comment}")
+                    f"{names[proc.member_uid]}：{proc.comment}")
             else:
                 in_process_list.append(
-                    clan.get_user_info(proc.member_uid).uname)
+                    names[proc.member_uid])
         msg = "、".join(in_process_list) + "正在对当前boss出刀，请注意"
-    result = clan.commit_battle_in_progress(uid, challenge_boss, comment)
+    result = await clan.commit_battle_in_progress(uid, challenge_boss, comment)
     if result == CommitInProgressResult.success:
         if not msg == "":
             await clanbattle_qq.queue.send(msg)
@@ -870,7 +1083,7 @@ async def commit_in_progress(bot: Bot, event: GroupMessageEvent, state: T_State)
         await clanbattle_qq.queue.finish("现在无法挑战这个boss，别在这发癫了！")
 
 
-@clanbattle_qq.on_tree.handle()
+@clanbattle_router.handle("on_tree")
 async def commit_on_tree(bot: Bot, event: GroupMessageEvent, state: T_State):
     uid = str(event.user_id)
     challenge_boss = int(state['_matched_groups'][0]
@@ -880,21 +1093,21 @@ async def commit_on_tree(bot: Bot, event: GroupMessageEvent, state: T_State):
         uid = str(event.user_id)
     else:
         uid = state['_matched_groups'][4]
-    clan = clanbattle.get_clan_data(str(event.group_id))
+    clan = await clanbattle.get_clan_data(str(event.group_id))
     if not clan:
         await clanbattle_qq.on_tree.finish("本群还未创建公会，发送“创建[国台日]服公会”来创建公会")
-    if not clan.check_joined_clan(str(event.user_id)):
+    if not await clan.check_joined_clan(str(event.user_id)):
         await clanbattle_qq.on_tree.finish("您还没有加入公会，请发送“加入公会”来加入公会哦")
     if not challenge_boss:
-        if in_proc := clan.get_battle_on_tree(uid):
-            clan.update_on_tree_record(uid, comment)
+        if in_proc := await clan.get_battle_on_tree(uid):
+            await clan.update_on_tree_record(uid, comment)
             await clanbattle_qq.on_tree.finish("挂树备注更新成功！")
             return
-        if progress := clan.get_battle_in_progress(uid=uid):
+        if progress := await clan.get_battle_in_progress(uid=uid):
             challenge_boss = progress[0].target_boss
         else:
             await clanbattle_qq.commit_record.finish("您还没有正在挑战的boss，请发送“挂树x ”来挂树")
-    result = clan.commit_battle_on_tree(uid, challenge_boss, comment)
+    result = await clan.commit_battle_on_tree(uid, challenge_boss, comment)
     if result == CommitBattlrOnTreeResult.success:
         await clanbattle_qq.on_tree.finish("嘿呀，" + MessageSegment.at(uid) + f"在{challenge_boss}王挂树了")
     elif result == CommitBattlrOnTreeResult.already_in_other_boss_progress:
@@ -909,19 +1122,19 @@ async def commit_on_tree(bot: Bot, event: GroupMessageEvent, state: T_State):
         await clanbattle_qq.on_tree.finish("现在无法挑战这个boss，别在这发癫了！")
 
 
-@clanbattle_qq.subscribe.handle()
+@clanbattle_router.handle("subscribe")
 async def commit_subscribe(bot: Bot, event: GroupMessageEvent, state: T_State):
     uid = str(event.user_id)
     challenge_boss = int(state['_matched_groups'][0])
     comment = state['_matched_groups'][4]
     cycle = int(state['_matched_groups'][2]
                 ) if state['_matched_groups'][2] else None
-    clan = clanbattle.get_clan_data(str(event.group_id))
+    clan = await clanbattle.get_clan_data(str(event.group_id))
     if not clan:
         await clanbattle_qq.subscribe.finish("本群还未创建公会，发送“创建[国台日]服公会”来创建公会")
-    if not clan.check_joined_clan(str(event.user_id)):
+    if not await clan.check_joined_clan(str(event.user_id)):
         await clanbattle_qq.subscribe.finish("您还没有加入公会，请发送“加入公会”来加入公会哦")
-    result = clan.commit_batle_subscribe(uid, challenge_boss, cycle,  comment)
+    result = await clan.commit_batle_subscribe(uid, challenge_boss, cycle,  comment)
     if result == CommitSubscribeResult.success:
         await clanbattle_qq.subscribe.finish("预约成功")
     elif result == CommitSubscribeResult.boss_cycle_already_killed:
@@ -934,58 +1147,58 @@ async def commit_subscribe(bot: Bot, event: GroupMessageEvent, state: T_State):
         await clanbattle_qq.subscribe.finish("您还未加入公会，请发送“加入公会”加入")
 
 
-@clanbattle_qq.join_clan.handle()
+@clanbattle_router.handle("join_clan")
 async def join_clan(bot: Bot, event: GroupMessageEvent, state: T_State):
     if not state['_matched_groups'][1]:
         uid = str(event.user_id)
     else:
         uid = state['_matched_groups'][1]
-    clan = clanbattle.get_clan_data(str(event.group_id))
+    clan = await clanbattle.get_clan_data(str(event.group_id))
     if not clan:
         await clanbattle_qq.join_clan.finish("本群还未创建公会，发送“创建[国台日]服公会”来创建公会")
-    if clan.check_joined_clan(uid):
+    if await clan.check_joined_clan(uid):
         await clanbattle_qq.join_clan.finish("您已经加入公会了，无需再加入")
     member_info = await bot.get_group_member_info(group_id=event.group_id, user_id=int(uid))
-    clan.add_clan_member(str(
+    await clan.add_clan_member(str(
         member_info["user_id"]), member_info["card"] if member_info["card"] != "" else member_info["nickname"])
     await clanbattle_qq.join_clan.finish("加入成功")
 
 
-@clanbattle_qq.today_record.handle()
+@clanbattle_router.handle("today_record")
 async def _(bot: Bot, event: GroupMessageEvent, state: T_State):
     uid = str(event.user_id)
-    clan = clanbattle.get_clan_data(str(event.group_id))
+    clan = await clanbattle.get_clan_data(str(event.group_id))
     if not clan:
         await clanbattle_qq.undo_record_commit.finish("本群还未创建公会，发送“创建[国台日]服公会”来创建公会")
-    if not clan.check_joined_clan(str(event.user_id)):
+    if not await clan.check_joined_clan(str(event.user_id)):
         await clanbattle_qq.undo_record_commit.finish("您还没有加入公会，请发送“加入公会”来加入公会哦")
-    records = clan.get_today_record(uid)
+    records = await clan.get_today_record(uid)
 
     pass
 
 
-@clanbattle_qq.undo_record_commit.handle()
+@clanbattle_router.handle("undo_record_commit")
 async def undo_record_commit(bot: Bot, event: GroupMessageEvent, state: T_State):
     uid = str(event.user_id)
-    clan = clanbattle.get_clan_data(str(event.group_id))
+    clan = await clanbattle.get_clan_data(str(event.group_id))
     if not clan:
         await clanbattle_qq.undo_record_commit.finish("本群还未创建公会，发送“创建[国台日]服公会”来创建公会")
-    if not clan.check_joined_clan(str(event.user_id)):
+    if not await clan.check_joined_clan(str(event.user_id)):
         await clanbattle_qq.undo_record_commit.finish("您还没有加入公会，请发送“加入公会”来加入公会哦")
     boss_count = int(state['_matched_groups'][0]
                      ) if state['_matched_groups'][0] else None
     if boss_count:
-        recent_record = clan.get_recent_record(boss=boss_count)
+        recent_record = await clan.get_recent_record(boss=boss_count)
         if recent_record:
             challenge_uid = recent_record[0].member_uid
             proxy_uid = recent_record[0].proxy_report_uid
-            if uid in (challenge_uid, proxy_uid) or clan.check_admin_permission(str(event.user_id)):
-                ret = clan.delete_recent_record(
+            if uid in (challenge_uid, proxy_uid) or await clan.check_admin_permission(str(event.user_id)):
+                ret = await clan.delete_recent_record(
                     challenge_uid, boss_count=boss_count)
                 if ret:
                     msg = "出刀撤回成功"
                     if boss_count:
-                        boss_status = clan.get_current_boss_state()
+                        boss_status = await clan.get_current_boss_state()
                         boss = boss_status[boss_count-1]
                         msg += f"\n============\n当前{boss_count}王位于{boss.target_cycle}周目，剩余血量{Tools.get_num_str_with_dot(boss.boss_hp)}\n"
                     await clanbattle_qq.undo_record_commit.finish(msg)
@@ -997,19 +1210,19 @@ async def undo_record_commit(bot: Bot, event: GroupMessageEvent, state: T_State)
         else:
             await clanbattle_qq.undo_record_commit.finish("出刀撤回失败，未找到对应的出刀记录")
     else:
-        recent_record = clan.get_recent_record(uid=uid)
+        recent_record = await clan.get_recent_record(uid=uid)
         if not recent_record:
             await clanbattle_qq.undo_record_commit.finish("未找到最近的出刀记录")
-        recent_boss_record = clan.get_recent_record(
+        recent_boss_record = await clan.get_recent_record(
             boss=recent_record[0].target_boss)
         if recent_record[0].record_time != recent_boss_record[0].record_time:
             await clanbattle_qq.undo_record_commit.finish(f"您在最近一次出刀后该boss有其他的出刀记录，无法撤回，若是管理员或代报刀可使用'撤回 {recent_record[0].target_boss}'来撤回其他人的出刀")
-        ret = clan.delete_recent_record(recent_record[0].member_uid)
+        ret = await clan.delete_recent_record(recent_record[0].member_uid)
         if ret:
             msg = "出刀撤回成功"
             boss_count: int = recent_record[0].target_boss
             if boss_count:
-                boss_status = clan.get_current_boss_state()
+                boss_status = await clan.get_current_boss_state()
                 boss = boss_status[boss_count - 1]
                 msg += f"\n============\n当前{boss_count}王位于{boss.target_cycle}周目，剩余血量{Tools.get_num_str_with_dot(boss.boss_hp)}\n"
             await clanbattle_qq.undo_record_commit.finish(msg)
@@ -1017,67 +1230,68 @@ async def undo_record_commit(bot: Bot, event: GroupMessageEvent, state: T_State)
             await clanbattle_qq.undo_record_commit.finish("出刀撤回失败，内部错误")
 
 
-@clanbattle_qq.un_on_tree.handle()
+@clanbattle_router.handle("un_on_tree")
 async def _(bot: Bot, event: GroupMessageEvent, state: T_State):
     uid = str(event.user_id)
-    clan = clanbattle.get_clan_data(str(event.group_id))
+    clan = await clanbattle.get_clan_data(str(event.group_id))
     if not clan:
         await clanbattle_qq.un_on_tree.finish("本群还未创建公会，发送“创建[国台日]服公会”来创建公会")
-    if not clan.check_joined_clan(str(event.user_id)):
+    if not await clan.check_joined_clan(str(event.user_id)):
         await clanbattle_qq.un_on_tree.finish("您还没有加入公会，请发送“加入公会”来加入公会哦")
-    result = clan.delete_battle_on_tree(uid)
+    result = await clan.delete_battle_on_tree(uid)
     if result:
         await clanbattle_qq.un_on_tree.finish("下树成功")
     else:
         await clanbattle_qq.un_on_tree.finish("还没有挂在树上就别下树了")
 
 
-@clanbattle_qq.unsubscribe.handle()
+@clanbattle_router.handle("unsubscribe")
 async def unsubscribe_boss(bot: Bot, event: GroupMessageEvent, state: T_State):
     uid = str(event.user_id)
     challenge_boss = int(state['_matched_groups'][0])
     cycle = int(state['_matched_groups'][2]
                 ) if state['_matched_groups'][2] else None
-    clan = clanbattle.get_clan_data(str(event.group_id))
+    clan = await clanbattle.get_clan_data(str(event.group_id))
     if not clan:
         await clanbattle_qq.unsubscribe.finish("本群还未创建公会，发送“创建[国台日]服公会”来创建公会")
-    if not clan.check_joined_clan(str(event.user_id)):
+    if not await clan.check_joined_clan(str(event.user_id)):
         await clanbattle_qq.unsubscribe.finish("您还没有加入公会，请发送“加入公会”来加入公会哦")
-    result = clan.delete_battle_subscribe(uid, challenge_boss, cycle)
+    result = await clan.delete_battle_subscribe(uid, challenge_boss, cycle)
     if result:
         await clanbattle_qq.unsubscribe.finish("取消预约成功desu")
     else:
         await clanbattle_qq.unsubscribe.finish("取消预约失败，请确认您已经预约该boss喵")
 
 
-@clanbattle_qq.query_recent_record.handle()
+@clanbattle_router.handle("query_recent_record")
 async def query_recent_record(bot: Bot, event: GroupMessageEvent, state: T_State):
     target_qq = state['_matched_groups'][1]
-    clan = clanbattle.get_clan_data(str(event.group_id))
+    clan = await clanbattle.get_clan_data(str(event.group_id))
     if not clan:
         await clanbattle_qq.query_recent_record.finish("本群还未创建公会，发送“创建[国台日]服公会”来创建公会")
-    if not clan.check_joined_clan(str(event.user_id)):
+    if not await clan.check_joined_clan(str(event.user_id)):
         await clanbattle_qq.query_recent_record.finish("您还没有加入公会，请发送“加入公会”来加入公会哦")
     if not target_qq:
-        records = clan.get_recent_record(num=5)
+        records = await clan.get_recent_record(num=5)
         if not records:
             await clanbattle_qq.query_recent_record.finish("现在还没有出刀记录哦，快去出刀吧")
         else:
             msg = "最近五条出刀记录：\n\n"
+            names = await clan.get_user_names([record.member_uid for record in records])
             for record in records:
                 if record.member_uid == "admin":
                     continue
-                msg += f"{clan.get_user_info(record.member_uid).uname}于{(record.record_time +datetime.timedelta(hours=8)).strftime('%m月%d日%H时%M分')}对{record.target_cycle}周目{record.target_boss}王造成了{Tools.get_num_str_with_dot(record.damage)}点伤害\n\n"
+                msg += f"{names[record.member_uid]}于{(record.record_time +datetime.timedelta(hours=8)).strftime('%m月%d日%H时%M分')}对{record.target_cycle}周目{record.target_boss}王造成了{Tools.get_num_str_with_dot(record.damage)}点伤害\n\n"
             msg += "更多记录请前往网页端查看，查询指定成员请at"
             await clanbattle_qq.query_recent_record.finish(msg)
     else:
-        if not clan.check_joined_clan(target_qq):
+        if not await clan.check_joined_clan(target_qq):
             await clanbattle_qq.query_recent_record.finish("对方还没有加入公会哦")
-        records = clan.get_today_record(uid=target_qq)
+        records = await clan.get_today_record(uid=target_qq)
         if not records:
             await clanbattle_qq.query_recent_record.finish("Ta还没有出刀记录哦，快催Ta去出刀吧")
         else:
-            msg = f"{clan.get_user_name(target_qq)}今日的出刀记录："
+            msg = f"{await clan.get_user_name(target_qq)}今日的出刀记录："
             for record in records:
                 msg += f"\n{record.target_cycle}周目{record.target_boss}王 {Tools.get_num_str_with_dot(record.damage)} "
                 if record.remain_next_chance:
@@ -1089,7 +1303,7 @@ async def query_recent_record(bot: Bot, event: GroupMessageEvent, state: T_State
             await clanbattle_qq.query_recent_record.finish(msg)
 
 
-@clanbattle_qq.sl.handle()
+@clanbattle_router.handle("sl")
 async def commit_sl(bot: Bot, event: GroupMessageEvent, state: T_State):
     proxy_report_uid: str = None
     uid = str(event.user_id)
@@ -1102,24 +1316,24 @@ async def commit_sl(bot: Bot, event: GroupMessageEvent, state: T_State):
     else:
         uid = state['_matched_groups'][5]
         proxy_report_uid = str(event.user_id)
-    clan = clanbattle.get_clan_data(str(event.group_id))
+    clan = await clanbattle.get_clan_data(str(event.group_id))
     if not clan:
         await clanbattle_qq.sl.finish("本群还未创建公会，发送“创建[国台日]服公会”来创建公会")
-    if not clan.check_joined_clan(str(event.user_id)):
+    if not await clan.check_joined_clan(str(event.user_id)):
         await clanbattle_qq.sl.finish("您还没有加入公会，请发送“加入公会”来加入公会哦")
     if is_query_sl:
-        sl = clan.get_today_battle_sl(uid=uid)
+        sl = await clan.get_today_battle_sl(uid=uid)
         if sl:
             await clanbattle_qq.sl.finish("您今天已经sl过了")
         else:
             await clanbattle_qq.sl.finish("您今天还没有使用过sl哦")
         return
     if not challenge_boss:
-        if progress := clan.get_battle_in_progress(uid=uid):
+        if progress := await clan.get_battle_in_progress(uid=uid):
             challenge_boss = progress[0].target_boss
-        elif on_treee := clan.get_battle_on_tree(uid=uid):
+        elif on_treee := await clan.get_battle_on_tree(uid=uid):
             challenge_boss = on_treee[0].target_boss
-    result = clan.commit_battle_sl(
+    result = await clan.commit_battle_sl(
         uid, challenge_boss, comment, proxy_report_uid)
     if result == CommitSLResult.success:
         await clanbattle_qq.sl.finish("sl已经记录")
@@ -1131,65 +1345,68 @@ async def commit_sl(bot: Bot, event: GroupMessageEvent, state: T_State):
         await clanbattle_qq.sl.finish("您还未加入公会，请发送“加入公会”加入")
 
 
-@clanbattle_qq.unqueue.handle()
+@clanbattle_router.handle("unqueue")
 async def unqueue_boss(bot: Bot, event: GroupMessageEvent, state: T_State):
     uid = str(event.user_id)
-    clan = clanbattle.get_clan_data(str(event.group_id))
+    clan = await clanbattle.get_clan_data(str(event.group_id))
     if not clan:
         await clanbattle_qq.unqueue.finish("本群还未创建公会，发送“创建[国台日]服公会”来创建公会")
-    if not clan.check_joined_clan(str(event.user_id)):
+    if not await clan.check_joined_clan(str(event.user_id)):
         await clanbattle_qq.unqueue.finish("您还没有加入公会，请发送“加入公会”来加入公会哦")
-    result = clan.delete_battle_in_progress(uid)
+    result = await clan.delete_battle_in_progress(uid)
     if result:
         await clanbattle_qq.unsubscribe.finish("取消申请成功desu")
     else:
         await clanbattle_qq.unsubscribe.finish("取消申请失败，请确认您已经申请出刀该boss")
 
 
-@clanbattle_qq.showqueue.handle()
+@clanbattle_router.handle("showqueue")
 async def show_queue(bot: Bot, event: GroupMessageEvent, state: T_State):
-    clan = clanbattle.get_clan_data(str(event.group_id))
+    clan = await clanbattle.get_clan_data(str(event.group_id))
     if not clan:
         await clanbattle_qq.showqueue.finish("本群还未创建公会，发送“创建[国台日]服公会”来创建公会")
-    if not clan.check_joined_clan(str(event.user_id)):
+    if not await clan.check_joined_clan(str(event.user_id)):
         await clanbattle_qq.showqueue.finish("您还没有加入公会，请发送“加入公会”来加入公会哦")
-    progresses = clan.get_battle_in_progress()
+    progresses = await clan.get_battle_in_progress()
     if not progresses:
         await clanbattle_qq.showqueue.finish("当前没有人申请出刀，赶快来出刀吧")
     else:
         msg = "当前正在出刀的成员：\n"
+        names = await clan.get_user_names([pro.member_uid for pro in progresses])
         for i in range(1, 6):
-            prog = clan.get_battle_in_progress(boss=i)
+            prog = [pro for pro in progresses if pro.target_boss == i]
             if prog:
                 msg += f"==={i}王===\n"
                 for pro in prog:
-                    msg += f"{clan.get_user_info(pro.member_uid).uname}"
+                    msg += f"{names[pro.member_uid]}"
                     if pro.comment and pro.comment != "":
                         msg += f" : {pro.comment}"
                     msg += "\n"
         await clanbattle_qq.showqueue.finish(msg.strip())
 
 
-@clanbattle_qq.showsubscribe.handle()
+@clanbattle_router.handle("showsubscribe")
 async def show_subscribe(bot: Bot, event: GroupMessageEvent, state: T_State):
-    clan = clanbattle.get_clan_data(str(event.group_id))
+    clan = await clanbattle.get_clan_data(str(event.group_id))
     if not clan:
         await clanbattle_qq.showsubscribe.finish("本群还未创建公会，发送“创建[国台日]服公会”来创建公会")
-    if not clan.check_joined_clan(str(event.user_id)):
+    if not await clan.check_joined_clan(str(event.user_id)):
         await clanbattle_qq.showsubscribe.finish("您还没有加入公会，请发送“加入公会”来加入公会哦")
-    subs = clan.get_battle_subscribe()
-    boss_status = clan.get_current_boss_state()
+    subs = await clan.get_battle_subscribe()
+    boss_status = await clan.get_current_boss_state()
     if not subs:
         await clanbattle_qq.showsubscribe.finish("当前没有人预约boss，赶快来出刀吧")
     else:
         msg = "当前预约的成员：\n"
+        all_subs = subs
+        names = await clan.get_user_names([sub.member_uid for sub in all_subs])
         for i in range(1, 6):
-            subs = clan.get_battle_subscribe(
-                boss=i, boss_cycle=boss_status[i-1].target_cycle)
+            subs = [sub for sub in all_subs if sub.target_boss ==
+                    i and sub.target_cycle == boss_status[i-1].target_cycle]
             if subs:
                 msg += f"==={i}王===\n"
                 for sub in subs:
-                    msg += f"{clan.get_user_info(sub.member_uid).uname}"
+                    msg += f"{names[sub.member_uid]}"
                     if sub.comment and sub.comment != "":
                         msg += f" : {sub.comment}"
                     msg += "\n"
@@ -1199,44 +1416,46 @@ async def show_subscribe(bot: Bot, event: GroupMessageEvent, state: T_State):
         await clanbattle_qq.showsubscribe.finish(msg.strip())
 
 
-@clanbattle_qq.sl_query.handle()
+@clanbattle_router.handle("sl_query")
 async def query_sl(bot: Bot, event: GroupMessageEvent, state: T_State):
     uid = str(event.user_id)
     if not state['_matched_groups'][1]:
         uid = str(event.user_id)
     else:
         uid = state['_matched_groups'][1]
-    clan = clanbattle.get_clan_data(str(event.group_id))
+    clan = await clanbattle.get_clan_data(str(event.group_id))
     if not clan:
         await clanbattle_qq.sl_query.finish("本群还未创建公会，发送“创建[国台日]服公会”来创建公会")
-    if not clan.check_joined_clan(str(event.user_id)):
+    if not await clan.check_joined_clan(str(event.user_id)):
         await clanbattle_qq.sl_query.finish("您还没有加入公会，请发送“加入公会”来加入公会哦")
-    sl = clan.get_today_battle_sl(uid=uid)
+    sl = await clan.get_today_battle_sl(uid=uid)
     if sl:
         await clanbattle_qq.sl_query.finish("您今天已经sl过了")
     else:
         await clanbattle_qq.sl_query.finish("您今天还没有使用过sl哦")
 
 
-@clanbattle_qq.query_on_tree.handle()
+@clanbattle_router.handle("query_on_tree")
 async def query_on_tree(bot: Bot, event: GroupMessageEvent, state: T_State):
-    clan = clanbattle.get_clan_data(str(event.group_id))
+    clan = await clanbattle.get_clan_data(str(event.group_id))
     if not clan:
         await clanbattle_qq.query_on_tree.finish("本群还未创建公会，发送“创建[国台日]服公会”来创建公会")
-    if not clan.check_joined_clan(str(event.user_id)):
+    if not await clan.check_joined_clan(str(event.user_id)):
         await clanbattle_qq.query_on_tree.finish("您还没有加入公会，请发送“加入公会”来加入公会哦")
     on_tree_dict = {}
     for i in range(1, 6):
         on_tree_dict[i] = []
     msg = ""
     first_flag = True
+    all_on_tree = await clan.get_battle_on_tree()
+    names = await clan.get_user_names([on_tree_item.member_uid for on_tree_item in all_on_tree])
     for i in range(1, 6):
-        on_tree_list = clan.get_battle_on_tree(boss=i)
+        on_tree_list = [on_tree_item for on_tree_item in all_on_tree if on_tree_item.target_boss == i]
         if on_tree_list and len(on_tree_list) > 0:
             msg += f"\n==={i}王===\n" if i == 1 else f"==={i}王===\n"
             for on_tree_item in on_tree_list:
                 commemt = f"：{on_tree_item.comment}" if on_tree_item.comment and on_tree_item.comment != "" else ""
-                msg += f"{clan.get_user_name(on_tree_item.member_uid)}{commemt}（{Tools.get_chinese_timedetla(on_tree_item.record_time)}）"
+                msg += f"{names[on_tree_item.member_uid]}{commemt}（{Tools.get_chinese_timedetla(on_tree_item.record_time)}）"
                 #msg += f"当前{clan.get_user_name(on_tree_item.member_uid)}{commemt}挂在{on_tree_item.target_boss}王上"
                 msg += "\n"
     if msg == "":
@@ -1244,280 +1463,273 @@ async def query_on_tree(bot: Bot, event: GroupMessageEvent, state: T_State):
     await clanbattle_qq.query_on_tree.finish(msg.strip())
 
 
-@clanbattle_qq.reset_password.handle()
+@clanbattle_router.handle("reset_password")
 async def reset_password(bot: Bot, event: PrivateMessageEvent, state: T_State):
     uid = str(event.user_id)
-    if user := ClanBattleData.get_user_info(uid):
-        WebAuth.set_password(uid, state['_matched_groups'][0])
+    if user := await db_executor.run(ClanBattleData.get_user_info, uid):
+        await db_executor.run(WebAuth.set_password, uid, state['_matched_groups'][0])
         await clanbattle_qq.reset_password.finish(
             f"密码已经重置为：{state['_matched_groups'][0]}，请前往网页端登录")
     else:
         await clanbattle_qq.reset_password.finish("不存在您的用户资料，请先加入一个公会")
 
 
-@clanbattle_qq.leave_clan.handle()
+@clanbattle_router.handle("leave_clan")
 async def leave_clan(bot: Bot, event: GroupMessageEvent, state: T_State):
     uid = str(event.user_id)
-    clan = clanbattle.get_clan_data(str(event.group_id))
+    clan = await clanbattle.get_clan_data(str(event.group_id))
     if not clan:
         await clanbattle_qq.leave_clan.finish("本群还未创建公会，发送“创建[国台日]服公会”来创建公会")
-    if clan.delete_clan_member(uid):
+    if await clan.delete_clan_member(uid):
         await clanbattle_qq.leave_clan.finish("退出公会成功！")
     else:
         await clanbattle_qq.leave_clan.finish("退出公会失败，可能还没有加入公会？")
 
 
-@clanbattle_qq.refresh_clan_admin.handle()
+@clanbattle_router.handle("refresh_clan_admin")
 async def refresh_clan_admin(bot: Bot, event: GroupMessageEvent, state: T_State):
     gid = str(event.group_id)
-    clan = clanbattle.get_clan_data(gid)
+    clan = await clanbattle.get_clan_data(gid)
     if not clan:
         await clanbattle_qq.refresh_clan_admin.finish("本群还未创建公会，发送“创建[国台日]服公会”来创建公会")
-    if not clan.check_joined_clan(str(event.user_id)):
+    if not await clan.check_joined_clan(str(event.user_id)):
         await clanbattle_qq.refresh_clan_admin.finish("您还没有加入公会，请发送“加入公会”来加入公会哦")
     group_member_list = await bot.get_group_member_list(group_id=event.group_id)
     admin_list = []
     for member in group_member_list:
         if member["role"] in ["owner", "admin"] and member["user_id"] != int(bot.self_id):
             admin_list.append(str(member["user_id"]))
-    clan.refresh_clan_admin(admin_list)
+    await clan.refresh_clan_admin(admin_list)
     await clanbattle_qq.refresh_clan_admin.finish("刷新管理员列表成功")
 
 
-@clanbattle_qq.rename_clan.handle()
+@clanbattle_router.handle("rename_clan")
 async def rename_clan(bot: Bot, event: GroupMessageEvent, state: T_State):
     gid = str(event.group_id)
     uid = str(event.user_id)
-    clan = clanbattle.get_clan_data(gid)
+    clan = await clanbattle.get_clan_data(gid)
     if not clan:
         await clanbattle_qq.rename_clan.finish("本群还未创建公会，发送“创建[国台日]服公会”来创建公会")
-    if not clan.check_joined_clan(str(event.user_id)):
+    if not await clan.check_joined_clan(str(event.user_id)):
         await clanbattle_qq.rename_clan.finish("您还没有加入公会，请发送“加入公会”来加入公会哦")
-    if not clan.check_admin_permission(uid):
+    if not await clan.check_admin_permission(uid):
         await clanbattle_qq.rename_clan.finish("您不是会战管理员，无权使用本指令")
     else:
-        clan.rename_clan(state['_matched_groups'][0])
+        await clan.rename_clan(state['_matched_groups'][0])
         await clanbattle_qq.rename_clan.finish("修改公会名称成功")
 
 
-@clanbattle_qq.remove_clan_member.handle()
+@clanbattle_router.handle("remove_clan_member")
 async def remove_clan_member(bot: Bot, event: GroupMessageEvent, state: T_State):
     gid = str(event.group_id)
     uid = str(event.user_id)
-    clan = clanbattle.get_clan_data(gid)
+    clan = await clanbattle.get_clan_data(gid)
     if not clan:
         await clanbattle_qq.remove_clan_member.finish("本群还未创建公会，发送“创建[国台日]服公会”来创建公会")
-    if not clan.check_joined_clan(str(event.user_id)):
+    if not await clan.check_joined_clan(str(event.user_id)):
         await clanbattle_qq.remove_clan_member.finish("您还没有加入公会，请发送“加入公会”来加入公会哦")
-    if not clan.check_admin_permission(uid):
+    if not await clan.check_admin_permission(uid):
         await clanbattle_qq.remove_clan_member.finish("您不是会战管理员，无权使用本指令")
     remove_uid = state['_matched_groups'][0]
-    if clan.delete_clan_member(remove_uid):
+    if await clan.delete_clan_member(remove_uid):
         await clanbattle_qq.remove_clan_member.finish("成功将该成员移出公会")
     else:
         await clanbattle_qq.remove_clan_member.finish("移出公会失败，Ta可能还未加入公会？")
 
 
-@clanbattle_qq.rename_clan_uname.handle()
+@clanbattle_router.handle("rename_clan_uname")
 async def rename_clan_uname(bot: Bot, event: GroupMessageEvent, state: T_State):
     gid = str(event.group_id)
-    clan = clanbattle.get_clan_data(gid)
+    clan = await clanbattle.get_clan_data(gid)
     if not clan:
         await clanbattle_qq.rename_clan_uname.finish("本群还未创建公会，发送“创建[国台日]服公会”来创建公会")
-    if not clan.check_joined_clan(str(event.user_id)):
+    if not await clan.check_joined_clan(str(event.user_id)):
         await clanbattle_qq.rename_clan_uname.finish("您还没有加入公会，请发送“加入公会”来加入公会哦")
     if not state['_matched_groups'][2]:
         uid = str(event.user_id)
     else:
-        if not clan.check_admin_permission(str(event.user_id)):
+        if not await clan.check_admin_permission(str(event.user_id)):
             await clanbattle_qq.rename_clan_uname.finish("您不是会战管理员，无权修改他人昵称")
         uid = state['_matched_groups'][2]
     uname = state['_matched_groups'][0]
-    if clan.rename_user_uname(uid, uname):
+    if await clan.rename_user_uname(uid, uname):
         await clanbattle_qq.remove_clan_member.finish("修改昵称成功")
     else:
         await clanbattle_qq.remove_clan_member.finish("修改昵称失败，可能用户还没加入任何公会？")
 
 
-@clanbattle_qq.force_change_boss_status.handle()
+@clanbattle_router.handle("force_change_boss_status")
 async def force_change_boss_status(bot: Bot, event: GroupMessageEvent, state: T_State):
     gid = str(event.group_id)
     uid = str(event.user_id)
-    clan = clanbattle.get_clan_data(gid)
+    clan = await clanbattle.get_clan_data(gid)
     challenge_boss = int(state['_matched_groups'][0])
     cycle = int(state['_matched_groups'][1])
     remain_hp = state['_matched_groups'][2]
     if not clan:
         await clanbattle_qq.rename_clan.finish("本群还未创建公会，发送“创建[国台日]服公会”来创建公会")
-    if not clan.check_joined_clan(str(event.user_id)):
+    if not await clan.check_joined_clan(str(event.user_id)):
         await clanbattle_qq.rename_clan.finish("您还没有加入公会，请发送“加入公会”来加入公会哦")
-    if not clan.check_admin_permission(uid):
+    if not await clan.check_admin_permission(uid):
         await clanbattle_qq.rename_clan.finish("您不是会战管理员，无权使用本指令")
     else:
-        clan.commit_force_change_boss_status(challenge_boss, cycle, remain_hp)
+        await clan.commit_force_change_boss_status(challenge_boss, cycle, remain_hp)
         await clanbattle_qq.rename_clan.finish("强制修改boss状态成功")
 
 
-@clanbattle_qq.help.handle()
+@clanbattle_router.handle("help")
 async def send_bot_help(bot: Bot, event: MessageEvent, state: T_State):
     if isinstance(event, GroupMessageEvent) or isinstance(event, PrivateMessageEvent):
         await clanbattle_qq.help.finish(f"Yuki Clanbattle Ver{VERSION}\n会战帮助请见{get_config().web_url}help")
 
 
-@clanbattle_qq.webview.handle()
+@clanbattle_router.handle("webview")
 async def send_webview(bot: Bot, event: MessageEvent, state: T_State):
     if isinstance(event, GroupMessageEvent) or isinstance(event, PrivateMessageEvent):
         await clanbattle_qq.webview.finish(f"请登录{get_config().web_url}clan 查看详情，首次登录前请先加入公会并私聊bot“设置密码+要设置的密码”来设置密码（由于风控暂时无回复）")
 
 
-@clanbattle_qq.join_all_member.handle()
+@clanbattle_router.handle("join_all_member")
 async def join_all_member(bot: Bot, event: GroupMessageEvent, state: T_State):
     gid = str(event.group_id)
-    clan = clanbattle.get_clan_data(gid)
+    clan = await clanbattle.get_clan_data(gid)
     if not clan:
         await clanbattle_qq.join_all_member.finish("本群还未创建公会，发送“创建[国台日]服公会”来创建公会")
-    if not clan.check_joined_clan(str(event.user_id)):
+    if not await clan.check_joined_clan(str(event.user_id)):
         await clanbattle_qq.join_all_member.finish("您还没有加入公会，请发送“加入公会”来加入公会哦")
-    if not clan.check_admin_permission(str(event.user_id)):
+    if not await clan.check_admin_permission(str(event.user_id)):
         await clanbattle_qq.join_all_member.finish("您不是会战管理员，无权加入全部成员")
     group_member_list = await bot.get_group_member_list(group_id=event.group_id)
-    for member in group_member_list:
-        if member["user_id"] != int(bot.self_id):
-            if not clan.check_joined_clan(str(member["user_id"])):
-                clan.add_clan_member(str(
-                    member["user_id"]), member["card"] if member["card"] != "" else member["nickname"])
+    await clan.add_clan_members([(str(member["user_id"]), member["card"] if member["card"] != "" else member["nickname"])
+                                 for member in group_member_list if member["user_id"] != int(bot.self_id)])
     await clanbattle_qq.join_all_member.finish("加入全部成员成功")
 
 
-@clanbattle_qq.switch_current_clanbattle_data.handle()
+@clanbattle_router.handle("switch_current_clanbattle_data")
 async def switch_current_clanbattle_data(bot: Bot, event: GroupMessageEvent, state: T_State):
     gid = str(event.group_id)
     uid = str(event.user_id)
     set_num = int(state['_matched_groups'][0])
-    clan = clanbattle.get_clan_data(gid)
+    clan = await clanbattle.get_clan_data(gid)
     if not clan:
         await clanbattle_qq.switch_current_clanbattle_data.finish("本群还未创建公会，发送“创建[国台日]服公会”来创建公会")
-    if not clan.check_joined_clan(str(event.user_id)):
+    if not await clan.check_joined_clan(str(event.user_id)):
         await clanbattle_qq.switch_current_clanbattle_data.finish("您还没有加入公会，请发送“加入公会”来加入公会哦")
-    if not clan.check_admin_permission(uid):
+    if not await clan.check_admin_permission(uid):
         await clanbattle_qq.switch_current_clanbattle_data.finish("您不是会战管理员，无权使用本指令")
     if set_num < 1 or set_num > 10:
         await clanbattle_qq.switch_current_clanbattle_data.finish("会战档案超出允许的范围，请考虑清空旧的会战档案")
-    clan.set_current_clanbattle_data(set_num)
+    await clan.set_current_clanbattle_data(set_num)
     await clanbattle_qq.switch_current_clanbattle_data.finish(f"切换会战档案成功，当前使用会战档案{set_num}")
 
 
-@clanbattle_qq.clear_current_clanbattle_data.handle()
+@clanbattle_router.handle("clear_current_clanbattle_data")
 async def clear_current_clanbattle_data(bot: Bot, event: GroupMessageEvent, state: T_State):
     gid = str(event.group_id)
     uid = str(event.user_id)
-    clan = clanbattle.get_clan_data(gid)
+    clan = await clanbattle.get_clan_data(gid)
     if not clan:
         await clanbattle_qq.clear_current_clanbattle_data.finish("本群还未创建公会，发送“创建[国台日]服公会”来创建公会")
-    if not clan.check_joined_clan(str(event.user_id)):
+    if not await clan.check_joined_clan(str(event.user_id)):
         await clanbattle_qq.clear_current_clanbattle_data.finish("您还没有加入公会，请发送“加入公会”来加入公会哦")
-    if not clan.check_admin_permission(uid):
+    if not await clan.check_admin_permission(uid):
         await clanbattle_qq.clear_current_clanbattle_data.finish("您不是会战管理员，无权使用本指令")
-    clan.clear_current_clanbattle_data()
-    await clanbattle_qq.clear_current_clanbattle_data.finish(f"清空会战档案成功！")
+    deleted = await clan.clear_current_clanbattle_data()
+    await clanbattle_qq.clear_current_clanbattle_data.finish(f"清空会战档案成功！共删除{deleted['record']}条出刀记录，{deleted['sl']}条SL记录，"
+                                                             f"{deleted['subscribe']}条预约，{deleted['on_tree']}条挂树和{deleted['in_progress']}条出刀中记录")
 
 
-@clanbattle_qq.add_clanbattle_admin.handle()
+@clanbattle_router.handle("add_clanbattle_admin")
 async def add_clanbattle_admin(bot: Bot, event: GroupMessageEvent, state: T_State):
     gid = str(event.group_id)
     uid = str(event.user_id)
     new_admin_uid = state['_matched_groups'][1]
-    clan = clanbattle.get_clan_data(gid)
+    clan = await clanbattle.get_clan_data(gid)
     if not clan:
         await clanbattle_qq.add_clanbattle_admin.finish("本群还未创建公会，发送“创建[国台日]服公会”来创建公会")
-    if not clan.check_joined_clan(str(event.user_id)):
+    if not await clan.check_joined_clan(str(event.user_id)):
         await clanbattle_qq.add_clanbattle_admin.finish("您还没有加入公会，请发送“加入公会”来加入公会哦")
-    if not clan.check_admin_permission(uid):
+    if not await clan.check_admin_permission(uid):
         await clanbattle_qq.add_clanbattle_admin.finish("您不是会战管理员，无权使用本指令")
-    admin_list = clan.get_db_strlist_list(clan.clan_info.clan_admin)
-    admin_list.append(new_admin_uid)
-    clan.refresh_clan_admin(admin_list)
+    await clan.add_clan_admin(new_admin_uid)
 
 
-@clanbattle_qq.delete_clan.handle()
+@clanbattle_router.handle("delete_clan")
 async def delete_clan(bot: Bot, event: GroupMessageEvent, state: T_State):
     gid = str(event.group_id)
     uid = str(event.user_id)
-    clan = clanbattle.get_clan_data(gid)
+    clan = await clanbattle.get_clan_data(gid)
     if not clan:
         await clanbattle_qq.delete_clan.finish("本群还未创建公会，发送“创建[国台日]服公会”来创建公会")
-    if not clan.check_joined_clan(str(event.user_id)):
+    if not await clan.check_joined_clan(str(event.user_id)):
         await clanbattle_qq.delete_clan.finish("您还没有加入公会，请发送“加入公会”来加入公会哦")
-    if not clan.check_admin_permission(uid):
+    if not await clan.check_admin_permission(uid):
         await clanbattle_qq.delete_clan.finish("您不是会战管理员，无权使用本指令")
-    clanbattle.delete_clan(gid)
-    await clanbattle_qq.delete_clan.finish("清除公会数据成功")
+    deleted = await clanbattle.delete_clan(gid)
+    await clanbattle_qq.delete_clan.finish(f"清除公会数据成功，共删除{deleted['member']}名成员和{deleted['record']}条出刀记录")
 
 
-@clanbattle_qq.query_certain_num.handle()
+@clanbattle_router.handle("query_certain_num")
 async def query_certain_num(bot: Bot, event: GroupMessageEvent, state: T_State):
     gid = str(event.group_id)
     uid = str(event.user_id)
-    clan = clanbattle.get_clan_data(gid)
+    clan = await clanbattle.get_clan_data(gid)
     if not clan:
         await clanbattle_qq.query_certain_num.finish("本群还未创建公会，发送“创建[国台日]服公会”来创建公会")
-    if not clan.check_joined_clan(str(event.user_id)):
+    if not await clan.check_joined_clan(str(event.user_id)):
         await clanbattle_qq.query_certain_num.finish("您还没有加入公会，请发送“加入公会”来加入公会哦")
     query_num = int(state['_matched_groups'][1]
                     ) if state['_matched_groups'][1] else None
     query_remain = True if state['_matched_groups'][2] else False
     if query_num != None:
         msg = f"今日已出{query_num}刀的有：\n"
-        status = clan.get_today_member_status()
+        status = await clan.get_today_member_status()
+        names = await clan.get_user_names([member_state.uid for member_state in status])
         for member_state in status:
             if member_state.today_challenged == query_num:
-                msg += f"{clan.get_user_name(member_state.uid)}、"
+                msg += f"{names[member_state.uid]}、"
         if msg == f"今日已出{query_num}刀的有：\n":
             msg = f"今天还没有人已经出了{query_num}刀"
         await clanbattle_qq.query_certain_num.finish(msg.strip('、'))
     if query_remain:
         msg = f"还没有出补偿刀的有：\n"
-        status = clan.get_today_member_status()
+        status = await clan.get_today_member_status()
+        names = await clan.get_user_names([member_state.uid for member_state in status])
         for member_state in status:
             if member_state.remain_addition_challeng > 0:
-                msg += f"{clan.get_user_name(member_state.uid)}、"
+                msg += f"{names[member_state.uid]}、"
         if msg == f"还没有出补偿刀的有：\n":
             msg = f"现在没有剩余的补偿刀！"
         await clanbattle_qq.query_certain_num.finish(msg.strip('、'))
 
 
-@clanbattle_qq.notice_not_report.handle()
+@clanbattle_router.handle("notice_not_report")
 async def notice_not_report(bot: Bot, event: GroupMessageEvent, state: T_State):
     gid = str(event.group_id)
     uid = str(event.user_id)
-    clan = clanbattle.get_clan_data(gid)
+    clan = await clanbattle.get_clan_data(gid)
     if not clan:
         await clanbattle_qq.notice_not_report.finish("本群还未创建公会，发送“创建[国台日]服公会”来创建公会")
-    if not clan.check_joined_clan(str(event.user_id)):
+    if not await clan.check_joined_clan(str(event.user_id)):
         await clanbattle_qq.notice_not_report.finish("您还没有加入公会，请发送“加入公会”来加入公会哦")
-    if not clan.check_admin_permission(uid):
+    if not await clan.check_admin_permission(uid):
         await clanbattle_qq.notice_not_report.finish("您不是会战管理员，无权使用本指令")
     notice_num = int(state['_matched_groups'][0]
                      ) if state['_matched_groups'][0] else 0
-    status = clan.get_today_member_status()
+    status = await clan.get_today_member_status()
     notice_list = []
     for member_state in status:
         if member_state.today_challenged <= notice_num:
             notice_list.append(member_state.uid)
-    notice_message = Message("管理员催你快去出刀啦")
-    for member in notice_list:
-        notice_message += MessageSegment.at(member)
-        if len(notice_message) == 20:
-            await bot.send_group_msg(group_id=gid, message=notice_message)
-            notice_message = Message("管理员催你快去出刀啦")
-    if len(notice_message) > 1:
-        await bot.send_group_msg(group_id=gid, message=notice_message)
-
-@clanbattle_qq.clan_rank.handle()
+    if notice_list:
+        message_sender.send(gid, Message("管理员催你快去出刀啦") +
+                            Message(map(MessageSegment.at, notice_list)))
+
+@clanbattle_router.handle("clan_rank")
 async def clan_rank(bot: Bot, event: GroupMessageEvent, state: T_State):
     gid = str(event.group_id)
     uid = str(event.user_id)
-    clan = clanbattle.get_clan_data(gid)
+    clan = await clanbattle.get_clan_data(gid)
     if not clan:
         await clanbattle_qq.notice_not_report.finish("本群还未创建公会，发送“创建[国台日]服公会”来创建公会")
     clan_name = clan.clan_info.clan_name
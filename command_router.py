@@ -0,0 +1,108 @@
+import inspect
+import re
+
+from nonebot.adapters.onebot.v11 import Bot, Event
+from nonebot.exception import FinishedException
+from nonebot.matcher import Matcher
+from nonebot.plugin import on_message
+from nonebot.typing import T_State
+from typing import Any, Callable, Dict, List, Optional, Tuple, Type
+
+
+class KeywordTrie:
+    # 指令关键词前缀树，不区分大小写，返回消息开头匹配到的所有关键词对应的值
+
+    def __init__(self) -> None:
+        self.root: Dict[Any, Any] = {}
+
+    def add(self, keyword: str, value: Any):
+        node = self.root
+        for char in keyword.lower():
+            node = node.setdefault(char, {})
+        node.setdefault(None, []).append(value)
+
+    def search(self, text: str) -> List[Any]:
+        node = self.root
+        result = []
+        for char in text.lower():
+            if not char in node:
+                break
+            node = node[char]
+            result.extend(node.get(None, []))
+        return result
+
+
+class Command:
+
+    def __init__(self, name: str, index: int, pattern: str, block: bool) -> None:
+        self.name = name
+        self.index = index
+        self.regex = re.compile(pattern)
+        self.block = block
+        self.handler: Callable = None
+        self.event_type: Type[Event] = Event
+
+
+class CommandRouter:
+    # 所有指令共用一个消息响应器，代替每个指令单独注册的 on_regex
+    # 先用指令关键词的前缀树过滤普通聊天消息，只有开头（或结尾）是指令关键词的消息才会匹配对应指令的正则
+    # 与原来同一优先级的各个响应器一样，所有匹配的指令都按注册顺序执行
+
+    def __init__(self, priority: int = 1) -> None:
+        self.commands: Dict[str, Command] = {}
+        self.trie = KeywordTrie()
+        # 指令结尾关键词，倒序保存
+        self.suffix_trie = KeywordTrie()
+        self.matcher: Type[Matcher] = on_message(
+            priority=priority, block=False, handlers=[self.dispatch])
+
+    # 注册指令，keywords 为匹配该指令的消息可能的开头，suffix_keywords 为正则中以 $ 结尾、不限制开头的部分可能的结尾
+    # 返回共用的响应器用于发送回复
+    def on_regex(self, name: str, pattern: str, keywords: List[str], suffix_keywords: Optional[List[str]] = None,
+                 block: bool = True) -> Type[Matcher]:
+        command = Command(name, len(self.commands), pattern, block)
+        self.commands[name] = command
+        for keyword in keywords:
+            self.trie.add(keyword, command)
+        for keyword in suffix_keywords or []:
+            self.suffix_trie.add(keyword[::-1], command)
+        return self.matcher
+
+    def handle(self, name: str) -> Callable:
+        def decorator(func: Callable) -> Callable:
+            command = self.commands[name]
+            command.handler = func
+            event_param = inspect.signature(func).parameters.get("event")
+            if event_param and inspect.isclass(event_param.annotation):
+                command.event_type = event_param.annotation
+            return func
+        return decorator
+
+    def match(self, text: str) -> List[Tuple[Command, re.Match]]:
+        # $ 也可以匹配结尾的换行符之前
+        suffix_text = text[:-1] if text.endswith("\n") else text
+        candidates = sorted(dict.fromkeys(self.trie.search(text) + self.suffix_trie.search(suffix_text[::-1])),
+                            key=lambda command: command.index)
+        return [(command, matched) for command in candidates
+                if (matched := command.regex.search(text))]
+
+    async def dispatch(self, bot: Bot, event: Event, state: T_State, matcher: Matcher):
+        try:
+            text = str(event.get_message())
+        except Exception:
+            return
+        matched_list = self.match(text)
+        if any(command.block for command, _ in matched_list):
+            matcher.stop_propagation()
+        for command, regex_matched in matched_list:
+            if not command.handler or not isinstance(event, command.event_type):
+                continue
+            # 与 on_regex 保存的匹配结果一致
+            state["_matched"] = regex_matched
+            state["_matched_groups"] = regex_matched.groups()
+            state["_matched_dict"] = regex_matched.groupdict()
+            # 各个指令共用同一个响应器，一个指令 finish 后继续执行其他匹配的指令
+            try:
+                await command.handler(bot, event, state)
+            except FinishedException:
+                pass
@@ -1,6 +1,7 @@
 import os
 import json
 import pydantic
+from typing import Optional
 
 
 class ConfigClass(pydantic.BaseModel):
@@ -10,6 +11,8 @@ class ConfigClass(pydantic.BaseModel):
     db_salt: str
     boss_info: dict
     http_proxy: Optional[str] = None
+    # 检查内存中的当天出刀状态与数据库是否一致，用于排查问题
+    today_status_check: bool = False
 
 
 clanbattle_config: "ConfigClass" = None
@@ -1,9 +1,14 @@
 #import redis
+import asyncio
+import datetime
 import sys
+import tempfile
 
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from os import path
 from peewee import *
-import sqlite3
+from typing import Any, Callable, Dict
 
 
 redis_db = 2
@@ -14,32 +19,12 @@ if not "pytest" in sys.modules:
     db_path = path.join(path.dirname(__file__),
                         "clanbattle.db").replace(":\\", ":\\\\")
 else:
-    db_path = path.join(path.dirname(__file__),
+    # 测试时在临时目录中使用新的数据库
+    db_path = path.join(tempfile.mkdtemp(),
                         "clanbattle_test.db").replace(":\\", ":\\\\")
 
-#Check and update table
-if(path.exists(db_path)):
-    db_conn = sqlite3.connect(db_path)
-    c = db_conn.cursor()
-    cur = c.execute("PRAGMA table_info('clan_info')")
-    v_0_2_3_detected = False
-    for row in cur:
-        if(row[1] == "clan_query_info"):
-            v_0_2_3_detected = True
-    cur.close()
-    if(not v_0_2_3_detected):
-        print("YukiClanbattle: Old database detected, update table struct...")
-        c = db_conn.cursor()
-        c.execute("ALTER TABLE clan_info ADD COLUMN clan_query_info text")
-        c.close()
-        print("YukiClanbattle: Update table struct success")
-    db_conn.commit()
-    db_conn.close()
-
-
-
-
-sqlite_db = SqliteDatabase(db_path)
+# WAL 模式下读操作不会被其他线程的写操作阻塞
+sqlite_db = SqliteDatabase(db_path, pragmas={"journal_mode": "wal"})
 
 
 class BaseModel(Model):
@@ -52,8 +37,8 @@ class User(BaseModel):
     tg_uid = CharField(unique=True, null=True)
     uname = CharField(null=True)
     password = CharField(null=True)
-    clan_joined = TextField(null=True)  # list,split by |
-    web_session = CharField(null=True)
+    clan_joined = TextField(null=True)  # 旧版本数据，已迁移至 clan_membership
+    web_session = CharField(null=True)  # 旧版本数据，已迁移至 web_session
     is_super_admin = BooleanField(default=False)
 
     class Meta:
@@ -65,20 +50,53 @@ class ClanInfo(BaseModel):
     clan_name = CharField()
     clan_type = CharField()  # cn为国，tw为台，jp为日
     clan_api_key = CharField(unique=True, null=True)
-    clan_admin = TextField()  # list,split by |
-    clan_members = TextField(null=True)  # list,split by |
+    clan_admin = TextField()  # 旧版本数据，已迁移至 clan_admin
+    clan_members = TextField(null=True)  # 旧版本数据，已迁移至 clan_membership
     create_time = DateTimeField()
     current_using_data_num = IntegerField(default=1)
     #current_cycle = IntegerField()
     #current_boss = IntegerField()
     #current_boss_hp = IntegerField()
     clan_web_msg_push = BooleanField(default=True)
-    clan_query_info = TextField()
+    clan_query_info = TextField(null=True)
 
     class Meta:
         table_name = "clan_info"
 
 
+class ClanMembership(BaseModel):
+    clan_gid = CharField()
+    uid = CharField(index=True)
+
+    class Meta:
+        table_name = "clan_membership"
+        indexes = (
+            (("clan_gid", "uid"), True),
+        )
+
+
+class ClanAdmin(BaseModel):
+    clan_gid = CharField()
+    uid = CharField()
+
+    class Meta:
+        table_name = "clan_admin"
+        indexes = (
+            (("clan_gid", "uid"), True),
+        )
+
+
+class WebSession(BaseModel):
+    token = CharField(unique=True)
+    uid = CharField(index=True)
+    created = DateTimeField()
+    last_seen = DateTimeField()
+    expires = DateTimeField(index=True)
+
+    class Meta:
+        table_name = "web_session"
+
+
 class BattleRecord(BaseModel):
     clan_gid = CharField()
     member_uid = CharField()
@@ -150,6 +168,153 @@ class BattleSL(BaseModel):
         table_name = "battle_sl"
 
 
+class BossState(BaseModel):
+    clan_gid = CharField()
+    using_data_num = IntegerField()
+    boss = IntegerField()
+    cycle = IntegerField()
+    stage = IntegerField()
+    hp = IntegerField()
+    version = IntegerField(default=1)
+
+    class Meta:
+        table_name = "boss_state"
+        primary_key = CompositeKey("clan_gid", "using_data_num", "boss")
+
+
+class MessageOutbox(BaseModel):
+    group_id = CharField()
+    message = TextField()  # 消息段列表的json
+    created = DateTimeField()
+    status = CharField(default="pending")  # pending为待发送，sent为已发送，failed为多次重试后仍发送失败，expired为过期未发送
+    attempts = IntegerField(default=0)
+    sent_parts = IntegerField(default=0)  # at人数过多拆成多条发送时，已经发送的条数
+    next_attempt = DateTimeField()
+    sent_time = DateTimeField(null=True)
+    last_error = TextField(null=True)
+
+    class Meta:
+        table_name = "message_outbox"
+        indexes = (
+            (("group_id", "status"), False),
+            (("status", "created"), False),
+        )
+
+
+# 数据库结构迁移，按序号依次执行，当前版本记录在 PRAGMA user_version 中
+# 已发布的迁移不要修改，结构变化请在列表末尾追加新的迁移
+
+def migration_add_clan_query_info(database: SqliteDatabase):
+    columns = [column.name for column in database.get_columns("clan_info")]
+    if not "clan_query_info" in columns:
+        database.execute_sql(
+            "ALTER TABLE clan_info ADD COLUMN clan_query_info text")
+
+
+def migration_add_battle_indexes(database: SqliteDatabase):
+    for sql in (
+        'CREATE INDEX IF NOT EXISTS "battle_record_clan_data_time" ON "battle_record" ("clan_gid", "using_data_num", "record_time")',
+        'CREATE INDEX IF NOT EXISTS "battle_record_clan_data_boss_time" ON "battle_record" ("clan_gid", "using_data_num", "target_boss", "record_time")',
+        'CREATE INDEX IF NOT EXISTS "battle_record_clan_data_member_time" ON "battle_record" ("clan_gid", "using_data_num", "member_uid", "record_time")',
+        'CREATE INDEX IF NOT EXISTS "battle_subscribe_clan_data_boss_cycle" ON "battle_subscribe" ("clan_gid", "using_data_num", "target_boss", "target_cycle")',
+        'CREATE INDEX IF NOT EXISTS "battle_subscribe_clan_data_member" ON "battle_subscribe" ("clan_gid", "using_data_num", "member_uid")',
+        'CREATE INDEX IF NOT EXISTS "battle_on_tree_clan_data_boss" ON "battle_on_tree" ("clan_gid", "using_data_num", "target_boss")',
+        'CREATE INDEX IF NOT EXISTS "battle_on_tree_clan_data_member" ON "battle_on_tree" ("clan_gid", "using_data_num", "member_uid")',
+        'CREATE INDEX IF NOT EXISTS "battle_in_progress_clan_data_boss" ON "battle_in_progress" ("clan_gid", "using_data_num", "target_boss")',
+        'CREATE INDEX IF NOT EXISTS "battle_in_progress_clan_data_member" ON "battle_in_progress" ("clan_gid", "using_data_num", "member_uid")',
+        'CREATE INDEX IF NOT EXISTS "battle_sl_clan_data_time" ON "battle_sl" ("clan_gid", "using_data_num", "record_time")',
+        'CREATE INDEX IF NOT EXISTS "battle_sl_clan_data_member_time" ON "battle_sl" ("clan_gid", "using_data_num", "member_uid", "record_time")',
+    ):
+        database.execute_sql(sql)
+    database.execute_sql("ANALYZE")
+
+
+def migration_backfill_clan_membership(database: SqliteDatabase):
+    # 将旧版本用 | 分隔保存的成员和管理员列表写入成员表
+    def split_list(text: str):
+        return [item for item in str(text).split("|") if item] if text else []
+
+    clan_gid_set = set()
+    members = set()
+    admins = set()
+    for clan in ClanInfo.select(ClanInfo.clan_gid, ClanInfo.clan_members, ClanInfo.clan_admin):
+        clan_gid_set.add(clan.clan_gid)
+        for uid in split_list(clan.clan_members):
+            members.add((clan.clan_gid, uid))
+        for uid in split_list(clan.clan_admin):
+            admins.add((clan.clan_gid, uid))
+    for user in User.select(User.qq_uid, User.clan_joined):
+        for gid in split_list(user.clan_joined):
+            if gid in clan_gid_set:
+                members.add((gid, user.qq_uid))
+    for batch in chunked(sorted(members), 500):
+        ClanMembership.insert_many(batch, fields=[
+            ClanMembership.clan_gid, ClanMembership.uid]).on_conflict_ignore().execute()
+    for batch in chunked(sorted(admins), 500):
+        ClanAdmin.insert_many(batch, fields=[
+            ClanAdmin.clan_gid, ClanAdmin.uid]).on_conflict_ignore().execute()
+
+
+def migration_backfill_web_session(database: SqliteDatabase):
+    # 旧版本每个用户只保存一个会话，迁移后有效期从迁移时开始计算
+    now_time = datetime.datetime.utcnow()
+    sessions = [(user.web_session, user.qq_uid, now_time, now_time, now_time + datetime.timedelta(days=30))
+                for user in User.select(User.qq_uid, User.web_session).where(User.web_session.is_null(False))]
+    for batch in chunked(sessions, 500):
+        WebSession.insert_many(batch, fields=[WebSession.token, WebSession.uid, WebSession.created,
+                                              WebSession.last_seen, WebSession.expires]).on_conflict_ignore().execute()
+
+
+migrations = [
+    migration_add_clan_query_info,
+    migration_add_battle_indexes,
+    migration_backfill_clan_membership,
+    migration_backfill_web_session,
+]
+
+
+def get_schema_version(database: SqliteDatabase) -> int:
+    return database.execute_sql("PRAGMA user_version").fetchone()[0]
+
+
+def run_migrations(database: SqliteDatabase):
+    current_version = get_schema_version(database)
+    for version, migration in enumerate(migrations, 1):
+        if version <= current_version:
+            continue
+        print(
+            f"YukiClanbattle: Update database struct to version {version} ({migration.__name__})...")
+        with database.atomic():
+            migration(database)
+            database.execute_sql(f"PRAGMA user_version = {version}")
+    if current_version < len(migrations):
+        print("YukiClanbattle: Update database struct success")
+
+
 sqlite_db.connect()
-sqlite_db.create_tables([User, ClanInfo, BattleRecord,
-                         BattleSubscribe, BattleOnTree, BattleInProgress, BattleSL])
+sqlite_db.create_tables([User, ClanInfo, ClanMembership, ClanAdmin, WebSession, BattleRecord,
+                         BattleSubscribe, BattleOnTree, BattleInProgress, BattleSL, BossState, MessageOutbox])
+run_migrations(sqlite_db)
+
+
+class DatabaseExecutor:
+    # 在固定数量的数据库线程中执行同步的 peewee 查询，避免阻塞事件循环
+    # 同一个 key（公会）的写操作按提交顺序依次执行，不同公会之间互不影响
+
+    def __init__(self, max_workers: int = 4) -> None:
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="yuki_clanbattle_db")
+        self.write_locks: Dict[str, asyncio.Lock] = {}
+
+    async def run(self, func: Callable, *args, **kwargs) -> Any:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, partial(func, *args, **kwargs))
+
+    async def run_write(self, key: str, func: Callable, *args, **kwargs) -> Any:
+        if not key in self.write_locks:
+            self.write_locks[key] = asyncio.Lock()
+        async with self.write_locks[key]:
+            return await self.run(func, *args, **kwargs)
+
+
+db_executor = DatabaseExecutor()
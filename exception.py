@@ -28,3 +28,11 @@ class WebsocketResloveException(Exception):
 
     def __str__(self):
         return "Websocket数据解析错误"
+
+
+class BotUnavailableException(Exception):
+    def __init__(self):
+        pass
+
+    def __str__(self):
+        return "没有可用的Bot"
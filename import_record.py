@@ -0,0 +1,56 @@
+import argparse
+import importlib
+import os
+import sys
+import time
+
+import nonebot
+
+
+# 命令行批量导入出刀记录，在 Bot 目录下执行：
+# python 插件目录/import_record.py 公会群号 records.csv [--format csv|json|ndjson]
+# 导入到公会的当前会战档案，文件格式与网页导出的文件一致，每条记录需要 member_uid 和 record_time，成员需要已加入公会
+# 运行中的 Bot 不会感知其他进程写入的数据，导入前需要先停止 Bot，否则缓存的boss状态和出刀状态会与数据库不一致
+# Bot 运行时请使用网页的导入功能
+def main():
+    parser = argparse.ArgumentParser(description="import battle records")
+    parser.add_argument("clan_gid")
+    parser.add_argument("file")
+    parser.add_argument("--format", choices=["csv", "json", "ndjson"])
+    args = parser.parse_args()
+    file_format = args.format or os.path.splitext(args.file)[1][1:].lower()
+
+    # 以插件包的形式加载，数据库和配置文件与运行中的 Bot 相同
+    plugin_dir = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, os.path.dirname(plugin_dir))
+    nonebot.init()
+    plugin_name = os.path.basename(plugin_dir)
+    plugin = importlib.import_module(plugin_name)
+    utils = importlib.import_module(f"{plugin_name}.utils")
+    plugin.load_config()
+    utils.Tools.update_boss_info()
+
+    if not utils.ClanInfo.select().where(utils.ClanInfo.clan_gid == args.clan_gid).exists():
+        print(f"YukiClanbattle: Clan {args.clan_gid} not found")
+        sys.exit(1)
+    clan = utils.ClanBattleData(args.clan_gid)
+    try:
+        with open(args.file, "r", encoding="utf8") as fp:
+            rows = utils.ClanBattleData.parse_import_content(
+                fp.read(), file_format)
+    except (utils.ClanBattleException, ValueError, OSError) as e:
+        print(f"YukiClanbattle: Import failed: {e}")
+        sys.exit(1)
+    start_time = time.perf_counter()
+    count, errors = clan.import_records(rows)
+    if errors:
+        print("YukiClanbattle: Import failed")
+        for error in errors:
+            print(error)
+        sys.exit(1)
+    print(
+        f"YukiClanbattle: Imported {count} records in {time.perf_counter() - start_time:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,302 @@
+import asyncio
+import datetime
+import json
+import time
+
+import nonebot
+from nonebot.adapters.onebot.v11 import Bot, Message, MessageSegment
+from peewee import fn
+from typing import Dict, List, Set, Tuple, Union
+
+from .db import MessageOutbox, db_executor
+from .exception import BotUnavailableException
+
+
+class TokenBucket:
+
+    def __init__(self, rate: float, capacity: int) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_time = time.monotonic()
+
+    # 取出一个令牌，返回需要等待的秒数，令牌不足时预支后续的令牌
+    def take(self) -> float:
+        now_time = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens +
+                          (now_time - self.last_time) * self.rate)
+        self.last_time = now_time
+        self.tokens -= 1
+        return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class GroupBotIndex:
+    # 记录每个群中有哪些Bot，多个Bot连接时通过群里的Bot发送消息
+    # 同一个群有多个Bot时轮流发送，分摊每个账号的发送频率
+
+    def __init__(self) -> None:
+        self.bot_groups: Dict[str, Set[str]] = {}
+        self.group_bots: Dict[str, List[str]] = {}
+        self.next_index: Dict[str, int] = {}
+
+    async def refresh_bot(self, bot: Bot):
+        group_list = await bot.get_group_list()
+        self.bot_groups[bot.self_id] = set(
+            str(group["group_id"]) for group in group_list)
+        self.rebuild()
+
+    def remove_bot(self, self_id: str):
+        if self.bot_groups.pop(self_id, None) is not None:
+            self.rebuild()
+
+    # 刷新所有已连接的Bot，获取失败时保留原来的群列表
+    async def refresh_all(self, bots: Dict[str, Bot]):
+        for self_id in list(self.bot_groups):
+            if not self_id in bots:
+                self.remove_bot(self_id)
+        for bot in bots.values():
+            try:
+                await self.refresh_bot(bot)
+            except Exception as e:
+                print(
+                    f"YukiClanbattle: Get group list of bot {bot.self_id} failed: {e}")
+
+    def rebuild(self):
+        group_bots: Dict[str, List[str]] = {}
+        for self_id in sorted(self.bot_groups):
+            for gid in self.bot_groups[self_id]:
+                group_bots.setdefault(gid, []).append(self_id)
+        self.group_bots = group_bots
+
+    # 选择发送消息的Bot，群列表中没有该群时（如刚加入的群）使用任意一个Bot
+    def select(self, gid: str, bots: Dict[str, Bot]) -> Bot:
+        self_ids = [self_id for self_id in self.group_bots.get(gid, [])
+                    if self_id in bots]
+        if not self_ids:
+            return list(bots.values())[0]
+        index = self.next_index.get(gid, 0) % len(self_ids)
+        self.next_index[gid] = index + 1
+        return bots[self_ids[index]]
+
+
+class GroupMessageSender:
+    # 群消息发送队列，消息先写入数据库中的发件箱，调用 send 后立即返回，由每个群的后台任务按顺序发送
+    # 同一个群在 tick 时间内收到的消息会合并为一条，每个群按令牌桶限制发送频率
+    # 没有可用的 Bot 时消息保留在发件箱中，Bot 连接后调用 resume 继续发送，发送失败时按指数退避重试
+
+    # 写入发件箱的操作使用同一个写锁，保证消息按调用 send 的顺序保存
+    outbox_write_key = "message_outbox"
+
+    def __init__(self, rate: float = 1, capacity: int = 3, tick: float = 0.2, max_at_num: int = 19,
+                 max_attempts: int = 5, max_retry_delay: float = 300, message_expire: datetime.timedelta = datetime.timedelta(hours=1)) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tick = tick
+        # 与原来的分段规则一致，每条消息最多20个消息段
+        self.max_at_num = max_at_num
+        self.max_attempts = max_attempts
+        self.max_retry_delay = max_retry_delay
+        # 超过该时间仍未发送的消息不再发送，避免 Bot 长时间离线后发出过时的提醒
+        self.message_expire = message_expire
+        self.buckets: Dict[str, TokenBucket] = {}
+        self.workers: Dict[str, asyncio.Task] = {}
+        # 每次写入新消息后递增，后台任务据此判断退出前是否有新消息
+        self.versions: Dict[str, int] = {}
+        self.enqueue_tasks: Set[asyncio.Task] = set()
+        self.bot_index = GroupBotIndex()
+
+    def send(self, gid: str, message: Union[str, Message, MessageSegment]) -> asyncio.Task:
+        task = asyncio.get_running_loop().create_task(
+            self.enqueue(str(gid), Message(message)))
+        self.enqueue_tasks.add(task)
+        task.add_done_callback(self.enqueue_tasks.discard)
+        return task
+
+    # 写入发件箱并启动发送任务，返回消息编号
+    async def enqueue(self, gid: str, message: Message) -> int:
+        message_id = await db_executor.run_write(self.outbox_write_key, self.save_message, gid, message)
+        self.start_worker(gid)
+        return message_id
+
+    def start_worker(self, gid: str):
+        self.versions[gid] = self.versions.get(gid, 0) + 1
+        if not gid in self.workers:
+            self.workers[gid] = asyncio.get_running_loop().create_task(
+                self.group_worker(gid))
+
+    # Bot 连接后继续发送发件箱中的消息
+    async def resume(self):
+        for gid in await db_executor.run(self.get_pending_groups):
+            self.start_worker(gid)
+
+    @staticmethod
+    def dump_message(message: Message) -> str:
+        return json.dumps([{"type": seg.type, "data": seg.data} for seg in message], ensure_ascii=False)
+
+    @staticmethod
+    def load_message(text: str) -> Message:
+        return Message([MessageSegment(seg["type"], seg["data"]) for seg in json.loads(text)])
+
+    def save_message(self, gid: str, message: Message) -> int:
+        now_time = datetime.datetime.utcnow()
+        return MessageOutbox.insert(group_id=gid, message=self.dump_message(message),
+                                    created=now_time, next_attempt=now_time).execute()
+
+    @staticmethod
+    def load_pending(gid: str, limit: int = 50) -> List[MessageOutbox]:
+        return list(MessageOutbox.select().where((MessageOutbox.group_id == gid) & (MessageOutbox.status == "pending"))
+                    .order_by(MessageOutbox.id).limit(limit))
+
+    @staticmethod
+    def get_pending_groups() -> List[str]:
+        return [row.group_id for row in MessageOutbox.select(MessageOutbox.group_id).where(
+            MessageOutbox.status == "pending").distinct()]
+
+    @staticmethod
+    def set_status(message_ids: List[int], status: str):
+        MessageOutbox.update(status=status, sent_time=datetime.datetime.utcnow() if status == "sent" else None).where(
+            MessageOutbox.id.in_(message_ids)).execute()
+
+    def set_sent(self, message_ids: List[int], sent_parts: Dict[int, int]):
+        if message_ids:
+            self.set_status(message_ids, "sent")
+        for message_id, parts in sent_parts.items():
+            MessageOutbox.update(sent_parts=parts).where(
+                MessageOutbox.id == message_id).execute()
+
+    # 记录发送失败，同一个群所有待发送的消息都等到重试时间后再发送，保持发送顺序
+    def set_failed(self, gid: str, message_ids: List[int], error: str) -> float:
+        MessageOutbox.update(attempts=MessageOutbox.attempts + 1, last_error=error).where(
+            MessageOutbox.id.in_(message_ids)).execute()
+        attempts = MessageOutbox.select(fn.MAX(MessageOutbox.attempts)).where(
+            MessageOutbox.id.in_(message_ids)).scalar()
+        if attempts >= self.max_attempts:
+            self.set_status(message_ids, "failed")
+            return 0
+        retry_delay = min(2 ** attempts, self.max_retry_delay)
+        MessageOutbox.update(next_attempt=datetime.datetime.utcnow() + datetime.timedelta(seconds=retry_delay)).where(
+            (MessageOutbox.group_id == gid) & (MessageOutbox.status == "pending")).execute()
+        return retry_delay
+
+    @staticmethod
+    def get_message(message_id: int) -> MessageOutbox:
+        return MessageOutbox.get_or_none(MessageOutbox.id == message_id)
+
+    # 清理已经处理完的消息
+    @staticmethod
+    def sweep(keep: datetime.timedelta = datetime.timedelta(days=1)) -> int:
+        return MessageOutbox.delete().where((MessageOutbox.status != "pending")
+                                            & (MessageOutbox.created < datetime.datetime.utcnow() - keep)).execute()
+
+    @staticmethod
+    def count_at(message: Message) -> int:
+        return len([seg for seg in message if seg.type == "at"])
+
+    # 将at人数超过上限的消息拆成多条，每条都带上原消息开头的文字
+    def split_message(self, message: Message) -> List[Message]:
+        if self.count_at(message) <= self.max_at_num:
+            return [message]
+        head = Message()
+        at_list = []
+        tail = Message()
+        for seg in message:
+            if seg.type == "at":
+                at_list.append(seg)
+            elif at_list:
+                tail.append(seg)
+            else:
+                head.append(seg)
+        split_list = []
+        for i in range(0, len(at_list), self.max_at_num):
+            split_list.append(head + Message(at_list[i:i+self.max_at_num]))
+        split_list[-1] += tail
+        return split_list
+
+    # 合并同一时间段内的消息，合并后的消息at人数不超过上限
+    # entries 为 (消息编号, 消息, 已发送的条数)，拆分成多条的消息跳过已经发送的部分
+    # 返回 (发送完成的消息编号列表, {只发送了一部分的消息编号: 发送后已发送的条数}, 合并后的消息)
+    def merge_entries(self, entries: List[Tuple[int, Message, int]]) -> List[Tuple[List[int], Dict[int, int], Message]]:
+        merged_list = []
+        current_ids = []
+        current_parts = {}
+        current_msg = Message()
+        current_at_num = 0
+        for message_id, message, sent_parts in entries:
+            parts = self.split_message(message)
+            for i, part in enumerate(parts):
+                if i < sent_parts:
+                    continue
+                at_num = self.count_at(part)
+                if len(current_msg) > 0 and current_at_num + at_num > self.max_at_num:
+                    merged_list.append((current_ids, current_parts, current_msg))
+                    current_ids = []
+                    current_parts = {}
+                    current_msg = Message()
+                    current_at_num = 0
+                if len(current_msg) > 0:
+                    current_msg += MessageSegment.text("\n")
+                current_msg += part
+                current_at_num += at_num
+                if i == len(parts) - 1:
+                    current_ids.append(message_id)
+                else:
+                    current_parts[message_id] = i + 1
+        if len(current_msg) > 0:
+            merged_list.append((current_ids, current_parts, current_msg))
+        return merged_list
+
+    def merge_message(self, msg_list: List[Message]) -> List[Message]:
+        return [message for _, _, message in self.merge_entries([(i, msg, 0) for i, msg in enumerate(msg_list)])]
+
+    async def group_worker(self, gid: str):
+        try:
+            if not gid in self.buckets:
+                self.buckets[gid] = TokenBucket(self.rate, self.capacity)
+            bucket = self.buckets[gid]
+            while True:
+                # 等待同一时间段内的其他消息一起发送
+                await asyncio.sleep(self.tick)
+                version = self.versions.get(gid)
+                rows = await db_executor.run(self.load_pending, gid)
+                if not rows:
+                    if version == self.versions.get(gid):
+                        break
+                    continue
+                now_time = datetime.datetime.utcnow()
+                if rows[0].next_attempt > now_time:
+                    await asyncio.sleep((rows[0].next_attempt - now_time).total_seconds())
+                    continue
+                expired_ids = [row.id for row in rows
+                               if now_time - row.created > self.message_expire]
+                if expired_ids:
+                    await db_executor.run_write(self.outbox_write_key, self.set_status, expired_ids, "expired")
+                entries = [(row.id, self.load_message(row.message), row.sent_parts)
+                           for row in rows if not row.id in expired_ids]
+                for message_ids, sent_parts, message in self.merge_entries(entries):
+                    await asyncio.sleep(bucket.take())
+                    try:
+                        await self.deliver(gid, message)
+                    except BotUnavailableException:
+                        print(
+                            f"YukiClanbattle: No bot available, keep messages to group {gid} in outbox")
+                        return
+                    except Exception as e:
+                        print(
+                            f"YukiClanbattle: Send message to group {gid} failed: {e}")
+                        await db_executor.run_write(self.outbox_write_key, self.set_failed, gid,
+                                                    message_ids + list(sent_parts), str(e))
+                        break
+                    # 每发送一条就记录进度，重试时从未发送的部分继续，避免重复at
+                    await db_executor.run_write(self.outbox_write_key, self.set_sent, message_ids, sent_parts)
+        finally:
+            del self.workers[gid]
+
+    async def deliver(self, gid: str, message: Message):
+        bots = nonebot.get_bots()
+        if not bots:
+            raise BotUnavailableException()
+        bot = self.bot_index.select(gid, bots)
+        await bot.send_group_msg(group_id=gid, message=message)
+
+
+message_sender = GroupMessageSender()
@@ -0,0 +1,65 @@
+import asyncio
+import time
+
+import pytest
+
+
+class SlowClanData:
+    def __init__(self, gid: str, write_delay: float = 0) -> None:
+        from types import SimpleNamespace
+        self.clan_info = SimpleNamespace(clan_gid=gid)
+        self.write_delay = write_delay
+        self.write_log = []
+
+    def create_new_record(self, uid: str, *args):
+        time.sleep(self.write_delay)
+        self.write_log.append(uid)
+
+    def get_current_boss_state(self):
+        return []
+
+
+@pytest.mark.asyncio
+async def test_slow_write_not_block_other_clan():
+    from ..utils import AsyncClanBattleData
+
+    slow_clan = AsyncClanBattleData(SlowClanData("1001", write_delay=0.5))
+    other_clan = AsyncClanBattleData(SlowClanData("1002"))
+    write_task = asyncio.create_task(slow_clan.create_new_record("1"))
+    await asyncio.sleep(0.05)
+    start = time.perf_counter()
+    await other_clan.get_current_boss_state()
+    await other_clan.create_new_record("2")
+    assert time.perf_counter() - start < 0.2
+    # 写操作执行期间事件循环本身也不会被阻塞
+    start = time.perf_counter()
+    await asyncio.sleep(0.05)
+    assert time.perf_counter() - start < 0.2
+    assert not write_task.done()
+    await write_task
+
+
+@pytest.mark.asyncio
+async def test_write_order_in_same_clan():
+    from ..utils import AsyncClanBattleData
+
+    clan_data = SlowClanData("1003", write_delay=0.01)
+    clan = AsyncClanBattleData(clan_data)
+    await asyncio.gather(*[clan.create_new_record(str(i)) for i in range(20)])
+    assert clan_data.write_log == [str(i) for i in range(20)]
+
+
+@pytest.mark.asyncio
+async def test_concurrent_get_clan_data():
+    import random
+    from ..utils import ClanBattle
+
+    clanbattle = ClanBattle()
+    gid = str(random.randrange(10 ** 8, 10 ** 9))
+    assert await clanbattle.get_clan_data(gid) is None
+    await clanbattle.create_clan(gid, "load", "cn", ["1"])
+    del clanbattle.clan_data_dict[gid]
+    # 同时第一次加载同一公会时得到同一个实例
+    clans = await asyncio.gather(*[clanbattle.get_clan_data(gid) for _ in range(10)])
+    assert all(clan is clans[0] for clan in clans)
+    await clanbattle.delete_clan(gid)
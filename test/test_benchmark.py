@@ -0,0 +1,147 @@
+import datetime
+import os
+import random
+import tempfile
+import time
+
+import pytest
+
+# 基准测试耗时较长，设置环境变量 YUKI_CLANBATTLE_BENCHMARK=1 后运行
+# pytest test/test_benchmark.py -s
+benchmark = pytest.mark.skipif(not os.environ.get("YUKI_CLANBATTLE_BENCHMARK"),
+                               reason="set YUKI_CLANBATTLE_BENCHMARK=1 to run benchmarks")
+
+
+def timeit(func, repeat: int = 50) -> float:
+    func()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+@benchmark
+def test_battle_record_query_scaling():
+    from peewee import SqliteDatabase
+    from ..db import BattleRecord, BattleSL, BattleSubscribe, BattleOnTree, BattleInProgress, BossState, ClanInfo, ClanMembership, ClanAdmin, User, WebSession, run_migrations
+    from ..utils import ClanBattleData
+
+    sizes = [int(size) for size in os.environ.get(
+        "YUKI_CLANBATTLE_BENCHMARK_ROWS", "10000,100000,1000000,3000000").split(",")]
+    models = [User, ClanInfo, ClanMembership, ClanAdmin, WebSession, BattleRecord, BattleSubscribe,
+              BattleOnTree, BattleInProgress, BattleSL, BossState]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for indexed in (False, True):
+            bench_db = SqliteDatabase(os.path.join(
+                tmp_dir, f"bench_{indexed}.db"), pragmas={"synchronous": "off", "journal_mode": "memory"})
+            with bench_db.bind_ctx(models):
+                bench_db.create_tables(models)
+                ClanInfo.create(clan_gid="10000", clan_name="bench", clan_type="jp",
+                                clan_admin="", create_time=datetime.datetime.utcnow())
+                clan = ClanBattleData("10000")
+                if indexed:
+                    run_migrations(bench_db)
+                now = datetime.datetime.utcnow()
+                rows = 0
+                for size in sizes:
+                    batch = []
+                    while rows < size:
+                        # 其他公会和旧档案的数据占绝大多数
+                        clan_gid = str(10000 + random.randrange(2000))
+                        batch.append({
+                            "clan_gid": clan_gid, "member_uid": str(random.randrange(30)),
+                            "record_time": now - datetime.timedelta(minutes=random.randrange(60 * 24 * 180)),
+                            "using_data_num": random.randrange(1, 4), "target_cycle": 1,
+                            "target_boss": random.randrange(1, 6), "boss_hp": 1, "damage": 1,
+                            "is_extra_time": False, "remain_next_chance": False})
+                        rows += 1
+                        if len(batch) == 5000:
+                            with bench_db.atomic():
+                                BattleRecord.insert_many(batch).execute()
+                            batch = []
+                    if batch:
+                        with bench_db.atomic():
+                            BattleRecord.insert_many(batch).execute()
+                    if indexed:
+                        bench_db.execute_sql("ANALYZE")
+                    recent_ms = timeit(lambda: clan.get_recent_record(boss=3))
+                    # 当天出刀状态已经改为使用内存中的数据，这里测量聚合查询本身
+                    status_ms = timeit(
+                        lambda: clan.get_record_status("7"))
+                    print(
+                        f"\n{'indexed' if indexed else 'no index'} rows={size}: recent_record_by_boss {recent_ms:.3f}ms, today_status {status_ms:.3f}ms")
+                    if indexed:
+                        if size == sizes[0]:
+                            baseline = max(recent_ms, status_ms)
+                        else:
+                            assert max(recent_ms, status_ms) < baseline * 5 + 1
+            bench_db.close()
+
+
+@benchmark
+def test_cycle_stage_lookup():
+    from ..config import get_config
+    from ..utils import compile_boss_tables
+
+    boss_info = get_config().boss_info
+    boss_tables = compile_boss_tables(boss_info)
+
+    # 原来逐个阶段比较的实现
+    def get_cycle_stage(clan_type: str, cycle: int) -> int:
+        max_cycle = len(boss_info["cycle"][clan_type])
+        for i in range(len(boss_info["cycle"][clan_type])):
+            if max_cycle - 1 == i and cycle >= boss_info["cycle"][clan_type][i]:
+                return i+1
+            elif max_cycle != i and cycle >= boss_info["cycle"][clan_type][i] and cycle < boss_info["cycle"][clan_type][i+1]:
+                return i+1
+
+    def linear_lookup():
+        for cycle in range(1, 200):
+            stage = get_cycle_stage("jp", cycle)
+            boss_info["boss"]["jp"][stage-1][4]
+
+    def table_lookup():
+        boss_table = boss_tables["jp"]
+        for cycle in range(1, 200):
+            boss_table.get_max_hp(boss_table.get_stage(cycle), 5)
+
+    for clan_type in ("jp", "tw", "cn"):
+        for cycle in range(1, 200):
+            assert boss_tables[clan_type].get_stage(
+                cycle) == get_cycle_stage(clan_type, cycle)
+    linear_ms = timeit(linear_lookup, 2000)
+    table_ms = timeit(table_lookup, 2000)
+    print(
+        f"\ncycle stage lookup x199: linear {linear_ms * 1000:.1f}us, bisect table {table_ms * 1000:.1f}us")
+    assert table_ms < linear_ms
+
+
+@benchmark
+def test_command_router_throughput():
+    from .. import clanbattle_router
+
+    chat = ["今天抽卡又歪了", "有没有人打竞技场", "[CQ:image,file=abc.jpg]", "哈哈哈哈哈", "晚上几点开会战",
+            "这个阵容怎么配", "[CQ:at,qq=123456789] 在吗", "好的收到", "我先去吃饭了", "查一下今天的活动"]
+    commands = ["报刀 1200w", "3报刀 800w", "尾刀", "状态", "查树", "申请出刀2", "预约4", "挂树1", "查刀", "sl 3",
+                "3王解锁", "下树"]
+    random.seed(0)
+    # 会战期间大部分消息仍然是普通聊天
+    messages = [random.choice(commands) if random.random() < 0.1 else random.choice(chat)
+                for _ in range(10000)]
+    regex_list = [(command.name, command.regex)
+                  for command in clanbattle_router.commands.values()]
+
+    # 原来每个指令单独注册 on_regex 时，每条消息都要依次匹配所有正则
+    def match_all(text: str):
+        return [name for name, regex in regex_list if regex.search(text)]
+
+    def router_match(text: str):
+        return [command.name for command, _ in clanbattle_router.match(text)]
+
+    for message in messages:
+        assert router_match(message) == match_all(message)
+    all_ms = timeit(lambda: [match_all(message) for message in messages], 10)
+    router_ms = timeit(lambda: [router_match(message)
+                       for message in messages], 10)
+    print(f"\ncommand match x{len(messages)}: all regex {all_ms:.2f}ms, keyword trie {router_ms:.2f}ms")
+    assert router_ms < all_ms
@@ -0,0 +1,14 @@
+def test_command_router_match():
+    from .. import clanbattle_router
+
+    def match_names(text: str):
+        return [command.name for command, _ in clanbattle_router.match(text)]
+
+    assert match_names("申请出刀2") == ["queue"]
+    # 解锁和下树在消息结尾时也能匹配
+    assert match_names("取消申请") == ["unqueue"]
+    assert match_names("3王解锁") == ["unqueue"]
+    assert match_names("取消挂树") == ["un_on_tree"]
+    assert match_names("打完了下树") == ["un_on_tree"]
+    assert match_names("解锁一下") == []
+    assert match_names("今天抽卡又歪了") == []
@@ -0,0 +1,67 @@
+import asyncio
+import random
+
+import pytest
+
+
+async def create_test_clan(member_num: int):
+    from ..utils import ClanBattle
+
+    clanbattle = ClanBattle()
+    gid = str(random.randrange(10 ** 8, 10 ** 9))
+    await clanbattle.create_clan(gid, "stress", "cn", ["1"])
+    clan = await clanbattle.get_clan_data(gid)
+    await clan.add_clan_members([(str(uid), f"member{uid}") for uid in range(member_num)])
+    return clanbattle, clan
+
+
+@pytest.mark.asyncio
+async def test_concurrent_kill_record():
+    from ..utils import CommitRecordResult
+
+    clanbattle, clan = await create_test_clan(20)
+
+    # 所有人在同一时刻看到1王第1周目，然后同时发送尾刀
+    boss_status = (await clan.get_current_boss_state())[0]
+    results = await asyncio.gather(*[clan.commit_record(str(uid), 1, None, None, is_kill_boss=True, expected_cycle=boss_status.target_cycle) for uid in range(20)])
+    assert results.count(CommitRecordResult.success) == 1
+    assert results.count(CommitRecordResult.boss_status_changed) == 19
+    boss_status = (await clan.get_current_boss_state())[0]
+    assert boss_status.target_cycle == 2
+    assert boss_status.boss_hp == boss_status.max_boss_hp
+    assert len(await clan.get_record()) == 1
+    await clanbattle.delete_clan(clan.clan_info.clan_gid)
+
+
+@pytest.mark.asyncio
+async def test_concurrent_damage_record():
+    from ..utils import CommitRecordResult
+
+    clanbattle, clan = await create_test_clan(20)
+    max_hp = (await clan.get_current_boss_state())[0].boss_hp
+    damage = max_hp // 40
+    results = await asyncio.gather(*[clan.commit_record(str(uid), 1, str(damage), None) for uid in range(20)])
+    assert results == [CommitRecordResult.success] * 20
+    boss_status = (await clan.get_current_boss_state())[0]
+    assert boss_status.target_cycle == 1
+    assert boss_status.boss_hp == max_hp - damage * 20
+    await clanbattle.delete_clan(clan.clan_info.clan_gid)
+
+
+@pytest.mark.asyncio
+async def test_state_version_after_commit():
+    from ..db import sqlite_db
+
+    clanbattle, clan = await create_test_clan(1)
+    seen = []
+    bump_state_version = clan.data.bump_state_version
+
+    # 嵌套的写方法不单独递增版本，版本在最外层事务提交后递增一次
+    def record_bump():
+        seen.append(sqlite_db.in_transaction())
+        bump_state_version()
+    clan.data.bump_state_version = record_bump
+    await clan.commit_record("0", 1, "1", None)
+    del clan.data.bump_state_version
+    assert seen == [False]
+    await clanbattle.delete_clan(clan.clan_info.clan_gid)
@@ -0,0 +1,50 @@
+import random
+
+import pytest
+
+
+@pytest.mark.asyncio
+async def test_import_record():
+    from ..utils import ClanBattle, ClanBattleData
+
+    clanbattle = ClanBattle()
+    gid = str(random.randrange(10 ** 8, 10 ** 9))
+    await clanbattle.create_clan(gid, "import", "cn", ["1"])
+    clan = await clanbattle.get_clan_data(gid)
+    await clan.add_clan_members([(str(uid), f"member{uid}") for uid in range(1, 4)])
+    max_hp = (await clan.get_current_boss_state())[0].max_boss_hp
+    content = "\n".join(["member_uid,record_time,target_boss,target_cycle,damage,is_extra_time",
+                         f"1,2026-01-01 10:00:00,1,1,{max_hp // 2},False",
+                         # 超出剩余生命值的伤害按击败boss处理
+                         f"2,2026-01-01 10:01:00,1,1,{max_hp},False",
+                         "3,2026-01-01 10:02:00,1,2,100w,True"])
+    rows = ClanBattleData.parse_import_content(content, "csv")
+    assert await clan.import_records(rows) == (3, [])
+    boss_status = (await clan.get_current_boss_state())[0]
+    assert boss_status.target_cycle == 2
+    assert boss_status.boss_hp == boss_status.max_boss_hp - 1000000
+    records = await clan.get_record()
+    assert [record.boss_hp == record.damage for record in records] == [False, True, False]
+
+    # 有错误的记录时整个文件都不会导入
+    row = {"member_uid": "1", "record_time": "2026-01-01 11:00:00",
+           "target_boss": "1", "target_cycle": "3", "damage": "1"}
+    count, errors = await clan.import_records([dict(row, target_boss="6"), dict(row, member_uid="9"),
+                                               dict(row, record_time=""), row])
+    assert count == 0 and len(errors) == 3
+    assert len(await clan.get_record()) == 3
+
+    # 没有 boss_hp 的记录从boss当前的剩余生命值开始计算
+    assert await clan.import_records([dict(row, target_cycle="2", damage=str(max_hp))]) == (1, [])
+    record = (await clan.get_recent_record("1"))[0]
+    assert record.boss_hp == record.damage == boss_status.boss_hp
+
+    # 写入过程中出错时整个导入回滚
+    def refresh_boss_state(boss: int):
+        raise RuntimeError("refresh failed")
+    clan.data.refresh_boss_state = refresh_boss_state
+    with pytest.raises(RuntimeError):
+        await clan.import_records([dict(row, target_boss="2", target_cycle="1")])
+    del clan.data.refresh_boss_state
+    assert len(await clan.get_record()) == 4
+    await clanbattle.delete_clan(gid)
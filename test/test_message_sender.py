@@ -0,0 +1,126 @@
+import asyncio
+import time
+
+import pytest
+from nonebot.adapters.onebot.v11 import Message, MessageSegment
+
+
+def create_sender(**kwargs):
+    from ..message_sender import GroupMessageSender
+
+    sender = GroupMessageSender(**kwargs)
+    sender.delivered = []
+
+    # 记录发送的消息和时间，不实际发送
+    async def deliver(gid: str, message: Message):
+        sender.delivered.append((gid, time.monotonic(), message))
+    sender.deliver = deliver
+    return sender
+
+
+def test_split_at_message():
+    sender = create_sender(max_at_num=19)
+    message = Message("管理员催你快去出刀啦") + Message(
+        [MessageSegment.at(str(uid)) for uid in range(45)])
+    split_list = sender.merge_message([message])
+    assert [sender.count_at(msg) for msg in split_list] == [19, 19, 7]
+    assert all(str(msg).startswith("管理员催你快去出刀啦") for msg in split_list)
+
+
+@pytest.mark.asyncio
+async def test_merge_and_rate_limit():
+    sender = create_sender(rate=10, capacity=1, tick=0.05)
+    for i in range(3):
+        sender.send("1001", f"notice{i}")
+    sender.send("1002", "other group")
+    await asyncio.sleep(0.2)
+    # 同一时间段内的消息合并为一条
+    assert [str(msg) for gid, _, msg in sender.delivered if gid == "1001"] == [
+        "notice0\nnotice1\nnotice2"]
+    for i in range(3):
+        sender.send("1001", MessageSegment.at(str(i)) + "x" * 10)
+        await asyncio.sleep(0.06)
+    await asyncio.sleep(0.5)
+    send_time = [t for gid, t, _ in sender.delivered if gid == "1001"]
+    assert len(send_time) == 4
+    assert all(b - a >= 0.09 for a, b in zip(send_time[1:], send_time[2:]))
+    assert not sender.workers
+
+
+@pytest.mark.asyncio
+async def test_outbox_retry_and_resume():
+    from ..db import MessageOutbox
+    from ..exception import BotUnavailableException
+
+    sender = create_sender(tick=0.05, max_retry_delay=0.1)
+    record_deliver = sender.deliver
+    failures = [BotUnavailableException(), RuntimeError("timeout")]
+
+    async def deliver(gid: str, message: Message):
+        if failures:
+            raise failures.pop(0)
+        await record_deliver(gid, message)
+    sender.deliver = deliver
+    # 没有可用的Bot时消息保留在发件箱中
+    message_id = await sender.send("1003", "outbox")
+    await asyncio.sleep(0.2)
+    assert not sender.workers and not sender.delivered
+    assert MessageOutbox.get_by_id(message_id).status == "pending"
+    # Bot连接后继续发送，发送失败时退避重试
+    await sender.resume()
+    await asyncio.sleep(1.5)
+    row = MessageOutbox.get_by_id(message_id)
+    assert (row.status, row.attempts) == ("sent", 1)
+    assert [str(msg) for gid, _, msg in sender.delivered] == ["outbox"]
+    assert not sender.workers
+
+
+class FakeBot:
+
+    def __init__(self, self_id: str, group_list) -> None:
+        self.self_id = self_id
+        self.group_list = group_list
+
+    async def get_group_list(self):
+        return [{"group_id": int(gid)} for gid in self.group_list]
+
+
+@pytest.mark.asyncio
+async def test_bot_index_select():
+    from ..message_sender import GroupBotIndex
+
+    bots = {"1": FakeBot("1", ["2001"]), "2": FakeBot("2", ["2001", "2002"])}
+    bot_index = GroupBotIndex()
+    await bot_index.refresh_all(bots)
+    # 只有一个Bot在群里时总是使用该Bot，多个Bot在群里时轮流发送
+    assert [bot_index.select("2002", bots).self_id for _ in range(3)] == ["2", "2", "2"]
+    assert [bot_index.select("2001", bots).self_id for _ in range(4)] == ["1", "2", "1", "2"]
+    del bots["2"]
+    await bot_index.refresh_all(bots)
+    assert bot_index.select("2001", bots).self_id == "1"
+    assert not "2002" in bot_index.group_bots
+
+
+@pytest.mark.asyncio
+async def test_outbox_resume_split_message():
+    from ..db import MessageOutbox
+
+    sender = create_sender(tick=0.05, max_retry_delay=0.1)
+    record_deliver = sender.deliver
+    calls = []
+
+    async def deliver(gid: str, message: Message):
+        calls.append(message)
+        if len(calls) == 2:
+            raise RuntimeError("timeout")
+        await record_deliver(gid, message)
+    sender.deliver = deliver
+    message = Message("管理员催你快去出刀啦") + Message(
+        [MessageSegment.at(str(uid)) for uid in range(45)])
+    message_id = await sender.send("1004", message)
+    await asyncio.sleep(1.5)
+    # 第二条发送失败后从第二条重新发送，第一条不会重复发送
+    assert [sender.count_at(msg) for _, _, msg in sender.delivered] == [19, 19, 7]
+    row = MessageOutbox.get_by_id(message_id)
+    assert (row.status, row.attempts, row.sent_parts) == ("sent", 1, 2)
+    assert not sender.workers
@@ -0,0 +1,78 @@
+import asyncio
+import datetime
+import random
+
+import pytest
+
+
+def status_values(status):
+    return (status.today_challenged, status.addition_challeng, status.remain_addition_challeng,
+            status.last_is_addition, status.use_sl)
+
+
+@pytest.mark.asyncio
+async def test_today_status_tracker():
+    from ..utils import ClanBattle, ClanBattleData
+
+    clanbattle = ClanBattle()
+    gid = str(random.randrange(10 ** 8, 10 ** 9))
+    await clanbattle.create_clan(gid, "status", "cn", ["1"])
+    clan = await clanbattle.get_clan_data(gid)
+    members = [str(uid) for uid in range(10)]
+    await clan.add_clan_members([(uid, f"member{uid}") for uid in members])
+    # 先加载内存状态，之后的修改都通过增量更新
+    await clan.get_today_member_status()
+    random.seed(1)
+    for _ in range(60):
+        uid = random.choice(members)
+        boss = random.randint(1, 5)
+        action = random.random()
+        if action < 0.6:
+            boss_status = (await clan.get_current_boss_state())[boss-1]
+            damage = boss_status.boss_hp if random.random() < 0.3 else boss_status.boss_hp // 4
+            await clan.commit_record(uid, boss, str(damage), None)
+        elif action < 0.8:
+            await clan.delete_recent_record(uid)
+        else:
+            await clan.commit_battle_sl(uid, boss)
+        if random.random() < 0.3:
+            tracked = await clan.get_today_record_status(uid)
+            assert status_values(tracked) == status_values(await clan.run(ClanBattleData.get_record_status, uid))
+    tracked = await clan.get_today_member_status()
+    assert [status_values(status) for status in tracked] == \
+        [status_values(status) for status in await clan.get_member_record_status()]
+
+    # 并发上报后内存状态与数据库一致
+    await asyncio.gather(*[clan.commit_record(uid, 1, "1", None) for uid in members])
+    start_time, end_time = clan.data.get_today_datetime()
+    status = await clan.run(lambda data: data.today_status.get_status_dict(members))
+    assert await clan.run(lambda data: data.today_status.check(status, members, start_time, end_time)) == []
+
+    # 跨过当天5点后重新加载
+    clan.data.get_today_datetime = lambda: (end_time, end_time + datetime.timedelta(days=1))
+    assert status_values(await clan.get_today_record_status("1")) == (0, 0, 0, False, False)
+    await clanbattle.delete_clan(gid)
+
+
+@pytest.mark.asyncio
+async def test_today_status_load_before_apply():
+    from ..utils import ClanBattle
+
+    clanbattle = ClanBattle()
+    gid = str(random.randrange(10 ** 8, 10 ** 9))
+    await clanbattle.create_clan(gid, "status", "cn", ["1"])
+    clan = await clanbattle.get_clan_data(gid)
+    await clan.add_clan_members([("1", "member1")])
+    tracker = clan.data.today_status
+    apply_pending = tracker.apply_pending
+
+    # 出刀记录已经提交、还没有应用到内存状态时重新加载，记录不会被重复计算
+    def load_then_apply():
+        tracker.reset()
+        tracker.get_status_dict(["1"])
+        apply_pending()
+    tracker.apply_pending = load_then_apply
+    await clan.commit_record("1", 1, "1", None)
+    del tracker.apply_pending
+    assert status_values(await clan.get_today_record_status("1")) == (1, 0, 0, False, False)
+    await clanbattle.delete_clan(gid)
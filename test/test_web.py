@@ -0,0 +1,10 @@
+def test_etag_matches():
+    from ..utils import Tools
+
+    etag = 'W/"get_joined_clan-1-1001,1002"'
+    assert Tools.etag_matches(etag, etag)
+    assert Tools.etag_matches('"get_joined_clan-1-1001,1002"', etag)
+    assert Tools.etag_matches('W/"other", W/"get_joined_clan-1-1001,1002"', etag)
+    assert Tools.etag_matches(" * ", etag)
+    assert not Tools.etag_matches('W/"get_joined_clan-1-1001"', etag)
+    assert not Tools.etag_matches(None, etag)
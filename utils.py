@@ -1,4 +1,13 @@
 import asyncio
+import bisect
+import copy
+import csv
+import io
+import re
+import threading
+import time
+import weakref
+from collections import OrderedDict
 from peewee import *
 from typing import Dict, List
 import datetime
@@ -9,9 +18,11 @@ from functools import wraps
 from nonebot.adapters.onebot.v11 import Bot
 from nonebot.adapters.onebot.v11 import Message, MessageSegment
 from peewee import _BoundModelsContext
-from .db import BaseModel, User, ClanInfo, BattleOnTree, BattleRecord, BattleInProgress, BattleSL, BattleSubscribe
+from playhouse.shortcuts import model_to_dict
+from .db import sqlite_db, db_executor, BaseModel, User, ClanInfo, ClanMembership, ClanAdmin, WebSession, BattleOnTree, BattleRecord, BattleInProgress, BattleSL, BattleSubscribe, BossState
+from .message_sender import message_sender
 from .exception import ClanBattleException, ClanBattleDamageParseException
-from typing import Any, List, Union, Optional, Tuple
+from typing import Any, Callable, List, Set, Union, Optional, Tuple
 import json
 import uuid
 import hashlib
@@ -41,6 +52,35 @@ class BossInfo(pydantic.BaseModel):
 boss_info: dict = None
 
 
+class BossTable:
+    # 由配置文件编译的单个服务器的boss数据，加载配置时生成一次，之后只读
+    # cycle_thresholds 为各阶段开始的周目，max_hp[阶段-1][boss-1] 为boss的最大生命值
+
+    __slots__ = ("cycle_thresholds", "max_hp", "stage_num")
+
+    def __init__(self, cycles: List[int], hp: List[List[int]]) -> None:
+        self.cycle_thresholds = tuple(cycles)
+        self.max_hp = tuple(tuple(stage_hp) for stage_hp in hp)
+        self.stage_num = len(self.cycle_thresholds)
+
+    def get_stage(self, cycle: int) -> int:
+        if cycle < self.cycle_thresholds[0]:
+            raise ClanBattleException("cycle error")
+        return bisect.bisect_right(self.cycle_thresholds, cycle)
+
+    def get_max_hp(self, stage: int, boss: int) -> int:
+        return self.max_hp[stage-1][boss-1]
+
+
+boss_tables: Dict[str, BossTable] = {}
+
+
+def compile_boss_tables(info: dict) -> Dict[str, BossTable]:
+    info = BossInfo.parse_obj(info)
+    return {clan_type: BossTable(getattr(info.cycle, clan_type), getattr(info.boss, clan_type))
+            for clan_type in ("jp", "tw", "cn")}
+
+
 class BossStatus:
     target_cycle: int
     stage: int
@@ -90,6 +130,7 @@ class CommitRecordResult(Enum):
     member_not_in_clan = 4
     boss_not_challengeable = 5
     on_another_tree = 6
+    boss_status_changed = 7
 
 
 class CommitInProgressResult(Enum):
@@ -131,45 +172,325 @@ class NewRecordLegalCheckResult(Enum):
     boss_not_challengeable = 2
 
 
+class LRUCache:
+    # 线程安全的LRU缓存，缓存项同时受数据版本和过期时间约束
+
+    def __init__(self, max_size: int = 256, ttl: float = 60) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.items: OrderedDict = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: str, version: int) -> Tuple[bool, Any]:
+        with self.lock:
+            item = self.items.get(key)
+            if item and item[0] == version and item[1] > time.monotonic():
+                self.items.move_to_end(key)
+                self.hits += 1
+                return (True, item[2])
+            if item:
+                del self.items[key]
+            self.misses += 1
+            return (False, None)
+
+    def set(self, key: str, version: int, value: Any):
+        with self.lock:
+            self.items[key] = (version, time.monotonic() + self.ttl, value)
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    def get_stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self.items)}
+
+
+class SessionCache:
+    # 网页会话缓存，token -> (uid, 已加入的公会)，会话或成员变化时按 uid 失效
+    # generation 在每次失效时递增，防止失效前读出的旧数据在失效后写入缓存
+
+    def __init__(self, ttl: float = 300, max_size: int = 4096) -> None:
+        self.ttl = ttl
+        self.max_size = max_size
+        self.generation = 0
+        self.items: OrderedDict = OrderedDict()
+        self.user_tokens: Dict[str, Set[str]] = {}
+        self.lock = threading.Lock()
+
+    def get(self, token: str) -> Optional[Tuple[str, List[str]]]:
+        if not token:
+            return None
+        with self.lock:
+            item = self.items.get(token)
+            if not item:
+                return None
+            if item[0] < time.monotonic():
+                self.remove(token)
+                return None
+            self.items.move_to_end(token)
+            return (item[1], list(item[2]))
+
+    # expires 为会话在数据库中的过期时间，缓存不会超过该时间
+    def set(self, token: str, uid: str, joined_clan: List[str], generation: int, expires: datetime.datetime = None):
+        ttl = self.ttl
+        if expires:
+            ttl = min(ttl, (expires - datetime.datetime.utcnow()).total_seconds())
+        with self.lock:
+            if generation != self.generation or ttl <= 0:
+                return
+            self.remove(token)
+            self.items[token] = (time.monotonic() + ttl, uid, list(joined_clan))
+            self.user_tokens.setdefault(uid, set()).add(token)
+            while len(self.items) > self.max_size:
+                self.remove(next(iter(self.items)))
+
+    # 调用时需要持有锁
+    def remove(self, token: str):
+        item = self.items.pop(token, None)
+        if item and item[1] in self.user_tokens:
+            self.user_tokens[item[1]].discard(token)
+            if not self.user_tokens[item[1]]:
+                del self.user_tokens[item[1]]
+
+    def invalidate_uid(self, uid: str):
+        with self.lock:
+            self.generation += 1
+            for token in list(self.user_tokens.get(uid, [])):
+                self.remove(token)
+
+    # 会话被删除或替换时使缓存失效
+    def invalidate_tokens(self, tokens: List[str]):
+        with self.lock:
+            self.generation += 1
+            for token in tokens:
+                self.remove(token)
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.items.clear()
+            self.user_tokens.clear()
+
+
+session_cache = SessionCache()
+
+
+class TodayStatusTracker:
+    # 公会当天出刀状态的内存副本，第一次使用时用一次聚合查询加载，之后随出刀记录和SL的写入增量更新
+    # 写操作的变化先记录下来，事务提交后再应用，回滚时丢弃并重新加载
+    # 记录变化时递增 generation，提交后、应用前加载的数据可能已经包含这些变化，不会被保存
+    # 跨过服务器当天的5点（与 get_today_datetime 一致）或切换档案后自动重新加载
+
+    def __init__(self, clan: "ClanBattleData") -> None:
+        self.clan = clan
+        self.lock = threading.Lock()
+        self.generation = 0
+        # (开始时间, 结束时间, 档案编号)
+        self.loaded_key: Tuple[datetime.datetime, datetime.datetime, int] = None
+        self.status: Dict[str, TodayBattleStatus] = {}
+        self.pending: List[tuple] = []
+
+    def add_pending(self, change: Optional[tuple]):
+        with self.lock:
+            self.generation += 1
+            self.pending.append(change)
+
+    def record_added(self, uid: str, record_time: datetime.datetime, is_extra_time: bool, remain_next_chance: bool):
+        self.add_pending((uid, record_time, is_extra_time, remain_next_chance))
+
+    def sl_added(self, uid: str, record_time: datetime.datetime):
+        self.add_pending((uid, record_time, None, None))
+
+    # 无法增量更新的修改，提交后重新加载
+    def invalidate(self):
+        self.add_pending(None)
+
+    def reset(self):
+        with self.lock:
+            self.generation += 1
+            self.loaded_key = None
+            self.status = {}
+
+    def discard_pending(self):
+        with self.lock:
+            self.pending = []
+        self.reset()
+
+    def apply_pending(self):
+        with self.lock:
+            pending = self.pending
+            self.pending = []
+            # 加载中的查询可能没有包含这些修改，不再使用
+            self.generation += 1
+            for change in pending:
+                if change is None:
+                    self.loaded_key = None
+                    self.status = {}
+                    continue
+                uid, record_time, is_extra_time, remain_next_chance = change
+                if not self.loaded_key or not self.loaded_key[0] < record_time < self.loaded_key[1]:
+                    continue
+                if not uid in self.status:
+                    self.status[uid] = TodayBattleStatus(
+                        uid, 0, 0, 0, False, False)
+                status = self.status[uid]
+                if is_extra_time is None:
+                    status.use_sl = True
+                    continue
+                if is_extra_time:
+                    status.addition_challeng += 1
+                    status.remain_addition_challeng -= 1
+                else:
+                    status.today_challenged += 1
+                if remain_next_chance:
+                    status.remain_addition_challeng += 1
+                status.last_is_addition = is_extra_time
+
+    # 返回 uid -> 状态的副本，uids 为 None 时返回当天所有有记录的成员
+    def get_status_dict(self, uids: List[str] = None) -> Dict[str, TodayBattleStatus]:
+        start_time, end_time = self.clan.get_today_datetime()
+        key = (start_time, end_time, self.clan.clan_info.current_using_data_num)
+        with self.lock:
+            # 有未应用的变化时，加载的结果可能已经包含也可能没有包含这些变化
+            generation = None if self.pending else self.generation
+            status = self.status if self.loaded_key == key else None
+            if status is not None:
+                status = {uid: copy.copy(item) for uid, item in status.items()
+                          if uids is None or uid in uids}
+        if status is None:
+            status = self.clan.get_record_status_dict(
+                None, start_time, end_time)
+            with self.lock:
+                if generation == self.generation:
+                    self.status = {uid: copy.copy(item)
+                                   for uid, item in status.items()}
+                    self.loaded_key = key
+        if get_config().today_status_check:
+            self.check(status, uids, start_time, end_time)
+        for uid in (uids or []):
+            if not uid in status:
+                status[uid] = TodayBattleStatus(uid, 0, 0, 0, False, False)
+        return status
+
+    # 检查模式下与数据库的聚合查询结果比较，不一致时输出并重新加载，返回不一致的成员
+    def check(self, status: Dict[str, TodayBattleStatus], uids: List[str], start_time: datetime.datetime, end_time: datetime.datetime) -> List[str]:
+        def get_values(item: TodayBattleStatus):
+            return (item.today_challenged, item.addition_challeng, item.remain_addition_challeng,
+                    item.last_is_addition, item.use_sl) if item else (0, 0, 0, False, False)
+
+        sql_status = self.clan.get_record_status_dict(
+            uids, start_time, end_time)
+        mismatch = [uid for uid in set(status) | set(sql_status)
+                    if get_values(status.get(uid)) != get_values(sql_status.get(uid))]
+        if mismatch:
+            print(
+                f"YukiClanbattle: Today status of clan {self.clan.clan_info.clan_gid} mismatch: {mismatch}")
+            self.reset()
+            status.clear()
+            status.update(sql_status)
+        return mismatch
+
+
 class ClanBattleData:
 
-    cache = {}
+    # 已加载的公会，用于修改昵称等跨公会的数据变化时使缓存失效
+    loaded_clans: "weakref.WeakValueDictionary[str, ClanBattleData]" = weakref.WeakValueDictionary()
 
     def __init__(self, gid: str) -> None:
         clan: ClanInfo = ClanInfo.get(ClanInfo.clan_gid == gid)
         if not clan:
             raise ClanBattleException("公会不存在")
         self.clan_info = clan
+        # 每次写操作后递增，缓存项只在版本一致时有效
+        self.state_version = 0
+        # 版本号只在当前进程内有效，生成 ETag 时带上实例标识，避免重启后与旧版本号冲突
+        self.instance_id = uuid.uuid4().hex[:8]
+        self.cache = LRUCache()
+        # 数据变化时在数据库线程中调用，参数为新的版本号
+        self.state_listeners: List[Callable[[int], None]] = []
+        # 昵称表，uid -> 昵称，修改昵称和加入成员时清空
+        self.user_names: Dict[str, str] = {}
+        self.user_names_generation = 0
+        self.user_names_lock = threading.Lock()
+        self.today_status = TodayStatusTracker(self)
+        ClanBattleData.loaded_clans[gid] = self
 
     def cache_return(get_func):
 
         @wraps(get_func)
-        def decorated(*args, **kwargs):
-            return get_func(*args, **kwargs)
-            cache_key = str(args) + str(kwargs) + str(get_func)
-            cache_obj: dict = args[0].cache
-            cache_res = cache_obj.get(cache_key, "@*^")
-            if cache_res != "@*^":
-                #print("cache hit")
-                return cache_res
-            else:
-                result = get_func(*args, **kwargs)
-                cache_obj[cache_key] = result
-                #print("cache not hit")
-                return result
+        def decorated(self, *args, **kwargs):
+            # 事务中可能读到未提交的数据，不使用也不写入缓存
+            if sqlite_db.in_transaction():
+                result = get_func(self, *args, **kwargs)
+                return list(result) if isinstance(result, list) else result
+            cache_key = get_func.__name__ + str(args) + str(sorted(kwargs.items()))
+            version = self.state_version
+            is_hit, result = self.cache.get(cache_key, version)
+            if not is_hit:
+                result = get_func(self, *args, **kwargs)
+                self.cache.set(cache_key, version, result)
+            # 返回列表副本，避免调用方修改缓存内容
+            return list(result) if isinstance(result, list) else result
 
         return decorated
 
     def clear_cache(get_func):
 
         @wraps(get_func)
-        def decorated(*args, **kwargs):
-            ret = get_func(*args, **kwargs)
-            args[0].cache = {}
-            return ret
+        def decorated(self, *args, **kwargs):
+            try:
+                ret = get_func(self, *args, **kwargs)
+            except:
+                if not sqlite_db.in_transaction():
+                    self.today_status.discard_pending()
+                raise
+            else:
+                if not sqlite_db.in_transaction():
+                    self.today_status.apply_pending()
+                return ret
+            finally:
+                # 嵌套在外层事务中时由最外层在提交后递增版本，避免其他线程在提交前以新版本缓存旧数据
+                if not sqlite_db.in_transaction():
+                    self.bump_state_version()
 
         return decorated
 
+    # 整个方法在同一个事务中执行，需要放在 clear_cache 之下，保证提交后再使缓存失效
+    # 写事务使用 IMMEDIATE 在开始时获取写锁，避免先读后写时因其他线程已写入而直接返回 database is locked
+    def in_transaction(func):
+
+        @wraps(func)
+        def decorated(self, *args, **kwargs):
+            with sqlite_db.atomic("IMMEDIATE"):
+                return func(self, *args, **kwargs)
+
+        return decorated
+
+    def bump_state_version(self):
+        with self.cache.lock:
+            self.state_version += 1
+            self.cache.items.clear()
+            version = self.state_version
+        for listener in list(self.state_listeners):
+            try:
+                listener(version)
+            except Exception as e:
+                print(f"YukiClanbattle: State listener error: {e}")
+
+    # 剩余刀数等当天状态在每天5点切换时变化，但数据版本不变，ETag 中带上当前会战日
+    def get_state_etag(self, name: str) -> str:
+        battle_day = self.get_today_datetime()[0].strftime("%Y%m%d")
+        return f'W/"{name}-{self.clan_info.clan_gid}-{self.instance_id}-{self.state_version}-{battle_day}"'
+
+    def get_cache_stats(self) -> Dict[str, int]:
+        return self.cache.get_stats()
+
     @staticmethod
     def get_db_strlist_list(text_field: TextField) -> List[str]:
         return str(text_field).split("|") if text_field else []
@@ -199,13 +520,40 @@ class ClanBattleData:
 
     @staticmethod
     def create_clan(gid: str, clan_name: str, clan_type: str, clan_admin: List[str]):
-        ClanInfo.create(clan_gid=gid, clan_name=clan_name, create_time=datetime.datetime.utcnow(),
-                        clan_type=clan_type, clan_admin=ClanBattleData.get_db_strlist_str(clan_admin))
+        with sqlite_db.atomic("IMMEDIATE"):
+            ClanInfo.create(clan_gid=gid, clan_name=clan_name, create_time=datetime.datetime.utcnow(),
+                            clan_type=clan_type, clan_admin="")
+            if clan_admin:
+                ClanAdmin.insert_many([(gid, uid) for uid in set(clan_admin)], fields=[
+                                      ClanAdmin.clan_gid, ClanAdmin.uid]).execute()
 
+    battle_data_models = (("record", BattleRecord), ("in_progress", BattleInProgress), ("sl", BattleSL),
+                          ("subscribe", BattleSubscribe), ("on_tree", BattleOnTree), ("boss_state", BossState))
+
+    # 在一个事务中按公会和档案批量删除会战数据，不指定 data_num 时删除全部档案，返回每类数据删除的行数
+    @staticmethod
+    def delete_battle_data(gid: str, data_num: int = None) -> Dict[str, int]:
+        deleted = {}
+        with sqlite_db.atomic("IMMEDIATE"):
+            for name, model in ClanBattleData.battle_data_models:
+                qry = model.delete().where(model.clan_gid == gid)
+                if data_num:
+                    qry = qry.where(model.using_data_num == data_num)
+                deleted[name] = qry.execute()
+        return deleted
+
+    # 删除公会以及所有档案的会战数据，返回每类数据删除的行数
     @staticmethod
-    def delete_clan(gid: str):
-        qry = ClanInfo.delete().where(ClanInfo.clan_gid == gid)
-        qry.execute()
+    def delete_clan(gid: str) -> Dict[str, int]:
+        with sqlite_db.atomic("IMMEDIATE"):
+            deleted = ClanBattleData.delete_battle_data(gid)
+            deleted["member"] = ClanMembership.delete().where(
+                ClanMembership.clan_gid == gid).execute()
+            ClanAdmin.delete().where(ClanAdmin.clan_gid == gid).execute()
+            qry = ClanInfo.delete().where(ClanInfo.clan_gid == gid)
+            qry.execute()
+        session_cache.clear()
+        return deleted
 
     @staticmethod
     def get_user_info(uid: str) -> User:
@@ -224,8 +572,36 @@ class ClanBattleData:
             return False
         user.uname = uname
         user.save()
+        for clan in list(ClanBattleData.loaded_clans.values()):
+            clan.invalidate_user_names()
+            clan.bump_state_version()
         return True
 
+    # 批量获取昵称，未缓存的用户用一条 IN 查询获取
+    def get_user_names(self, uids: List[str]) -> Dict[str, str]:
+        with self.user_names_lock:
+            generation = self.user_names_generation
+            names = {uid: self.user_names[uid]
+                     for uid in uids if uid in self.user_names}
+        missing = list(set(uids) - set(names.keys()))
+        if not missing:
+            return names
+        # 没有用户记录或没有设置昵称时使用uid
+        missing_names = {uid: uid for uid in missing}
+        for batch in chunked(missing, 500):
+            for user in User.select(User.qq_uid, User.uname).where(User.qq_uid.in_(batch)):
+                missing_names[user.qq_uid] = user.uname or user.qq_uid
+        with self.user_names_lock:
+            if generation == self.user_names_generation:
+                self.user_names.update(missing_names)
+        names.update(missing_names)
+        return names
+
+    def invalidate_user_names(self):
+        with self.user_names_lock:
+            self.user_names_generation += 1
+            self.user_names.clear()
+
     def get_today_datetime(self) -> Tuple[datetime.datetime, datetime.datetime]:
         start_time = None
         end_time = None
@@ -242,28 +618,32 @@ class ClanBattleData:
             end_time = now_time_today + datetime.timedelta(hours=29) - detla
         return (start_time, end_time)
 
-    @cache_return
     def get_clan_members(self) -> List[str]:
-        return self.get_db_strlist_list(self.clan_info.clan_members)
+        members = ClanMembership.select(ClanMembership.uid).where(
+            ClanMembership.clan_gid == self.clan_info.clan_gid).order_by(ClanMembership.id)
+        return [member.uid for member in members]
 
     @cache_return
     def get_clan_members_with_info(self) -> List[MemberInfo]:
-        member_list = self.get_db_strlist_list(self.clan_info.clan_members)
+        users = User.select(User.qq_uid, User.uname).join(ClanMembership, on=(ClanMembership.uid == User.qq_uid)).where(
+            ClanMembership.clan_gid == self.clan_info.clan_gid).order_by(ClanMembership.id)
         ret_list = []
-        for member in member_list:
-            user: User = self.get_user_info(member)
-            member_info = MemberInfo(member, str(user.uname))
+        for user in users:
+            member_info = MemberInfo(user.qq_uid, str(user.uname))
             ret_list.append(member_info)
         return ret_list
 
-    @cache_return
     def get_current_clanbattle_data(self) -> int:
         return self.clan_info.current_using_data_num
 
     @clear_cache
     def set_clan_members(self, members: List[str]):
-        self.clan_info.clan_members = self.get_db_strlist_str(members)
-        self.clan_info.save()
+        with sqlite_db.atomic("IMMEDIATE"):
+            ClanMembership.delete().where(ClanMembership.clan_gid == self.clan_info.clan_gid).execute()
+            if members:
+                ClanMembership.insert_many([(self.clan_info.clan_gid, uid) for uid in dict.fromkeys(members)], fields=[
+                                           ClanMembership.clan_gid, ClanMembership.uid]).execute()
+        session_cache.clear()
 
     @clear_cache
     def set_clan_name(self, clan_name: str):
@@ -281,28 +661,9 @@ class ClanBattleData:
         self.clan_info.save()
 
     @clear_cache
-    def clear_current_clanbattle_data(self):
-        clan_record = self.get_record()
-        if clan_record:
-            for record in clan_record:
-                record.delete_instance()
-        clan_in_progress = self.get_battle_in_progress()
-        if clan_in_progress:
-            for in_progress in clan_in_progress:
-                in_progress.delete_instance()
-        clan_sl = BattleSL.select().where((BattleSL.clan_gid == self.clan_info.clan_gid)
-                                          & (BattleSL.using_data_num == self.clan_info.current_using_data_num))
-        if clan_sl:
-            for sl in clan_sl:
-                sl.delete_instance()
-        clan_battle_subscribe = self.get_battle_subscribe()
-        if clan_battle_subscribe:
-            for battle_subscribe in clan_battle_subscribe:
-                battle_subscribe.delete_instance()
-        battle_on_tree = self.get_battle_on_tree()
-        if battle_on_tree:
-            for on_tree in battle_on_tree:
-                on_tree.delete_instance()
+    def clear_current_clanbattle_data(self) -> Dict[str, int]:
+        self.today_status.invalidate()
+        return self.delete_battle_data(self.clan_info.clan_gid, self.clan_info.current_using_data_num)
 
     @clear_cache
     def rename_clan(self, name: str):
@@ -311,58 +672,51 @@ class ClanBattleData:
 
     @clear_cache
     def add_clan_member(self, uid: str, name: str) -> bool:
-        if not self.get_user_info(uid):
-            User.create(qq_uid=uid, uname=name,
-                        clan_joined=self.clan_info.clan_gid)
-            member_list = self.get_clan_members()
-            member_list.append(uid)
-            self.set_clan_members(member_list)
-            return True
-        else:
-            members = self.get_clan_members()
-            if uid in members:
-                return False
-            user = self.get_user_info(uid)
-            joined_clan = self.get_db_strlist_list(user.clan_joined)
-            joined_clan.append(self.clan_info.clan_gid)
-            user.clan_joined = self.get_db_strlist_str(joined_clan)
-            user.save()
-            members.append(uid)
-            self.set_clan_members(members)
-            return True
+        return self.add_clan_members([(uid, name)]) == 1
+
+    # 批量加入成员，members 为 (uid, 昵称) 列表，返回新加入的成员数量
+    @clear_cache
+    def add_clan_members(self, members: List[Tuple[str, str]]) -> int:
+        members = list(dict(members).items())
+        if not members:
+            return 0
+        with sqlite_db.atomic("IMMEDIATE"):
+            User.insert_many(members, fields=[User.qq_uid, User.uname]).on_conflict_ignore().execute()
+            joined = set(member.uid for member in ClanMembership.select(ClanMembership.uid).where(
+                (ClanMembership.clan_gid == self.clan_info.clan_gid) & (ClanMembership.uid.in_([uid for uid, _ in members]))))
+            new_members = [(self.clan_info.clan_gid, uid) for uid, _ in members if not uid in joined]
+            if new_members:
+                ClanMembership.insert_many(new_members, fields=[
+                                           ClanMembership.clan_gid, ClanMembership.uid]).execute()
+        for _, uid in new_members:
+            session_cache.invalidate_uid(uid)
+        self.invalidate_user_names()
+        return len(new_members)
 
     @clear_cache
     def delete_clan_member(self, uid: str) -> bool:
-        if not (user := self.get_user_info(uid)):
-            return False
-        joined_clan = self.get_db_strlist_list(user.clan_joined)
-        if not self.clan_info.clan_gid in joined_clan:
-            return False
-        joined_clan.remove(self.clan_info.clan_gid)
-        user.clan_joined = self.get_db_strlist_str(joined_clan)
-        user.save()
-        members = self.get_clan_members()
-        members.remove(uid)
-        self.set_clan_members(members)
-        return True
+        deleted = ClanMembership.delete().where((ClanMembership.clan_gid == self.clan_info.clan_gid)
+                                                & (ClanMembership.uid == uid)).execute()
+        session_cache.invalidate_uid(uid)
+        return deleted > 0
 
     @clear_cache
     def refresh_clan_admin(self, admins: List[str]):
-        clan = self.clan_info
-        clan.clan_admin = self.get_db_strlist_str(admins)
-        clan.save()
+        with sqlite_db.atomic("IMMEDIATE"):
+            ClanAdmin.delete().where(ClanAdmin.clan_gid == self.clan_info.clan_gid).execute()
+            if admins:
+                ClanAdmin.insert_many([(self.clan_info.clan_gid, uid) for uid in set(admins)], fields=[
+                                      ClanAdmin.clan_gid, ClanAdmin.uid]).execute()
+
+    @clear_cache
+    def add_clan_admin(self, uid: str):
+        ClanAdmin.insert(clan_gid=self.clan_info.clan_gid,
+                         uid=uid).on_conflict_ignore().execute()
 
-    @cache_return
     def check_joined_clan(self, uid: str) -> bool:
-        user = self.get_user_info(uid)
-        if not user:
-            return False
-        db_list = self.get_db_strlist_list(user.clan_joined)
-        if not user or not self.clan_info.clan_gid in db_list:
-            return False
-        return True
+        return ClanMembership.select().where((ClanMembership.clan_gid == self.clan_info.clan_gid)
+                                             & (ClanMembership.uid == uid)).exists()
 
-    @cache_return
     def get_record(self, uid: str = None, boss: int = None, cycle: int = None, start_time: datetime.datetime = None, end_time: datetime.datetime = None, num: int = None, time_desc: bool = False) -> List[BattleRecord]:
         res = BattleRecord.select().where((BattleRecord.clan_gid == self.clan_info.clan_gid)
                                           & (BattleRecord.using_data_num == self.clan_info.current_using_data_num))
@@ -382,6 +736,62 @@ class ClanBattleData:
             res = res.limit(num)
         return res if res else None
 
+    # 分页查询出刀记录，按时间倒序排列，cursor 为上一页最后一条记录的 (record_time, id)
+    # record_type: normal 完整刀，extra 补偿刀，kill 尾刀
+    # 返回 (当前页记录, 符合条件的记录总数, 下一页的 cursor)
+    def query_record_page(self, uid: str = None, boss: int = None, cycle: int = None, start_time: datetime.datetime = None, end_time: datetime.datetime = None, record_type: str = None, cursor: Tuple[datetime.datetime, int] = None, limit: int = 100) -> Tuple[List[BattleRecord], int, Optional[Tuple[datetime.datetime, int]]]:
+        res = BattleRecord.select().where((BattleRecord.clan_gid == self.clan_info.clan_gid)
+                                          & (BattleRecord.using_data_num == self.clan_info.current_using_data_num))
+        if uid:
+            res = res.where((BattleRecord.member_uid == uid))
+        if boss:
+            res = res.where((BattleRecord.target_boss == boss))
+        if cycle:
+            res = res.where((BattleRecord.target_cycle == cycle))
+        if start_time:
+            res = res.where((BattleRecord.record_time > start_time))
+        if end_time:
+            res = res.where((BattleRecord.record_time < end_time))
+        if record_type == "normal":
+            res = res.where((BattleRecord.is_extra_time == False)
+                            & (BattleRecord.remain_next_chance == False))
+        elif record_type == "extra":
+            res = res.where((BattleRecord.is_extra_time == True))
+        elif record_type == "kill":
+            res = res.where((BattleRecord.remain_next_chance == True))
+        total = res.count()
+        if cursor:
+            res = res.where((BattleRecord.record_time < cursor[0]) | (
+                (BattleRecord.record_time == cursor[0]) & (BattleRecord.id < cursor[1])))
+        records = list(res.order_by(BattleRecord.record_time.desc(),
+                       BattleRecord.id.desc()).limit(limit + 1))
+        next_cursor = None
+        if len(records) > limit:
+            records = records[:limit]
+            next_cursor = (records[-1].record_time, records[-1].id)
+        return (records, total, next_cursor)
+
+    export_record_fields = ["id", "member_uid", "uname", "record_time", "target_cycle", "target_boss", "boss_hp",
+                            "damage", "is_extra_time", "remain_next_chance", "comment", "proxy_report_uid"]
+
+    # 按 (record_time, id) 顺序分批读取一个会战档案的出刀记录用于导出，成员昵称在同一次查询中联表取出
+    # cursor 为上一批最后一条记录的 (record_time, id)，字段顺序与 export_record_fields 一致
+    def get_export_record_chunk(self, data_num: int = None, cursor: Tuple[datetime.datetime, int] = None, chunk_size: int = 1000) -> List[tuple]:
+        if not data_num:
+            data_num = self.clan_info.current_using_data_num
+        res = (BattleRecord.select(BattleRecord.id, BattleRecord.member_uid, User.uname, BattleRecord.record_time,
+                                   BattleRecord.target_cycle, BattleRecord.target_boss, BattleRecord.boss_hp,
+                                   BattleRecord.damage, BattleRecord.is_extra_time, BattleRecord.remain_next_chance,
+                                   BattleRecord.comment, BattleRecord.proxy_report_uid)
+               .join(User, JOIN.LEFT_OUTER, on=(BattleRecord.member_uid == User.qq_uid))
+               .where((BattleRecord.clan_gid == self.clan_info.clan_gid)
+                      & (BattleRecord.using_data_num == data_num)))
+        if cursor:
+            # record_time >= 让查询可以从索引中直接定位到上一批结束的位置
+            res = res.where((BattleRecord.record_time >= cursor[0])
+                            & ((BattleRecord.record_time > cursor[0]) | (BattleRecord.id > cursor[1])))
+        return list(res.order_by(BattleRecord.record_time, BattleRecord.id).limit(chunk_size).tuples())
+
     def get_today_record(self, uid: str = None, boss: int = None, cycle: int = None, num: int = None) -> List[BattleRecord]:
         start_time = None
         end_time = None
@@ -390,7 +800,6 @@ class ClanBattleData:
         end_time = today_time[1]
         return self.get_record(uid, boss, cycle, start_time, end_time, num)
 
-    @cache_return
     def get_recent_record(self, uid: str = None, boss: int = None, num: int = 1) -> List[BattleRecord]:
         return self.get_record(uid=uid, boss=boss, num=num, time_desc=True)
 
@@ -404,7 +813,7 @@ class ClanBattleData:
             progresses = progresses.where(
                 (BattleInProgress.target_boss == boss))
         ret_list = []
-        for progress in progresses:
+        for progress in progresses.order_by(BattleInProgress.id):
             ret_list.append(progress)
         return ret_list
 
@@ -421,7 +830,7 @@ class ClanBattleData:
             subscribes = subscribes.where(
                 (BattleSubscribe.target_cycle == boss_cycle))
         ret_list = []
-        for subscribe in subscribes:
+        for subscribe in subscribes.order_by(BattleSubscribe.id):
             ret_list.append(subscribe)
         return ret_list
 
@@ -434,11 +843,10 @@ class ClanBattleData:
         if boss:
             progresses = progresses.where((BattleOnTree.target_boss == boss))
         ret_list = []
-        for progress in progresses:
+        for progress in progresses.order_by(BattleOnTree.id):
             ret_list.append(progress)
         return ret_list
 
-    @cache_return
     def get_battle_sl(self, uid: str = None, boss: int = None, boss_cycle: int = None, start_time: datetime.datetime = None, end_time: datetime.datetime = None) -> List[BattleSL]:
         sls = BattleSL.select().where((BattleSL.clan_gid == self.clan_info.clan_gid) & (
             BattleSL.using_data_num == self.clan_info.current_using_data_num) & (BattleSL.record_time > start_time) & (BattleSL.record_time < end_time))
@@ -477,25 +885,120 @@ class ClanBattleData:
 
     @clear_cache
     def create_new_battle_sl(self, uid: str, target_cycle: int, target_boss: int, comment: str, proxy_report_uid: str):
-        BattleSL.create(clan_gid=self.clan_info.clan_gid, member_uid=uid, record_time=datetime.datetime.utcnow(),
-                        using_data_num=self.clan_info.current_using_data_num, comment=comment,
-                        target_cycle=target_cycle, target_boss=target_boss,
-                        proxy_report_uid=proxy_report_uid)
+        sl = BattleSL.create(clan_gid=self.clan_info.clan_gid, member_uid=uid, record_time=datetime.datetime.utcnow(),
+                             using_data_num=self.clan_info.current_using_data_num, comment=comment,
+                             target_cycle=target_cycle, target_boss=target_boss,
+                             proxy_report_uid=proxy_report_uid)
+        self.today_status.sl_added(uid, sl.record_time)
 
     @clear_cache
     def create_new_record(self, uid: str, target_cycle: int, target_boss: int, damage: int, boss_hp: int, comment: str, is_extra_time: bool, remain_next_chance: bool, proxy_report_uid: str):
-        BattleRecord.create(clan_gid=self.clan_info.clan_gid, member_uid=uid, record_time=datetime.datetime.utcnow(),
-                            target_cycle=target_cycle, target_boss=target_boss, using_data_num=self.clan_info.current_using_data_num, damage=damage, boss_hp=boss_hp, comment=comment,
-                            is_extra_time=is_extra_time, remain_next_chance=remain_next_chance, proxy_report_uid=proxy_report_uid)
+        with sqlite_db.atomic("IMMEDIATE"):
+            record = BattleRecord.create(clan_gid=self.clan_info.clan_gid, member_uid=uid, record_time=datetime.datetime.utcnow(),
+                                         target_cycle=target_cycle, target_boss=target_boss, using_data_num=self.clan_info.current_using_data_num, damage=damage, boss_hp=boss_hp, comment=comment,
+                                         is_extra_time=is_extra_time, remain_next_chance=remain_next_chance, proxy_report_uid=proxy_report_uid)
+            self.save_boss_state(target_boss, record)
+        self.today_status.record_added(
+            uid, record.record_time, is_extra_time, remain_next_chance)
+
+    # 解析导入文件，支持 csv（第一行为字段名）、json（数组）和 ndjson，字段与导出文件一致
+    @staticmethod
+    def parse_import_content(content: str, file_format: str) -> List[dict]:
+        content = content.lstrip("\ufeff")
+        if file_format == "csv":
+            return list(csv.DictReader(io.StringIO(content)))
+        elif file_format == "json":
+            rows = json.loads(content)
+            if not isinstance(rows, list):
+                raise ClanBattleException("json文件内容应为记录数组")
+            return rows
+        elif file_format == "ndjson":
+            return [json.loads(line) for line in content.splitlines() if line.strip()]
+        raise ClanBattleException("不支持该导入格式")
+
+    # 校验并转换一条导入的记录，没有 boss_hp 时按同一boss同一周目的记录顺序推算
+    def parse_import_row(self, row: dict, remain_hp: Dict[Tuple[int, int], int], members: Set[str]) -> dict:
+        def get_value(key: str):
+            value = row.get(key)
+            return None if value is None or str(value).strip() == "" else value
+
+        def get_bool(key: str) -> bool:
+            value = get_value(key)
+            if isinstance(value, bool) or value is None:
+                return bool(value)
+            return str(value).strip().lower() in ["1", "true", "yes", "是"]
+
+        uid = get_value("member_uid")
+        if not uid:
+            raise ClanBattleException("缺少member_uid")
+        if not str(uid) in members:
+            raise ClanBattleException(f"{uid}不是公会成员")
+        record_time = get_value("record_time")
+        if not record_time:
+            raise ClanBattleException("缺少record_time")
+        record_time = datetime.datetime.fromisoformat(str(record_time))
+        target_boss = int(get_value("target_boss"))
+        target_cycle = int(get_value("target_cycle"))
+        if not 1 <= target_boss <= 5 or target_cycle < 1:
+            raise ClanBattleException("boss或周目超出范围")
+        max_hp = self.boss_table.get_max_hp(
+            self.get_cycle_stage(target_cycle), target_boss)
+        damage = self.parse_damage(str(get_value("damage")))
+        if get_value("boss_hp") is not None:
+            boss_hp = int(get_value("boss_hp"))
+        else:
+            boss_hp = remain_hp.get((target_boss, target_cycle), max_hp)
+            damage = min(damage, boss_hp)
+        if damage < 0 or boss_hp <= 0 or boss_hp > max_hp or damage > boss_hp:
+            raise ClanBattleException("伤害或boss生命值不正确")
+        remain_hp[(target_boss, target_cycle)] = boss_hp - damage
+        return {"clan_gid": self.clan_info.clan_gid, "member_uid": str(uid), "record_time": record_time,
+                "using_data_num": self.clan_info.current_using_data_num, "target_cycle": target_cycle,
+                "target_boss": target_boss, "boss_hp": boss_hp, "damage": damage, "comment": get_value("comment"),
+                "is_extra_time": get_bool("is_extra_time"), "remain_next_chance": get_bool("remain_next_chance"),
+                "proxy_report_uid": get_value("proxy_report_uid")}
+
+    # 批量导入出刀记录到当前会战档案，全部校验通过后才会写入
+    # 校验和写入在同一个事务中，中途出错时不会留下部分记录，返回 (导入的记录数, 错误信息列表)
+    @clear_cache
+    @in_transaction
+    def import_records(self, rows: List[dict], chunk_size: int = 500) -> Tuple[int, List[str]]:
+        # 没有 boss_hp 的记录从boss当前的状态开始计算剩余生命值
+        remain_hp = {(status.target_boss, status.target_cycle): status.boss_hp
+                     for status in self.get_current_boss_state()}
+        members = set(self.get_clan_members())
+        records = []
+        errors = []
+        for i, row in enumerate(rows):
+            try:
+                records.append(self.parse_import_row(
+                    row, remain_hp, members))
+            except (ClanBattleException, ClanBattleDamageParseException, ValueError, TypeError) as e:
+                errors.append(f"第{i+1}条记录：{e}")
+            if len(errors) >= 20:
+                break
+        if errors:
+            return (0, errors)
+        for batch in chunked(records, chunk_size):
+            BattleRecord.insert_many(batch).execute()
+        # 写入全部记录后统一重新计算一次boss状态
+        for boss in range(1, 6):
+            self.refresh_boss_state(boss)
+        self.today_status.invalidate()
+        return (len(records), [])
 
     @clear_cache
     def delete_recent_record(self, uid: str, boss_count=None) -> bool:
-        record = self.get_recent_record(uid=uid, boss=boss_count)
-        if not record:
-            return False
-        else:
-            record[0].delete_instance()
-            return True
+        with sqlite_db.atomic("IMMEDIATE"):
+            record = self.get_recent_record(uid=uid, boss=boss_count)
+            if not record:
+                return False
+            else:
+                target_boss = record[0].target_boss
+                record[0].delete_instance()
+                self.today_status.invalidate()
+                self.refresh_boss_state(target_boss)
+                return True
 
     @clear_cache
     def delete_battle_in_progress(self, uid: str) -> bool:
@@ -544,42 +1047,93 @@ class ClanBattleData:
             on_tree_item.save()
         return True
 
+    # 聚合查询指定时间段内成员的出刀状态，返回 uid -> 状态，默认查询今天
+    # 出刀记录和SL各一条查询，不再按成员逐个查询
+    def get_record_status_dict(self, uids: List[str] = None, start_time: datetime.datetime = None, end_time: datetime.datetime = None) -> Dict[str, TodayBattleStatus]:
+        if not (start_time and end_time):
+            start_time, end_time = self.get_today_datetime()
+        records = BattleRecord.select(BattleRecord.member_uid,
+                                      fn.SUM(Case(None, [(BattleRecord.is_extra_time == False, 1)], 0)).alias(
+                                          "total_challenge"),
+                                      fn.SUM(Case(None, [(BattleRecord.is_extra_time == True, 1)], 0)).alias(
+                                          "addition_challeng"),
+                                      fn.SUM(Case(None, [(BattleRecord.remain_next_chance == True, 1)], 0)).alias(
+                                          "remain_next_chance"),
+                                      # SQLite 中与 MAX 同时查询的列取自最后一条记录
+                                      fn.MAX(BattleRecord.record_time).alias(
+                                          "last_time"),
+                                      BattleRecord.is_extra_time.alias("last_is_extra_time")).where(
+            (BattleRecord.clan_gid == self.clan_info.clan_gid)
+            & (BattleRecord.using_data_num == self.clan_info.current_using_data_num)
+            & (BattleRecord.record_time > start_time) & (BattleRecord.record_time < end_time))
+        sls = BattleSL.select(BattleSL.member_uid).distinct().where(
+            (BattleSL.clan_gid == self.clan_info.clan_gid)
+            & (BattleSL.using_data_num == self.clan_info.current_using_data_num)
+            & (BattleSL.record_time > start_time) & (BattleSL.record_time < end_time))
+        if uids is not None:
+            records = records.where(BattleRecord.member_uid.in_(uids))
+            sls = sls.where(BattleSL.member_uid.in_(uids))
+        sl_uid_set = set(sl.member_uid for sl in sls)
+        status_dict = {}
+        for record in records.group_by(BattleRecord.member_uid).dicts():
+            uid = record["member_uid"]
+            status_dict[uid] = TodayBattleStatus(uid, record["total_challenge"], record["addition_challeng"],
+                                                 record["remain_next_chance"] -
+                                                 record["addition_challeng"],
+                                                 bool(record["last_is_extra_time"]), uid in sl_uid_set)
+        for uid in (uids if uids is not None else sl_uid_set):
+            if not uid in status_dict:
+                status_dict[uid] = TodayBattleStatus(
+                    uid, 0, 0, 0, False, uid in sl_uid_set)
+        return status_dict
+
     def get_record_status(self, uid: str, start_time: datetime.datetime = None, end_time: datetime.datetime = None) -> TodayBattleStatus:
-        records = self.get_record(uid=uid, start_time=start_time, end_time=end_time) if (
-            start_time and end_time) else self.get_today_record(uid)
-        total_challenge = 0
-        addition_challeng = 0
-        remain_addition_challeng = 0
-        is_exta_time = False
-        if start_time and end_time:
-            is_sl = True if self.get_battle_sl(
-                uid=uid, start_time=start_time, end_time=end_time) else False
-        else:
-            is_sl = True if self.get_today_battle_sl(uid=uid) else False
-        if not records or len(records) == 0:
-            return TodayBattleStatus(uid, 0, 0, 0, False, is_sl)
-        for record in records:
-            if record.remain_next_chance:
-                remain_addition_challeng += 1
-            if not record.is_extra_time:
-                total_challenge += 1
-            else:
-                addition_challeng += 1
-                remain_addition_challeng -= 1
-        if records[len(records)-1].is_extra_time:
-            is_exta_time = True
-        return TodayBattleStatus(uid, total_challenge, addition_challeng, remain_addition_challeng, is_exta_time, is_sl)
+        return self.get_record_status_dict([uid], start_time, end_time)[uid]
 
+    # 使用内存中的当天出刀状态
     def get_today_record_status(self, uid: str) -> TodayBattleStatus:
-        return self.get_record_status(uid)
+        return self.today_status.get_status_dict([uid])[uid]
+
+    def get_member_record_status(self, start_time: datetime.datetime = None, end_time: datetime.datetime = None) -> List[TodayBattleStatus]:
+        members = self.get_clan_members()
+        status_dict = self.get_record_status_dict(None, start_time, end_time)
+        return [status_dict.get(member, TodayBattleStatus(member, 0, 0, 0, False, False)) for member in members]
 
     def get_today_member_status(self) -> List[TodayBattleStatus]:
-        ret_status = []
         members = self.get_clan_members()
-        for member in members:
-            status = self.get_today_record_status(member)
-            ret_status.append(status)
-        return ret_status
+        status_dict = self.today_status.get_status_dict(members)
+        return [status_dict[member] for member in members]
+
+    @staticmethod
+    def group_by_boss(items: List[BaseModel]) -> Dict[str, List[dict]]:
+        ret_dict = {str(i): [] for i in range(1, 6)}
+        for item in items:
+            ret_dict[str(item.target_boss)].append(model_to_dict(item))
+        return ret_dict
+
+    # 网页面板推送使用的数据，每张表只查询一次，出刀中、挂树、预约按boss分组
+    def get_web_status(self) -> Dict[str, Any]:
+        today_record = self.get_today_record()
+        return {
+            "boss_status": self.get_current_boss_state(),
+            "queue": self.group_by_boss(self.get_battle_in_progress()),
+            "on_tree": self.group_by_boss(self.get_battle_on_tree()),
+            "subscribe": self.group_by_boss(self.get_battle_subscribe()),
+            "record": [model_to_dict(record) for record in today_record] if today_record else [],
+        }
+
+    # 网页面板首页的全部数据，每张表只查询一次
+    def get_dashboard(self) -> Dict[str, Any]:
+        return {
+            "boss_status": self.get_current_boss_state(),
+            "member_list": self.get_clan_members_with_info(),
+            "queue": self.group_by_boss(self.get_battle_in_progress()),
+            "on_tree": self.group_by_boss(self.get_battle_on_tree()),
+            "subscribe": self.group_by_boss(self.get_battle_subscribe()),
+            "data_num": self.clan_info.current_using_data_num,
+            "area": self.clan_info.clan_type,
+            "clan_name": self.clan_info.clan_name,
+        }
 
     # 完整刀 补偿刀
     def get_today_record_status_total(self) -> Tuple[int, int]:
@@ -599,61 +1153,78 @@ class ClanBattleData:
                 next_chance_challenge -= 1
         return (total_challenge, next_chance_challenge)
 
-    @cache_return
     def check_admin_permission(self, uid: str) -> bool:
-        admins = self.get_db_strlist_list(self.clan_info.clan_admin)
-        if uid in admins:
-            return True
-        return False
+        return ClanAdmin.select().where((ClanAdmin.clan_gid == self.clan_info.clan_gid)
+                                        & (ClanAdmin.uid == uid)).exists()
+
+    @property
+    def boss_table(self) -> BossTable:
+        return boss_tables[self.clan_info.clan_type]
 
-    @cache_return
     def get_cycle_stage(self, cycle: int) -> int:
-        max_cycle = len(boss_info["cycle"][self.clan_info.clan_type])
-        for i in range(len(boss_info["cycle"][self.clan_info.clan_type])):
-            if max_cycle - 1 == i and cycle >= boss_info["cycle"][self.clan_info.clan_type][i]:
-                return i+1
-            elif max_cycle != i and cycle >= boss_info["cycle"][self.clan_info.clan_type][i] and cycle < boss_info["cycle"][self.clan_info.clan_type][i+1]:
-                return i+1
-        raise ClanBattleException("cycle error")
+        return self.boss_table.get_stage(cycle)
+
+    def get_boss_status_from_record(self, boss: int, record: BattleRecord = None) -> BossStatus:
+        if not record:
+            max_hp = self.boss_table.get_max_hp(1, boss)
+            return BossStatus(boss, 1, 1, max_hp, max_hp)
+        if record.boss_hp == record.damage:
+            boss_cycle = record.target_cycle+1
+            boss_stage = self.get_cycle_stage(boss_cycle)
+            max_hp = self.boss_table.get_max_hp(boss_stage, boss)
+            return BossStatus(boss, boss_cycle, boss_stage, max_hp, max_hp)
+        else:
+            boss_cycle = record.target_cycle
+            boss_stage = self.get_cycle_stage(boss_cycle)
+            return BossStatus(boss, boss_cycle, boss_stage, record.boss_hp-record.damage, self.boss_table.get_max_hp(boss_stage, boss))
+
+    def save_boss_state(self, boss: int, record: BattleRecord = None):
+        status = self.get_boss_status_from_record(boss, record)
+        BossState.insert(clan_gid=self.clan_info.clan_gid, using_data_num=self.clan_info.current_using_data_num, boss=boss,
+                         cycle=status.target_cycle, stage=status.stage, hp=status.boss_hp
+                         ).on_conflict(conflict_target=[BossState.clan_gid, BossState.using_data_num, BossState.boss],
+                                       update={BossState.cycle: status.target_cycle, BossState.stage: status.stage,
+                                               BossState.hp: status.boss_hp, BossState.version: BossState.version + 1}).execute()
+
+    # 从出刀记录重新计算boss状态，用于撤回出刀和旧数据的迁移
+    def refresh_boss_state(self, boss: int):
+        record = BattleRecord.select().where((BattleRecord.target_boss == boss)
+                                             & (BattleRecord.using_data_num == self.clan_info.current_using_data_num)
+                                             & (BattleRecord.clan_gid == self.clan_info.clan_gid)
+                                             ).order_by(BattleRecord.record_time.desc()).first()
+        self.save_boss_state(boss, record)
 
     @cache_return
     def get_current_boss_state(self) -> List[BossStatus]:
+        states: List[BossState] = list(BossState.select().where((BossState.clan_gid == self.clan_info.clan_gid)
+                                                               & (BossState.using_data_num == self.clan_info.current_using_data_num)
+                                                               ).order_by(BossState.boss))
+        if len(states) != 5:
+            with sqlite_db.atomic("IMMEDIATE"):
+                for i in range(1, 6):
+                    self.refresh_boss_state(i)
+            return self.get_current_boss_state()
+        boss_table = self.boss_table
         ret_list = []
-        for i in range(1, 6):
-            result: BattleRecord = BattleRecord.select().where((BattleRecord.target_boss == i)
-                                                               & (BattleRecord.using_data_num == self.clan_info.current_using_data_num)
-                                                               & (BattleRecord.clan_gid == self.clan_info.clan_gid)
-                                                               ).order_by(BattleRecord.record_time.desc()).limit(1)
-            if not result:
-                ret_list.append(BossStatus(
-                    i, 1, 1, boss_info["boss"][self.clan_info.clan_type][0][i-1], boss_info["boss"][self.clan_info.clan_type][0][i-1]))
-            else:
-                result = result[0]
-                if result.boss_hp == result.damage:
-                    boss_cycle = result.target_cycle+1
-                    boss_stage = self.get_cycle_stage(boss_cycle)
-                    ret_list.append(BossStatus(result.target_boss, boss_cycle, boss_stage,
-                                    boss_info["boss"][self.clan_info.clan_type][boss_stage-1][result.target_boss-1], boss_info["boss"][self.clan_info.clan_type][boss_stage-1][result.target_boss-1]))
-                else:
-                    boss_cycle = result.target_cycle
-                    boss_stage = self.get_cycle_stage(boss_cycle)
-                    ret_list.append(BossStatus(
-                        result.target_boss, boss_cycle, boss_stage, result.boss_hp-result.damage, boss_info["boss"][self.clan_info.clan_type][boss_stage-1][result.target_boss-1]))
+        for state in states:
+            ret_list.append(BossStatus(state.boss, state.cycle, state.stage, state.hp,
+                                       boss_table.get_max_hp(state.stage, state.boss)))
         return ret_list
 
-    async def boss_kill_process(self, uid: str, boss: int, proxy_report_uid: str):
-        bot: Bot = list(nonebot.get_bots().values())[0]
-        gid = self.clan_info.clan_gid
+    @clear_cache
+    def boss_kill_process(self, uid: str, boss: int, proxy_report_uid: str) -> List[Message]:
         current_boss_status = self.get_current_boss_state()
         on_tree_list = self.get_battle_on_tree(boss=boss)
         battle_subscribe_list = self.get_battle_subscribe(boss=boss)
         battle_in_progress_list = self.get_battle_in_progress(boss=boss)
         current_max_challenge_cycle = self.get_max_challenge_boss_cycle(
             current_boss_status)
-        current_boss_status[boss-1].target_cycle -= 1
+        # boss状态可能来自缓存，复制后再修改
+        previous_boss_status = list(current_boss_status)
+        previous_boss_status[boss-1] = copy.copy(current_boss_status[boss-1])
+        previous_boss_status[boss-1].target_cycle -= 1
         previous_max_challenge_cycle = self.get_max_challenge_boss_cycle(
-            current_boss_status)
-        current_boss_status[boss-1].target_cycle += 1
+            previous_boss_status)
         no_report_uid_set = {uid, proxy_report_uid}
         on_tree_mention_set = set()
         battle_subscribe_mention_qq_set = set()
@@ -685,6 +1256,7 @@ class ClanBattleData:
         battle_subscribe_able_challenge_set -= no_report_uid_set
         battle_in_progress_mention_qq_set -= no_report_uid_set
         battle_subscribe_able_challenge_set -= no_report_uid_set
+        notice_msg_list = []
         # 预约当前和正在挑战提醒
         memtion_boss_killed_msg = Message()
         if battle_subscribe_mention_qq_set or battle_in_progress_mention_qq_set:
@@ -695,35 +1267,24 @@ class ClanBattleData:
                     map(MessageSegment.at, battle_subscribe_mention_qq_set))
             if battle_in_progress_mention_qq_set:
                 memtion_boss_killed_msg += Message(
-                    map(MessageSegment.at, battle_subscribe_mention_qq_set))
+                    map(MessageSegment.at, battle_in_progress_mention_qq_set))
         if len(memtion_boss_killed_msg) > 0:
-            try:
-                await bot.send_group_msg(group_id=gid, message=memtion_boss_killed_msg)
-                await asyncio.sleep(0.5)
-            except:
-                pass
+            notice_msg_list.append(memtion_boss_killed_msg)
         # 下树提醒
         on_tree_mention_msg = Message()
         if on_tree_mention_set:
             on_tree_mention_msg += MessageSegment.text("下树啦\n") + \
                 Message(map(MessageSegment.at, on_tree_mention_set))
         if len(on_tree_mention_msg) > 0:
-            try:
-                await bot.send_group_msg(group_id=gid, message=on_tree_mention_msg)
-                await asyncio.sleep(0.5)
-            except:
-                pass
+            notice_msg_list.append(on_tree_mention_msg)
         # 预约可挑战提醒
         battle_subscribe_able_challenge_msg = Message()
         if battle_subscribe_able_challenge_set:
             battle_subscribe_able_challenge_msg += MessageSegment.text("现在可以出刀了\n") + Message(
                 map(MessageSegment.at, battle_subscribe_able_challenge_set))
         if len(battle_subscribe_able_challenge_msg) > 0:
-            try:
-                await bot.send_group_msg(group_id=gid, message=battle_subscribe_able_challenge_msg)
-                await asyncio.sleep(0.5)
-            except:
-                pass
+            notice_msg_list.append(battle_subscribe_able_challenge_msg)
+        return notice_msg_list
 
     def get_max_challenge_boss_cycle(self, boss_data: List[BossStatus]) -> int:
         current_max_cycle = boss_data[0].target_cycle
@@ -738,9 +1299,9 @@ class ClanBattleData:
         if current_max_cycle - current_min_cycle == 2:
             return current_max_cycle - 1
         elif current_max_cycle - current_min_cycle == 1:
-            if next_stage == len(boss_info["cycle"][self.clan_info.clan_type]) + 1:
+            if next_stage == self.boss_table.stage_num + 1:
                 return current_max_cycle
-            if current_max_cycle == boss_info["cycle"][self.clan_info.clan_type][next_stage - 1]:
+            if current_max_cycle == self.boss_table.cycle_thresholds[next_stage - 1]:
                 return current_min_cycle
             else:
                 return current_max_cycle
@@ -766,23 +1327,33 @@ class ClanBattleData:
             return NewRecordLegalCheckResult.success
         return NewRecordLegalCheckResult.boss_not_challengeable
 
-    async def commit_record(self, uid: str, target_boss: int, damage: str, comment: str, proxy_report_uid: str = None, force_use_full_chance: bool = False) -> CommitRecordResult:
-        damage_num = 0
-        try:
-            damage_num = self.parse_damage(damage)
-        except ClanBattleDamageParseException:
-            return CommitRecordResult.illegal_damage_inpiut
+    # 返回上报结果和击杀boss后需要发送的群提醒
+    # is_kill_boss 为 True 时忽略 damage，以提交时boss的剩余血量作为伤害
+    # expected_cycle 为上报者看到的周目，提交时boss已经进入其他周目则返回 boss_status_changed
+    @clear_cache
+    @in_transaction
+    def commit_record(self, uid: str, target_boss: int, damage: str, comment: str, proxy_report_uid: str = None, force_use_full_chance: bool = False, is_kill_boss: bool = False, expected_cycle: int = None) -> Tuple[CommitRecordResult, List[Message]]:
         boss_status = self.get_current_boss_state()
         boss = boss_status[target_boss-1]
+        if expected_cycle and boss.target_cycle != expected_cycle:
+            return (CommitRecordResult.boss_status_changed, [])
+        damage_num = 0
+        if is_kill_boss:
+            damage_num = boss.boss_hp
+        else:
+            try:
+                damage_num = self.parse_damage(damage)
+            except ClanBattleDamageParseException:
+                return (CommitRecordResult.illegal_damage_inpiut, [])
         record_status = self.get_today_record_status(uid)
         if damage_num > boss.boss_hp:
-            return CommitRecordResult.damage_out_of_hp
+            return (CommitRecordResult.damage_out_of_hp, [])
         if (check_result := self.check_new_record_legal(uid, boss.target_cycle, boss.target_boss, damage_num)) == NewRecordLegalCheckResult.boss_not_challengeable:
-            return CommitRecordResult.boss_not_challengeable
+            return (CommitRecordResult.boss_not_challengeable, [])
         if check_result == NewRecordLegalCheckResult.on_another_tree:
-            return CommitRecordResult.on_another_tree
+            return (CommitRecordResult.on_another_tree, [])
         if not self.check_joined_clan(uid):
-            return CommitRecordResult.member_not_in_clan
+            return (CommitRecordResult.member_not_in_clan, [])
         if on_tree := self.get_battle_on_tree(uid=uid):
             on_tree[0].delete_instance()
         if on_sub := self.get_battle_subscribe(uid=uid, boss=target_boss, boss_cycle=boss.target_cycle):
@@ -807,9 +1378,11 @@ class ClanBattleData:
             self.create_new_record(uid, boss.target_cycle,
                                    target_boss, damage_num, boss.boss_hp, comment, False, False, proxy_report_uid)
         if damage_num == boss.boss_hp:
-            await self.boss_kill_process(uid, target_boss, proxy_report_uid)
-        return CommitRecordResult.success
+            return (CommitRecordResult.success, self.boss_kill_process(uid, target_boss, proxy_report_uid))
+        return (CommitRecordResult.success, [])
 
+    @clear_cache
+    @in_transaction
     def commit_battle_in_progress(self, uid: str, target_boss: int, comment: str) -> CommitInProgressResult:
         boss_status = self.get_current_boss_state()
         boss = boss_status[target_boss-1]
@@ -829,6 +1402,8 @@ class ClanBattleData:
             uid, boss.target_cycle, target_boss, comment)
         return CommitInProgressResult.success
 
+    @clear_cache
+    @in_transaction
     def commit_batle_subscribe(self, uid: str, target_boss: int, target_cycle: int = None, comment: str = None) -> CommitSubscribeResult:
         boss_status = self.get_current_boss_state()
         boss = boss_status[target_boss-1]
@@ -851,6 +1426,8 @@ class ClanBattleData:
             uid, cycle, target_boss, comment)
         return CommitSubscribeResult.success
 
+    @clear_cache
+    @in_transaction
     def commit_battle_on_tree(self, uid: str, target_boss: int, comment: str) -> CommitBattlrOnTreeResult:
         boss_status = self.get_current_boss_state()
         boss = boss_status[target_boss-1]
@@ -870,6 +1447,8 @@ class ClanBattleData:
             uid, boss.target_cycle, target_boss, comment)
         return CommitBattlrOnTreeResult.success
 
+    @clear_cache
+    @in_transaction
     def commit_battle_sl(self, uid: str,  target_boss: int = None, comment: str = None, proxy_report_uid: str = None) -> CommitSLResult:
         if not self.check_joined_clan(uid):
             return CommitSLResult.member_not_in_clan
@@ -889,6 +1468,8 @@ class ClanBattleData:
                 uid, None, None, comment, proxy_report_uid)
         return CommitSLResult.success
 
+    @clear_cache
+    @in_transaction
     def commit_force_change_boss_status(self, target_boss: int, target_cycle: int, target_hp: str) -> bool:
         try:
             boss_hp = self.parse_damage(target_hp)
@@ -899,44 +1480,127 @@ class ClanBattleData:
         return True
 
 
+class AsyncClanBattleData:
+    # ClanBattleData 的异步封装，所有查询都在数据库线程中执行
+    # 同一公会的写操作按顺序执行，读操作和其他公会的操作可以并发
+
+    write_methods = frozenset([
+        "set_clan_members", "set_clan_name", "set_using_data_num", "set_current_clanbattle_data",
+        "clear_current_clanbattle_data", "rename_clan", "add_clan_member", "add_clan_members",
+        "delete_clan_member", "refresh_clan_admin", "add_clan_admin", "rename_user_uname", "create_new_battle_subscribe",
+        "create_new_battle_in_progress", "create_new_battle_on_tree", "create_new_battle_sl",
+        "create_new_record", "delete_recent_record", "delete_battle_in_progress",
+        "delete_battle_subscribe", "delete_battle_on_tree", "update_battle_in_progress_record",
+        "update_on_tree_record", "save_boss_state", "refresh_boss_state", "commit_battle_in_progress",
+        "commit_batle_subscribe", "commit_battle_on_tree", "commit_battle_sl",
+        "commit_force_change_boss_status", "boss_kill_process", "import_records",
+    ])
+
+    def __init__(self, clan_data: ClanBattleData) -> None:
+        self.data = clan_data
+
+    @property
+    def clan_info(self) -> ClanInfo:
+        return self.data.clan_info
+
+    # 只读取内存中的版本号，不需要在数据库线程中执行
+    def get_state_etag(self, name: str) -> str:
+        return self.data.get_state_etag(name)
+
+    def __getattr__(self, name: str):
+        attr = getattr(self.data, name)
+        if not callable(attr):
+            return attr
+        if name in self.write_methods:
+            async def write_func(*args, **kwargs):
+                return await db_executor.run_write(self.clan_info.clan_gid, attr, *args, **kwargs)
+            return write_func
+
+        async def read_func(*args, **kwargs):
+            return await db_executor.run(attr, *args, **kwargs)
+        return read_func
+
+    async def run(self, func, *args, write: bool = False, **kwargs):
+        if write:
+            return await db_executor.run_write(self.clan_info.clan_gid, func, self.data, *args, **kwargs)
+        return await db_executor.run(func, self.data, *args, **kwargs)
+
+    async def commit_record(self, uid: str, target_boss: int, damage: str, comment: str, proxy_report_uid: str = None, force_use_full_chance: bool = False, is_kill_boss: bool = False, expected_cycle: int = None) -> CommitRecordResult:
+        result, notice_msg_list = await db_executor.run_write(self.clan_info.clan_gid, self.data.commit_record, uid, target_boss, damage, comment, proxy_report_uid, force_use_full_chance, is_kill_boss, expected_cycle)
+        if notice_msg_list:
+            await self.send_group_notice(notice_msg_list)
+        return result
+
+    async def send_group_notice(self, msg_list: List[Message]):
+        for msg in msg_list:
+            message_sender.send(self.clan_info.clan_gid, msg)
+
+
 class ClanBattle:
 
-    clan_data_dict: Dict[str, ClanBattleData] = {}
+    clan_data_dict: Dict[str, AsyncClanBattleData] = {}
+    # 同一公会第一次加载时只创建一个实例
+    clan_data_locks: Dict[str, asyncio.Lock] = {}
 
     def __init__(self) -> None:
         pass
 
-    def get_joined_clan(self, uid: str) -> List[str]:
-        user: User = User.select().where(User.qq_uid == uid).get()
-        return ClanBattleData.get_db_strlist_list(user.clan_joined)
+    @staticmethod
+    def query_joined_clan(uid: str) -> List[str]:
+        joined = ClanMembership.select(ClanMembership.clan_gid).where(
+            ClanMembership.uid == uid).order_by(ClanMembership.id)
+        return [member.clan_gid for member in joined]
+
+    async def get_joined_clan(self, uid: str) -> List[str]:
+        return await db_executor.run(self.query_joined_clan, uid)
+
+    # 返回会话对应的 uid 和已加入的公会，命中缓存时不访问数据库
+    async def check_session(self, session: str) -> Tuple[Optional[str], List[str]]:
+        if session_info := session_cache.get(session):
+            return session_info
+        return await db_executor.run(WebAuth.get_session_info, session)
+
+    async def get_session_uid(self, session: str) -> Optional[str]:
+        return (await self.check_session(session))[0]
 
-    def get_clan_data(self, gid: str) -> ClanBattleData:
-        if not gid in list(self.clan_data_dict.keys()):
+    async def get_clan_data(self, gid: str) -> AsyncClanBattleData:
+        if gid in self.clan_data_dict:
+            return self.clan_data_dict[gid]
+        async with self.clan_data_locks.setdefault(gid, asyncio.Lock()):
+            if gid in self.clan_data_dict:
+                return self.clan_data_dict[gid]
             try:
-                clan_data = ClanBattleData(gid)
-                self.clan_data_dict[gid] = clan_data
-                return clan_data
-            except:
+                clan_data = AsyncClanBattleData(await db_executor.run(ClanBattleData, gid))
+            except (ClanInfo.DoesNotExist, ClanBattleException):
                 return None
-        else:
-            return self.clan_data_dict[gid]
+            self.clan_data_dict[gid] = clan_data
+            return clan_data
+
+    async def create_clan(self, gid: str, clan_name: str, clan_type: str, clan_admin: List[str]):
+        await db_executor.run_write(gid, ClanBattleData.create_clan, gid, clan_name, clan_type, clan_admin)
+        await self.get_clan_data(gid)
 
-    def create_clan(self, gid: str, clan_name: str, clan_type: str, clan_admin: List[str]):
-        ClanBattleData.create_clan(gid, clan_name, clan_type, clan_admin)
-        self.get_clan_data(gid)
-
-    def delete_clan(self, gid: str):
-        clan = self.get_clan_data(gid)
-        clan.clear_current_clanbattle_data()
-        members = clan.get_clan_members()
-        for member in members:
-            clan.delete_clan_member(member)
-        ClanBattleData.delete_clan(gid)
+    @staticmethod
+    def delete_clan_data(clan: ClanBattleData) -> Dict[str, int]:
+        try:
+            return ClanBattleData.delete_clan(clan.clan_info.clan_gid)
+        finally:
+            clan.bump_state_version()
+
+    async def delete_clan(self, gid: str) -> Dict[str, int]:
+        clan = await self.get_clan_data(gid)
+        deleted = await clan.run(self.delete_clan_data, write=True)
         del self.clan_data_dict[gid]
+        return deleted
 
 
 class WebAuth:
 
+    # 会话有效期，每次使用后重新计算
+    session_expire = datetime.timedelta(days=30)
+    # 距离上次使用超过该时间才更新数据库中的使用时间，避免每次请求都写入
+    session_refresh_interval = datetime.timedelta(hours=1)
+
     @staticmethod
     def check_password(uid: str, password: str) -> bool:
         user: User = User.get(User.qq_uid == uid)
@@ -956,21 +1620,67 @@ class WebAuth:
         user.save()
 
     @staticmethod
-    def check_session_valid(session: str) -> str:
+    def get_valid_session(session: str) -> WebSession:
         if not session:
             return None
-        user = User.select().where(User.web_session == session)
-        return user[0].qq_uid if user else None
+        now_time = datetime.datetime.utcnow()
+        web_session: WebSession = WebSession.select().where((WebSession.token == session)
+                                                           & (WebSession.expires > now_time)).first()
+        if not web_session:
+            return None
+        if now_time - web_session.last_seen > WebAuth.session_refresh_interval:
+            web_session.last_seen = now_time
+            web_session.expires = now_time + WebAuth.session_expire
+            WebSession.update(last_seen=now_time, expires=web_session.expires).where(
+                WebSession.token == session).execute()
+        return web_session
+
+    @staticmethod
+    def check_session_valid(session: str) -> str:
+        web_session = WebAuth.get_valid_session(session)
+        return web_session.uid if web_session else None
 
+    # 每次登录创建新的会话，同一用户可以在多个设备上同时登录
     @staticmethod
     def create_session(uid: str) -> str:
-        session = str(uuid.uuid4()).replace("-", "")
-        while User.select().where(User.web_session == session):
+        now_time = datetime.datetime.utcnow()
+        while True:
             session = str(uuid.uuid4()).replace("-", "")
-        user: User = User.select().where(User.qq_uid == uid).get()
-        user.web_session = session
-        user.save()
-        return session
+            try:
+                WebSession.create(token=session, uid=uid, created=now_time,
+                                  last_seen=now_time, expires=now_time + WebAuth.session_expire)
+                session_cache.invalidate_tokens([session])
+                return session
+            except IntegrityError:
+                continue
+
+    # 分批删除过期的会话，返回删除的数量
+    @staticmethod
+    def sweep_expired_sessions(batch_size: int = 500) -> int:
+        deleted = 0
+        while True:
+            expired = list(WebSession.select(WebSession.id, WebSession.token).where(
+                WebSession.expires < datetime.datetime.utcnow()).limit(batch_size))
+            if not expired:
+                return deleted
+            count = WebSession.delete().where(
+                WebSession.id.in_([session.id for session in expired])).execute()
+            # 删除的会话可能还在缓存中
+            session_cache.invalidate_tokens([session.token for session in expired])
+            deleted += count
+            if count < batch_size:
+                return deleted
+
+    @staticmethod
+    def get_session_info(session: str) -> Tuple[Optional[str], List[str]]:
+        generation = session_cache.generation
+        web_session = WebAuth.get_valid_session(session)
+        if not web_session:
+            return (None, [])
+        joined_clan = ClanBattle.query_joined_clan(web_session.uid)
+        session_cache.set(session, web_session.uid, joined_clan,
+                          generation, web_session.expires)
+        return (web_session.uid, joined_clan)
 
     @staticmethod
     # Tuple(code, sessison)
@@ -985,6 +1695,17 @@ class WebAuth:
 
 class Tools:
 
+    # 按 If-None-Match 的规则比较 ETag，请求头可以包含多个 ETag 或 *，使用弱比较
+    # ETag 的引号中可能包含逗号，不能直接按逗号分割
+    @staticmethod
+    def etag_matches(if_none_match: str, etag: str) -> bool:
+        if not if_none_match:
+            return False
+        if if_none_match.strip() == "*":
+            return True
+        opaque_tag = etag[2:] if etag.startswith("W/") else etag
+        return opaque_tag in re.findall(r'(?:W/)?("[^"]*")', if_none_match)
+
     @staticmethod
     def get_chinese_timedetla(target_time: datetime.datetime) -> str:
         now_time = datetime.datetime.utcnow()
@@ -1017,95 +1738,99 @@ class Tools:
 
     @staticmethod
     def update_boss_info():
-        global boss_info
+        global boss_info, boss_tables
         boss_info = get_config().boss_info
+        boss_tables = compile_boss_tables(boss_info)
 
 class MessageFormatter:
 
+    # boss的预约、出刀中和挂树成员，names 为 uid -> 昵称
     @staticmethod
-    def get_boss_status_msg(clan:ClanBattleData, boss_count:int) -> str:
-        boss_status = clan.get_current_boss_state()
-        boss = boss_status[boss_count-1]
-        msg = f"当前{boss_count}王位于{boss.target_cycle}周目，剩余血量{Tools.get_num_str_with_dot(boss.boss_hp)}"
-        if not clan.check_boss_challengeable(boss.target_cycle, boss_count):
-            msg += "（不可挑战）"
-        subs = clan.get_battle_subscribe(
-            boss=boss_count, boss_cycle=boss.target_cycle)
-        if subs: 
-            has_add_msg = True
+    def get_boss_member_msg(subs: List[BattleSubscribe], in_processes: List[BattleInProgress], on_tree: List[BattleOnTree], names: Dict[str, str]) -> str:
+        msg = ""
+        if subs:
             msg += "\n📅 "
             for sub in subs:
                 msg += " "
-                msg += clan.get_user_name(sub.member_uid)
+                msg += names[sub.member_uid]
                 if sub.comment and sub.comment != "":
                     msg += f"：{sub.comment}"
-        in_processes = clan.get_battle_in_progress(boss=boss_count)
         if in_processes:
-            has_add_msg = True
             msg += "\n🔪 "
             for proc in in_processes:
                 msg += " "
-                proc_msg = clan.get_user_name(proc.member_uid)
+                proc_msg = names[proc.member_uid]
                 if proc.comment and proc.comment != "":
                     proc_msg += f"：{proc.comment}"
                 msg += proc_msg
-        on_tree = clan.get_battle_on_tree(boss=boss_count)
         if on_tree:
-            has_add_msg = True
             msg += "\n🎄 "
             for tree in on_tree:
                 msg += " "
-                on_tree_msg = clan.get_user_name(tree.member_uid)
+                on_tree_msg = names[tree.member_uid]
                 if tree.comment and tree.comment != "":
                     on_tree_msg += f"：{tree.comment}"
                 msg += on_tree_msg
         return msg
 
+    # 每个boss的状态、是否可挑战和成员信息，单个boss和全部boss的状态共用
+    # 结果按公会的数据版本缓存，数据变化后才重新生成
     @staticmethod
-    def get_all_boss_status_msg(clan:ClanBattleData) -> str:
+    def get_boss_status_pieces(clan: ClanBattleData) -> List[Tuple[BossStatus, bool, str]]:
+        version = clan.state_version
+        is_hit, pieces = clan.cache.get("boss_status_pieces", version)
+        if is_hit:
+            return pieces
         boss_status = clan.get_current_boss_state()
-        msg = ""
-        boss_count = 0
+        max_challenge_cycle = clan.get_max_challenge_boss_cycle(boss_status)
+        # 一次取出所有boss的数据和昵称，查询次数与人数无关
+        all_subs = clan.get_battle_subscribe()
+        all_in_processes = clan.get_battle_in_progress()
+        all_on_tree = clan.get_battle_on_tree()
+        names = clan.get_user_names(
+            [item.member_uid for item in all_subs + all_in_processes + all_on_tree])
+        pieces = []
         for boss in boss_status:
-            boss_count += 1
-            msg += f"{boss.target_cycle}周目{boss.target_boss}王，生命值{Tools.get_num_str_with_dot(boss.boss_hp)}" if not get_config(
-            ).enable_anti_msg_fail else f"{boss.target_cycle}周目{boss.target_boss}王 HP{Tools.get_num_str_with_dot(boss.boss_hp)}"
-            if not clan.check_boss_challengeable(boss.target_cycle, boss.target_boss):
-                msg += "（不可挑战）"
-            has_add_msg = False
-            subs = clan.get_battle_subscribe(
-                boss=boss_count, boss_cycle=boss.target_cycle)
-            if subs:
-                has_add_msg = True
-                msg += "\n📅 "
-                for sub in subs:
-                    msg += " "
-                    msg += clan.get_user_name(sub.member_uid)
-                    if sub.comment and sub.comment != "":
-                        msg += f"：{sub.comment}"
-            in_processes = clan.get_battle_in_progress(boss=boss_count)
-            if in_processes:
-                has_add_msg = True
-                msg += "\n🔪 "
-                for proc in in_processes:
-                    msg += " "
-                    proc_msg = clan.get_user_name(proc.member_uid)
-                    if proc.comment and proc.comment != "":
-                        proc_msg += f"：{proc.comment}"
-                    msg += proc_msg
-            on_tree = clan.get_battle_on_tree(boss=boss_count)
-            if on_tree:
-                has_add_msg = True
-                msg += "\n🎄 "
-                for tree in on_tree:
-                    msg += " "
-                    on_tree_msg = clan.get_user_name(tree.member_uid)
-                    if tree.comment and tree.comment != "":
-                        on_tree_msg += f"：{tree.comment}"
-                    msg += on_tree_msg
-            msg += "\n"
-            if(has_add_msg):
-                msg += "----------------------\n"
+            subs = [sub for sub in all_subs if sub.target_boss ==
+                    boss.target_boss and sub.target_cycle == boss.target_cycle]
+            in_processes = [
+                proc for proc in all_in_processes if proc.target_boss == boss.target_boss]
+            on_tree = [
+                tree for tree in all_on_tree if tree.target_boss == boss.target_boss]
+            pieces.append((boss, boss.target_cycle <= max_challenge_cycle,
+                           MessageFormatter.get_boss_member_msg(subs, in_processes, on_tree, names)))
+        clan.cache.set("boss_status_pieces", version, pieces)
+        return pieces
+
+    @staticmethod
+    def get_boss_status_msg(clan:ClanBattleData, boss_count:int) -> str:
+        boss, challengeable, member_msg = MessageFormatter.get_boss_status_pieces(clan)[
+            boss_count-1]
+        msg = f"当前{boss_count}王位于{boss.target_cycle}周目，剩余血量{Tools.get_num_str_with_dot(boss.boss_hp)}"
+        if not challengeable:
+            msg += "（不可挑战）"
+        return msg + member_msg
+
+    @staticmethod
+    def get_all_boss_status_msg(clan:ClanBattleData) -> str:
+        anti_msg_fail = get_config().enable_anti_msg_fail
+        version = clan.state_version
+        cache_key = f"all_boss_status_msg{anti_msg_fail}"
+        is_hit, msg = clan.cache.get(cache_key, version)
+        if is_hit:
+            return msg
+        msg_list = []
+        for boss, challengeable, member_msg in MessageFormatter.get_boss_status_pieces(clan):
+            msg_list.append(f"{boss.target_cycle}周目{boss.target_boss}王，生命值{Tools.get_num_str_with_dot(boss.boss_hp)}" if not anti_msg_fail
+                            else f"{boss.target_cycle}周目{boss.target_boss}王 HP{Tools.get_num_str_with_dot(boss.boss_hp)}")
+            if not challengeable:
+                msg_list.append("（不可挑战）")
+            msg_list.append(member_msg)
+            msg_list.append("\n")
+            if member_msg:
+                msg_list.append("----------------------\n")
+        msg = "".join(msg_list)
+        clan.cache.set(cache_key, version, msg)
         return msg
 
 class ClanRankQueryHelperTw:
@@ -0,0 +1,96 @@
+import asyncio
+
+from fastapi import WebSocket
+from fastapi.encoders import jsonable_encoder
+from typing import Any, Callable, Dict, Set
+
+from .utils import AsyncClanBattleData, ClanBattleData
+
+
+class ClanStatePublisher:
+    # 网页面板的推送，公会数据变化后重新生成面板数据，只推送发生变化的部分
+    # 同一公会的所有连接共用一份数据，debounce 时间内的多次变化合并为一次推送
+
+    def __init__(self, debounce: float = 0.2) -> None:
+        self.debounce = debounce
+        self.subscribers: Dict[str, Set[WebSocket]] = {}
+        self.clans: Dict[str, AsyncClanBattleData] = {}
+        self.listeners: Dict[str, Callable[[int], None]] = {}
+        self.sections: Dict[str, Dict[str, Any]] = {}
+        self.versions: Dict[str, int] = {}
+        self.push_tasks: Dict[str, asyncio.Task] = {}
+
+    async def subscribe(self, websocket: WebSocket, clan: AsyncClanBattleData) -> bool:
+        if not clan:
+            return False
+        gid = clan.clan_info.clan_gid
+        if not gid in self.clans:
+            loop = asyncio.get_running_loop()
+            self.listeners[gid] = lambda version: loop.call_soon_threadsafe(
+                self.schedule_push, gid)
+            clan.data.state_listeners.append(self.listeners[gid])
+            self.clans[gid] = clan
+        self.subscribers.setdefault(gid, set()).add(websocket)
+        if not gid in self.sections:
+            await self.refresh(gid)
+        if gid in self.sections:
+            await websocket.send_json({"type": "snapshot", "clan_gid": gid, "version": self.versions[gid],
+                                       "sections": self.sections[gid]})
+        return True
+
+    def unsubscribe(self, websocket: WebSocket):
+        for gid in list(self.subscribers.keys()):
+            self.subscribers[gid].discard(websocket)
+            if not self.subscribers[gid]:
+                # 最后一个连接断开后不再监听公会数据变化
+                del self.subscribers[gid]
+                clan = self.clans.pop(gid)
+                listener = self.listeners.pop(gid)
+                if listener in clan.data.state_listeners:
+                    clan.data.state_listeners.remove(listener)
+                self.sections.pop(gid, None)
+                self.versions.pop(gid, None)
+
+    # 重新生成面板数据，返回发生变化的部分
+    async def refresh(self, gid: str) -> Dict[str, Any]:
+        if not gid in self.clans:
+            return {}
+        clan = self.clans[gid]
+        version = clan.data.state_version
+        sections = jsonable_encoder(await clan.run(ClanBattleData.get_web_status))
+        # 生成期间所有连接都已断开时不保存，避免重新订阅时发送旧的数据
+        if not gid in self.subscribers:
+            return {}
+        last_sections = self.sections.get(gid, {})
+        changed = {key: value for key, value in sections.items()
+                   if last_sections.get(key) != value}
+        self.sections[gid] = sections
+        self.versions[gid] = version
+        return changed
+
+    def schedule_push(self, gid: str):
+        if gid in self.subscribers and not gid in self.push_tasks:
+            self.push_tasks[gid] = asyncio.get_running_loop().create_task(self.push(gid))
+
+    async def push(self, gid: str):
+        try:
+            while gid in self.subscribers:
+                await asyncio.sleep(self.debounce)
+                base_version = self.versions.get(gid)
+                changed = await self.refresh(gid)
+                if changed:
+                    diff = {"type": "diff", "clan_gid": gid, "base_version": base_version,
+                            "version": self.versions[gid], "sections": changed}
+                    for websocket in list(self.subscribers.get(gid, [])):
+                        try:
+                            await websocket.send_json(diff)
+                        except Exception:
+                            self.unsubscribe(websocket)
+                # 推送期间的变化不会再创建推送任务，数据版本已经更新时再推送一次
+                if not gid in self.clans or self.clans[gid].data.state_version == self.versions.get(gid):
+                    break
+        finally:
+            del self.push_tasks[gid]
+
+
+clan_state_publisher = ClanStatePublisher()